@@ -0,0 +1,274 @@
+# app/admission.py
+from __future__ import annotations
+import asyncio
+import contextvars
+import math
+import time
+import weakref
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncContextManager, AsyncIterator, Deque, Dict, Optional
+
+from .config import (
+    ADMISSION_MAX_ACTIVE,
+    ADMISSION_QUEUE_SIZE,
+    ADMISSION_QUEUE_TIMEOUT,
+    CLIENT_RATE_PER_MIN,
+    CLIENT_RATE_BURST,
+    CLIENT_ID_HEADER,
+    TRUSTED_PROXY_HOPS,
+)
+from .deadline import current_deadline
+from .metrics import span
+from .tokens import client_wait
+
+# ── Control de admisión
+# Solo las preguntas que van a llegar a Claude (sin saludo, FAQ ni caché) piden un
+# cupo: hay un máximo de generaciones en curso y una cola acotada con plazo. Si la
+# cola está llena o el plazo vence, se rechaza de inmediato con 503 + Retry-After en
+# lugar de acumular timeouts y 429 de Anthropic para todos. Aparte, cada cliente
+# (IP o header) tiene un token bucket: si lo agota recibe 429 + Retry-After.
+# Los ítems de /ask/batch ("pacientes") esperan en una cola propia, sin tope ni plazo,
+# que solo se atiende cuando no hay preguntas interactivas esperando; y piden el cupo
+# recién dentro de gate("llm") del lote, así no ocupan cupos mientras esperan su turno.
+
+admission_totals: Counter = Counter()
+
+class Overloaded(Exception):
+    """Rechazo rápido: `status` 503 (servidor saturado) o 429 (cliente sobre su tasa)."""
+
+    def __init__(self, status: int, reason: str, retry_after: float):
+        self.status = status
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(f"{reason} (reintentar en {self.retry_after} s)")
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {"Retry-After": str(self.retry_after)}
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"status": self.status, "reason": self.reason, "retry_after": self.retry_after}
+
+class AdmissionController:
+    """Cupos de generación + cola FIFO acotada (+ cola de pacientes). Un controlador por event loop."""
+
+    def __init__(self, max_active: int, queue_size: int, queue_timeout: float):
+        self.max_active = max_active
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters: Deque[asyncio.Future] = deque()   # interactivos (cuentan para queue_size)
+        self._patient: Deque[asyncio.Future] = deque()   # ítems de lote: solo si no hay interactivos
+        # Duración media de un cupo (EWMA) para estimar el Retry-After
+        self._hold_s = 5.0
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def queued_patient(self) -> int:
+        return len(self._patient)
+
+    def retry_after(self) -> float:
+        return self._hold_s * (self.queued + 1) / max(1, self.max_active)
+
+    async def acquire(self, patient: bool = False) -> None:
+        if self.active < self.max_active and not self._waiters and not self._patient:
+            self.active += 1
+            admission_totals["admitted"] += 1
+            return
+        if not patient and len(self._waiters) >= self.queue_size:
+            admission_totals["shed_queue_full"] += 1
+            raise Overloaded(503, "cola de generación llena", self.retry_after())
+
+        fut = asyncio.get_running_loop().create_future()
+        queue = self._patient if patient else self._waiters
+        queue.append(fut)
+        admission_totals["queued_patient" if patient else "queued"] += 1
+        try:
+            if patient or self.queue_timeout <= 0:
+                await fut
+            else:
+                await asyncio.wait_for(asyncio.shield(fut), self.queue_timeout)
+        except BaseException as e:
+            if fut.done() and not fut.cancelled():
+                # El cupo llegó justo cuando nos fuimos: pasarlo al siguiente
+                self.release()
+            else:
+                fut.cancel()
+                try:
+                    queue.remove(fut)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.TimeoutError):
+                admission_totals["shed_timeout"] += 1
+                raise Overloaded(503, "plazo de espera en cola vencido", self.retry_after()) from None
+            raise
+        admission_totals["admitted"] += 1
+
+    def release(self) -> None:
+        # El cupo pasa directo al primer waiter vivo (FIFO, sin carreras con recién llegados);
+        # primero los interactivos, después los pacientes
+        for queue in (self._waiters, self._patient):
+            while queue:
+                fut = queue.popleft()
+                if not fut.done():
+                    fut.set_result(None)
+                    return
+        self.active -= 1
+
+    def observe_hold(self, seconds: float) -> None:
+        self._hold_s = 0.8 * self._hold_s + 0.2 * seconds
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "active": self.active,
+            "max_active": self.max_active,
+            "queued": self.queued,
+            "queued_patient": self.queued_patient,
+            "queue_size": self.queue_size,
+            "queue_timeout_s": self.queue_timeout,
+            "avg_hold_s": round(self._hold_s, 3),
+        }
+
+_controllers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AdmissionController]" = weakref.WeakKeyDictionary()
+
+def get_controller() -> AdmissionController:
+    loop = asyncio.get_running_loop()
+    ctl = _controllers.get(loop)
+    if ctl is None:
+        ctl = _controllers[loop] = AdmissionController(
+            ADMISSION_MAX_ACTIVE, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT
+        )
+    return ctl
+
+# Los ítems de /ask/batch ya tienen sus propios topes: esperan su cupo sin límite de
+# cola ni plazo en vez de ser rechazados, y lo piden en cada llamada a Claude (patient_slot)
+_patient: contextvars.ContextVar[bool] = contextvars.ContextVar("uvg_admission_patient", default=False)
+
+def use_patient(patient: bool) -> contextvars.Token:
+    return _patient.set(patient)
+
+def reset_patient(token: contextvars.Token) -> None:
+    _patient.reset(token)
+
+def is_patient() -> bool:
+    return _patient.get()
+
+@asynccontextmanager
+async def _slot(patient: bool) -> AsyncIterator[None]:
+    ctl = get_controller() if ADMISSION_MAX_ACTIVE > 0 else None
+    if ctl is not None:
+        with span("admission"):
+            await ctl.acquire(patient=patient)
+    if patient:
+        deadline = current_deadline()
+        if deadline is not None:
+            deadline.begin()  # el plazo del ítem corre desde su primer cupo
+    if ctl is None:
+        yield
+        return
+    t0 = time.monotonic()
+    try:
+        yield
+    finally:
+        if not patient:  # el Retry-After se estima con lo que dura una pregunta interactiva
+            ctl.observe_hold(time.monotonic() - t0)
+        ctl.release()
+
+@asynccontextmanager
+async def admission() -> AsyncIterator[None]:
+    """Cupo de una pregunta interactiva; los ítems de lote pasan (piden el suyo en gate("llm"))."""
+    if _patient.get():
+        yield
+        return
+    async with _slot(patient=False):
+        yield
+
+def patient_slot() -> AsyncContextManager[None]:
+    """Cupo de baja prioridad para una llamada a Claude de un ítem de lote."""
+    return _slot(patient=True)
+
+# ── Tasa por cliente (token bucket)
+class TokenBucket:
+    def __init__(self, per_minute: float, burst: float):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def take(self, cost: float = 1.0) -> float:
+        """Consume `cost` fichas; devuelve 0 si se pudo o los segundos a esperar si no."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        cost = min(cost, self.capacity)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+class ClientLimiter:
+    def __init__(self, per_minute: float, burst: float, max_clients: int = 10000):
+        self.per_minute = per_minute
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    def check(self, client: str, cost: float = 1.0) -> None:
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            bucket = self._buckets[client] = TokenBucket(self.per_minute, self.burst)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(client)
+        wait = bucket.take(cost)
+        if wait:
+            admission_totals["rate_limited"] += 1
+            raise Overloaded(429, "demasiadas preguntas de este cliente", wait)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"per_minute": self.per_minute, "burst": self.burst, "clients": len(self._buckets)}
+
+client_limiter: Optional[ClientLimiter] = (
+    ClientLimiter(CLIENT_RATE_PER_MIN, CLIENT_RATE_BURST) if CLIENT_RATE_PER_MIN > 0 else None
+)
+
+def client_key(headers: Any, host: Optional[str]) -> str:
+    """
+    IP del cliente o el valor de CLIENT_ID_HEADER. En X-Forwarded-For los primeros saltos
+    los escribe el propio cliente: solo vale el que agregó el proxy de confianza más
+    externo (TRUSTED_PROXY_HOPS contando desde la derecha); si faltan saltos, la conexión.
+    """
+    if CLIENT_ID_HEADER:
+        value = headers.get(CLIENT_ID_HEADER)
+        if value and CLIENT_ID_HEADER.lower() == "x-forwarded-for":
+            hops = [h.strip() for h in value.split(",") if h.strip()]
+            if TRUSTED_PROXY_HOPS > 0 and len(hops) >= TRUSTED_PROXY_HOPS:
+                return hops[-TRUSTED_PROXY_HOPS]
+        elif value:
+            return value.strip()
+    return host or "desconocido"
+
+def check_client(client: str, cost: float = 1.0) -> None:
+    if client_limiter is not None:
+        client_limiter.check(client, cost)
+    # Cuota diaria de tokens del cliente (CLIENT_DAILY_TOKENS): 429 hasta medianoche
+    wait = client_wait(client)
+    if wait:
+        admission_totals["token_quota"] += 1
+        raise Overloaded(429, "cuota diaria de tokens agotada para este cliente", wait)
+
+def admission_stats() -> Dict[str, Any]:
+    try:
+        ctl: Optional[AdmissionController] = get_controller() if ADMISSION_MAX_ACTIVE > 0 else None
+    except RuntimeError:
+        ctl = None
+    return {
+        "llm": ctl.as_dict() if ctl is not None else {"enabled": False},
+        "clients": client_limiter.as_dict() if client_limiter is not None else {"enabled": False},
+        **dict(admission_totals),
+    }
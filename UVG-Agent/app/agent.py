@@ -1,34 +1,47 @@
 # app/agent.py
 from __future__ import annotations
-import re
-from typing import Literal, Tuple
-
-from .llm import preprocess_query
-from .nuclia import nuclia_search, build_context
-from .clients import client
-from .config import CLAUDE_MODEL, INSTRUCTIONS, MAX_TOKENS, TEMPERATURE
-
-Intent = Literal["greeting", "uvg", "offtopic", "unknown"]
-
-# --- Heurística rápida para detectar saludos ---
-_GREET_RE = re.compile(r"\b(hola|buen[oa]s|qué tal|como estas|¿cómo estás|hi|hello)\b", re.I)
+import asyncio
+import time
+from collections import Counter
+from dataclasses import dataclass, field, replace
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from .llm import preprocess_query_async, system_prompt, text_block
+from .nuclia import nuclia_search_async, build_context, merge_searches, pack_context, record_packing
+from .federation import route_kbs
+from .rerank import rerank
+from .clients import get_async_llm, run_sync
+from .cache import answer_cache, answer_key
+from .text import normalize_question
+from .formatter import restructure, source_lines
+from .faq import faq_lookup
+from .intents import Intent, IntentResult, route_intent
+from .admission import admission, is_patient
+from .deadline import DeadlineExceeded, current_deadline, start_deadline, within
+from .resilience import is_upstream_error, resilient, stale_totals
+from .models import choose_tier, create_message
+from .sessions import FollowUp, Session, history_messages, load_session, plan_followup, save_turn
+from .limits import gate
+from .metrics import ensure_timer, record_usage, span
+from .tokens import allow, attribute, count_tokens, governor_totals, output_cap, violation
+from .config import (
+    CLAUDE_MODEL,
+    INSTRUCTIONS,
+    MAX_TOKENS,
+    TEMPERATURE,
+    SPECULATIVE_SEARCH,
+    REWRITE_DEADLINE,
+    FIX_ENGINE,
+    CONTEXT_PACKING,
+    CONTEXT_TOKEN_BUDGET,
+    RERANK,
+    PROMPT_TOKEN_BUDGET,
+    PROMPT_CACHE_CONTEXT,
+    OFFTOPIC_ROUTING,
+)
 
 def classify_intent(question: str) -> Intent:
-    q = (question or "").strip().lower()
-    if not q:
-        return "unknown"
-    if _GREET_RE.search(q) and len(q.split()) <= 8:
-        return "greeting"
-    # Heurística UVG mínima (menciona carreras, admisiones, sedes, etc.)
-    uvgtokens = [
-        "uvg", "altiplano", "campus sur", "campus central", "admisiones",
-        "carrera", "inscripción", "beca", "arancel", "pensum", "malla",
-        "calendario", "facultad", "laboratorio", "crea", "makerspace"
-    ]
-    if any(t in q for t in uvgtokens):
-        return "uvg"
-    # Dejar lo demás en unknown; el RAG puede decidir luego
-    return "unknown"
+    return route_intent(question).intent
 
 def smalltalk_reply() -> str:
     # Respuesta cordial breve + oferta de ayuda UVG
@@ -43,120 +56,647 @@ def smalltalk_reply() -> str:
         "Cuéntame qué sede o programa te interesa y avanzamos."
     )
 
+def offtopic_reply() -> str:
+    # Tema fuera de UVG: respuesta breve y de vuelta a lo que sí cubrimos
+    return (
+        "Ese tema queda fuera de lo que puedo responder con información de la UVG. 🙂\n\n"
+        "**Con gusto te ayudo con:** admisiones y requisitos, carreras, costos y becas, "
+        "calendario académico o recursos del campus. ¿Qué te gustaría saber?"
+    )
+
+# ── Utilidades compartidas por el pipeline
+_FIX_KEYWORDS = ["requisito", "costo", "beca", "calendario", "plan", "malla", "proceso"]
+_FIX_HEADERS = ["# Respuesta", "## Detalles", "## Siguientes pasos"]
+
+def _text_of(resp) -> str:
+    return "".join(getattr(p, "text", "") for p in (resp.content or [])).strip()
+
+def _wants_structure(question: str) -> bool:
+    # Preguntas informativas (costos, becas, requisitos...) deben seguir el esquema Markdown
+    return any(kw in question.lower() for kw in _FIX_KEYWORDS)
+
+def _needs_fix(question: str, txt: str) -> bool:
+    # Self-check: si parece respuesta informativa pero no trae secciones, reformatea
+    if not txt:
+        return False
+    # Si contiene bullets y bloques, bien; si no, intenta estructurar
+    return _wants_structure(question) and not all(h in txt for h in _FIX_HEADERS)
+
+def _user_prompt(question: str, context: str, no_context: bool) -> str:
+    return (
+        f"Pregunta: {question}\n\n"
+        f"Contexto (fragmentos UVG):\n{context if not no_context else '(sin pasajes relevantes)'}\n\n"
+        "Si el contexto es limitado o nulo, responde igual con una guía breve y solicita datos clave "
+        "(sede, carrera, programa), sin inventar. Si aplica, sigue el esquema Markdown."
+    )
+
+_CONTEXT_HEAD = "Contexto (fragmentos UVG):\n"
+
+def _context_block(context: str) -> Dict[str, Any]:
+    # Debe ser idéntico entre generación y reformateo para que el prefijo se lea de la caché
+    # El prefijo hasta el breakpoint incluye el system
+    return text_block(_CONTEXT_HEAD + context, cache=True, prefix=count_tokens(INSTRUCTIONS))
+
+def _user_content(question: str, context: str, no_context: bool, suffix: str = "") -> Union[str, List[Dict[str, Any]]]:
+    """
+    Mensaje del usuario para la generación. Con PROMPT_CACHE_CONTEXT el contexto va
+    primero, en su propio bloque con breakpoint, y la pregunta después.
+    """
+    if not PROMPT_CACHE_CONTEXT or no_context:
+        return _user_prompt(question, context, no_context) + suffix
+    return [
+        _context_block(context),
+        text_block(
+            f"Pregunta: {question}\n\n"
+            "Si el contexto es limitado, responde igual con una guía breve y solicita datos clave "
+            "(sede, carrera, programa), sin inventar. Si aplica, sigue el esquema Markdown." + suffix
+        ),
+    ]
+
+def _fix_prompt(answer: str) -> str:
+    return (
+        "Reestructura estrictamente en el siguiente esquema Markdown, sin texto fuera del esquema:\n\n"
+        "# Respuesta\n(1–3 líneas)\n\n"
+        "## Detalles\n- puntos clave\n\n"
+        "## Siguientes pasos\n1) …\n\n"
+        "## Fuentes consultadas\n- Título (URL o ID)\n\n"
+        f"=== TEXTO ===\n{answer}"
+    )
+
+_FIX_SYSTEM = "Eres un reformateador estricto de Markdown."
+
+def _fix_request(answer: str, context: str, no_context: bool) -> Dict[str, Any]:
+    """system + messages de la pasada de reformateo con el LLM."""
+    if PROMPT_CACHE_CONTEXT and not no_context:
+        # Mismo prefijo (system + contexto) que la generación: se lee de la caché
+        return dict(
+            system=system_prompt(INSTRUCTIONS),
+            messages=[{"role": "user", "content": [
+                _context_block(context),
+                text_block(f"{_FIX_SYSTEM}\n\n{_fix_prompt(answer)}"),
+            ]}],
+        )
+    return dict(
+        system=system_prompt(_FIX_SYSTEM),
+        messages=[{"role": "user", "content": _fix_prompt(answer)}],
+    )
+
+_EMPTY_REPLY = "¡Hola! ¿Qué te gustaría saber de la UVG? Puedo ayudarte con admisiones, carreras, costos, becas y más."
+
+_NO_CONTEXT_REPLY = (
+    "Puedo ayudarte con información de la UVG aunque no encontré pasajes relevantes ahora mismo.\n\n"
+    "**Dime:** sede (Altiplano, Central, Sur) y programa/carrera que te interesa.\n\n"
+    "**Temas comunes:** admisiones, requisitos, costos/becas, calendario, laboratorios, servicios del campus."
+)
+
+def _fallback_answer(sources: List[dict]) -> str:
+    # Presupuesto agotado antes de generar: lo que ya se encontró, sin inventar nada
+    if not sources:
+        return (
+            "# Respuesta\nNo alcancé a consultar la información de la UVG a tiempo.\n\n"
+            "## Siguientes pasos\n1) Vuelve a intentarlo en unos segundos."
+        )
+    return (
+        "# Respuesta\nNo alcancé a redactar una respuesta completa a tiempo, pero estas fuentes "
+        "de la UVG tratan tu pregunta.\n\n"
+        "## Siguientes pasos\n1) Revisa las fuentes o vuelve a intentarlo en unos segundos.\n\n"
+        "## Fuentes consultadas\n" + "\n".join(source_lines(sources))
+    )
+
+def faq_meta(faq) -> Dict[str, Any]:
+    return {"id": faq.id, "score": faq.score, "question": faq.question}
+
+# Cómo se resolvió el esquema Markdown: ok | local | llm
+format_paths: Counter = Counter()
+
+# Qué camino ganó en cada búsqueda (para medir si la reescritura vale su latencia)
+retrieval_paths: Counter = Counter()
+
+async def _speculative_search(question: str, search_kw: Dict[str, Any]) -> Tuple[dict, Dict[str, Any]]:
+    """
+    Lanza la búsqueda con la pregunta original al mismo tiempo que la reescritura.
+    Si la reescritura llega antes de REWRITE_DEADLINE se busca también con ella y se
+    fusionan ambos resultados; si no, se sigue con los resultados de la pregunta original.
+    """
+    t0 = time.perf_counter()
+    info: Dict[str, Any] = {"mode": "speculative", "query": question}
+    raw_task = asyncio.ensure_future(nuclia_search_async(question, **search_kw))
+    rewrite_task = asyncio.ensure_future(preprocess_query_async(question))
+    try:
+        try:
+            consulta = await asyncio.wait_for(rewrite_task, timeout=REWRITE_DEADLINE)
+        except asyncio.TimeoutError:
+            info["path"] = "raw_deadline"
+            return await raw_task, info
+        except Exception:
+            info["path"] = "raw_rewrite_error"
+            return await raw_task, info
+
+        info["rewrite_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        if normalize_question(consulta) == normalize_question(question):
+            info["path"] = "raw_same_query"
+            return await raw_task, info
+
+        info["query"] = consulta
+        raw, rewritten = await asyncio.gather(
+            raw_task, nuclia_search_async(consulta, **search_kw), return_exceptions=True
+        )
+        if isinstance(rewritten, BaseException) and isinstance(raw, BaseException):
+            raise rewritten
+        if isinstance(rewritten, BaseException):
+            info["path"] = "raw_search_only"
+            return raw, info
+        if isinstance(raw, BaseException):
+            info["path"] = "rewrite_search_only"
+            return rewritten, info
+        info["path"] = "merged"
+        return merge_searches(rewritten, raw), info
+    finally:
+        for task in (raw_task, rewrite_task):
+            if not task.done():
+                task.cancel()
+
+def degraded_search(info: Dict[str, Any]) -> bool:
+    """¿La búsqueda salió de un respaldo? (caché vencida, índice local por fallo de Nuclia, KB caídas)"""
+    return ("stale_search" in info or "reason" in info.get("local_search", {})
+            or "failed" in info.get("federation", {}))
+
+@dataclass
+class Retrieval:
+    search: dict               # respuesta cruda de Nuclia (search_results)
+    selected: dict             # vista de `search` con solo los párrafos que entraron al contexto
+    context: str
+    no_context: bool
+    info: Dict[str, Any] = field(default_factory=dict)
+    max_chunks: int = 20       # párrafos efectivos (menos si se recortó por plazo)
+
+def _context_paragraphs(r: Retrieval) -> List[dict]:
+    if r.no_context:
+        return []
+    return ((r.selected.get("paragraphs") or {}).get("results") or [])[:r.max_chunks]
+
+def _render_context(selected: dict, max_chunks: int) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """Contexto de `selected` y, si se empaqueta, sus estadísticas (sin registrarlas)."""
+    if CONTEXT_PACKING:
+        context, _used, stats = pack_context(
+            selected, token_budget=CONTEXT_TOKEN_BUDGET, max_chunks=max_chunks, include_metadata=True, record=False
+        )
+        return context, stats
+    return build_context(selected, max_chunks=max_chunks, include_metadata=True), None
+
+def _fit_context(r: Retrieval, allowance: int) -> Retrieval:
+    """Los primeros párrafos del contexto (van en orden de prioridad) que caben en `allowance` tokens."""
+    hits = _context_paragraphs(r)
+    # Primera estimación por párrafo (texto + encabezado); luego se verifica con el contexto armado
+    n, used = 0, 0
+    for hit in hits:
+        used += count_tokens(hit.get("text") or "") + 12
+        if used > allowance:
+            break
+        n += 1
+    context, stats = "", None
+    while n > 0:
+        selected = {**r.selected, "paragraphs": {**(r.selected.get("paragraphs") or {}), "results": hits[:n]}}
+        context, stats = _render_context(selected, n)
+        if count_tokens(context) <= allowance:
+            break
+        n -= 1
+    if n == 0:
+        selected, context = {**r.selected, "paragraphs": {**(r.selected.get("paragraphs") or {}), "results": []}}, ""
+        stats = None
+    info = {k: v for k, v in r.info.items() if k != "packing"}
+    if stats is not None:
+        info["packing"] = stats
+    return replace(r, selected=selected, context=context, no_context=not context.strip(), info=info)
+
+def govern_prompt(r: Retrieval, question: str, history_tokens: int, suffix: str = "") -> Tuple[Retrieval, Dict[str, Any]]:
+    """
+    Estima el prompt de la generación por partes antes de enviarlo y, si pasa
+    PROMPT_TOKEN_BUDGET, recorta el contexto a lo que cabe. Devuelve (retrieval, meta.tokens).
+    """
+    parts = {
+        "system": count_tokens(INSTRUCTIONS),
+        "history": history_tokens,
+        "context": 0 if r.no_context else count_tokens(r.context),
+        "question": count_tokens(_user_prompt(question, "", r.no_context) + suffix),
+    }
+    info: Dict[str, Any] = {"budget": PROMPT_TOKEN_BUDGET}
+    fixed = parts["system"] + parts["history"] + parts["question"]
+    if PROMPT_TOKEN_BUDGET > 0 and fixed + parts["context"] > PROMPT_TOKEN_BUDGET:
+        if fixed >= PROMPT_TOKEN_BUDGET:
+            # Ni sin contexto cabe: se envía igual (sin contexto) y queda registrado
+            violation("prompt_over_budget", estimated=fixed, budget=PROMPT_TOKEN_BUDGET, **parts)
+        chunks = len(_context_paragraphs(r))
+        with span("govern_prompt"):
+            r = _fit_context(r, PROMPT_TOKEN_BUDGET - fixed)
+        before, parts["context"] = parts["context"], 0 if r.no_context else count_tokens(r.context)
+        info["trimmed"] = {"chunks": chunks - len(_context_paragraphs(r)), "tokens": before - parts["context"]}
+        governor_totals["trimmed"] += 1
+        governor_totals["trimmed_tokens"] += info["trimmed"]["tokens"]
+    if "packing" in r.info:
+        record_packing(r.info["packing"])  # el contexto que se envía, una sola vez
+    info["estimated"] = parts
+    return r, info
+
+async def _retrieve(
+    question: str,
+    *,
+    size: int,
+    max_chunks: int,
+    use_semantic: bool,
+    min_score: float,
+    followup: Optional[FollowUp] = None,
+) -> Retrieval:
+    """
+    Reescritura + búsqueda + contexto (degradadas si el plazo del request no alcanza).
+    En una sesión, `followup` puede reutilizar los párrafos del turno anterior o pedir
+    solo una búsqueda incremental.
+    """
+    if followup is not None and followup.mode in ("reuse", "incremental"):
+        return await _session_retrieve(
+            followup, question, size=size, max_chunks=max_chunks, use_semantic=use_semantic, min_score=min_score
+        )
+    deadline = current_deadline()
+    # 1) Sin tiempo para reescribir: se busca con la pregunta original
+    skip_rewrite = deadline is not None and not deadline.allows("rewrite", "search", "generation")
+    # 2) Aún más justo: menos resultados y menos párrafos (búsqueda y prompt más cortos)
+    if deadline is not None and not deadline.allows("search", "generation"):
+        deadline.degrade("shrink_search")
+        size, max_chunks = max(5, size // 2), max(3, max_chunks // 2)
+
+    features = ["keyword"]
+    if use_semantic:
+        features.append("semantic")
+    # Con varias KB, las sedes se toman de la pregunta original (la reescritura puede omitirlas)
+    search_kw = dict(size=size, features=features, min_score=min_score, kbs=route_kbs(question))
+
+    consulta = question.strip()
+    rewrite_failed = False
+    if not skip_rewrite and not SPECULATIVE_SEARCH:
+        try:
+            consulta = await within(
+                "rewrite", preprocess_query_async(consulta), reserve=("search", "generation")
+            )
+        except DeadlineExceeded:
+            skip_rewrite = True
+        except Exception as e:
+            # Claude caído: la reescritura es opcional, se busca con la pregunta original
+            if not is_upstream_error(e):
+                raise
+            rewrite_failed = True
+
+    if rewrite_failed:
+        search = await within("search", nuclia_search_async(consulta, **search_kw))
+        info = {"mode": "sequential", "path": "raw_rewrite_error", "query": consulta}
+    elif skip_rewrite:
+        deadline.degrade("skip_rewrite")
+        search = await within("search", nuclia_search_async(consulta, **search_kw))
+        info = {"mode": "speculative" if SPECULATIVE_SEARCH else "sequential", "path": "raw_deadline", "query": consulta}
+    elif SPECULATIVE_SEARCH:
+        search, info = await within("search", _speculative_search(consulta, search_kw))
+    else:
+        search = await within("search", nuclia_search_async(consulta, **search_kw))
+        info = {"mode": "sequential", "path": "rewrite", "query": consulta}
+    return _with_context(search, info, question, max_chunks=max_chunks, min_score=min_score)
+
+async def _session_retrieve(
+    followup: FollowUp,
+    question: str,
+    *,
+    size: int,
+    max_chunks: int,
+    use_semantic: bool,
+    min_score: float,
+) -> Retrieval:
+    """Seguimiento en sesión: párrafos guardados tal cual o + una búsqueda solo con lo nuevo."""
+    if followup.mode == "reuse":
+        return _with_context(followup.prior, {"mode": "session", "path": "session_reuse"}, question,
+                             max_chunks=max_chunks, min_score=min_score)
+    features = ["keyword", "semantic"] if use_semantic else ["keyword"]
+    fresh = await within("search", nuclia_search_async(
+        followup.query, size=size, features=features, min_score=min_score
+    ))
+    info = {"mode": "session", "path": "session_incremental", "query": followup.query}
+    return _with_context(merge_searches(fresh, followup.prior), info, question, max_chunks=max_chunks, min_score=min_score)
+
+def _with_context(search: dict, info: Dict[str, Any], question: str, *, max_chunks: int, min_score: float) -> Retrieval:
+    retrieval_paths[info["path"]] += 1
+    if "stale" in search:
+        info["stale_search"] = search["stale"]
+    if "local" in search:
+        info["local_search"] = search["local"]
+    if "federation" in search:
+        info["federation"] = search["federation"]
+
+    # Reranker local: solo los mejores párrafos para la pregunta llegan al contexto
+    candidates = search
+    if RERANK:
+        with span("rerank"):
+            candidates, info["rerank"] = rerank(
+                search, question, info.get("query", ""), max_chunks=max_chunks, min_score=min_score
+            )
+
+    # Construir contexto
+    selected = candidates
+    with span("build_context"):
+        if CONTEXT_PACKING:
+            # Se registra en govern_prompt, ya con el contexto que se envía
+            context, used, info["packing"] = pack_context(
+                candidates,
+                token_budget=CONTEXT_TOKEN_BUDGET,
+                max_chunks=max_chunks,
+                include_metadata=True,
+                score_threshold=min_score,
+                record=False,
+            )
+            selected = {**search, "paragraphs": {**(search.get("paragraphs") or {}), "results": used}}
+        else:
+            context = build_context(
+                candidates,
+                max_chunks=max_chunks,
+                include_metadata=True,
+                score_threshold=min_score,
+            )
+
+    # Si no hay contexto útil, no devolvamos “no encuentro”; guiemos al usuario
+    no_context = not context or context.strip() == ""
+
+    return Retrieval(
+        search=search, selected=selected, context=context, no_context=no_context, info=info, max_chunks=max_chunks
+    )
+
 # ── Orquestación con detección de intención + self-check
-def ask_agent(
+async def ask_agent_async(
     question: str,
     *,
     size: int = 30,
     max_chunks: int = 20,
     use_semantic: bool = True,
-    min_score: float = 0.0
+    min_score: float = 0.0,
+    deadline: Optional[float] = None,
+    session_id: Optional[str] = None,
 ) -> dict:
+    """
+    `deadline`: presupuesto en segundos para este request (None = REQUEST_DEADLINE).
+    `session_id`: conversación multi-turno (ver app/sessions.py); None = pregunta suelta.
+    """
     if not question or not question.strip():
         return {
-            "answer": "¡Hola! ¿Qué te gustaría saber de la UVG? Puedo ayudarte con admisiones, carreras, costos, becas y más.",
+            "answer": _EMPTY_REPLY,
             "sources": [],
             "search_results": {},
         }
 
-    intent = classify_intent(question)
+    timer = ensure_timer()
+    start_deadline(deadline, paused=is_patient())  # en un lote corre desde el primer cupo
+    with span("classify_intent"):
+        routed = route_intent(question)
 
     # --- Caso 1: Saludos / small talk (no dependas de RAG) ---
-    if intent == "greeting":
+    if routed.intent == "greeting":
         return {
             "answer": smalltalk_reply(),
             "sources": [],
             "search_results": {},
         }
 
-    # --- Caso 2: Consulta UVG (o desconocida que intentamos resolver con RAG) ---
-    consulta = preprocess_query(question.strip())
-
-    features = ["keyword"]
-    if use_semantic:
-        features.append("semantic")
-
-    search = nuclia_search(
-        consulta,
-        size=size,
-        features=features,
-        min_score=min_score,
-    )
-
-    # Construir contexto
-    context = build_context(
-        search,
-        max_chunks=max_chunks,
-        include_metadata=True,
-        score_threshold=min_score,
-    )
-
-    # Si no hay contexto útil, no devolvamos “no encuentro”; guiemos al usuario
-    no_context = not context or context.strip() == ""
-
-    # Prompt usuario principal
-    user_prompt = (
-        f"Pregunta: {question}\n\n"
-        f"Contexto (fragmentos UVG):\n{context if not no_context else '(sin pasajes relevantes)'}\n\n"
-        "Si el contexto es limitado o nulo, responde igual con una guía breve y solicita datos clave "
-        "(sede, carrera, programa), sin inventar. Si aplica, sigue el esquema Markdown."
-    )
+    # --- Temas fuera de UVG: sin Nuclia ni Claude ---
+    if routed.intent == "offtopic" and OFFTOPIC_ROUTING:
+        return {
+            "answer": offtopic_reply(),
+            "sources": [],
+            "search_results": {},
+            "meta": {"intent": routed.as_dict(), "timing": timer.as_dict()},
+        }
 
-    resp = client.messages.create(
-        model=CLAUDE_MODEL,
-        max_tokens=MAX_TOKENS,
-        temperature=TEMPERATURE,
-        system=INSTRUCTIONS,
-        messages=[{"role": "user", "content": user_prompt}],
-    )
+    # --- FAQ precalculadas: respuesta curada sin Nuclia ni Claude ---
+    with span("faq"):
+        faq = faq_lookup(question)
+    if faq is not None:
+        return {
+            "answer": faq.answer,
+            "sources": faq.sources,
+            "search_results": {},
+            "meta": {"faq": faq_meta(faq), "timing": timer.as_dict()},
+        }
 
-    parts = resp.content or []
-    answer = "".join(getattr(p, "text", "") for p in parts).strip()
+    # --- Caché de respuestas (preguntas repetidas) ---
+    # Un seguimiento depende del historial de su sesión: no se lee ni se guarda en la caché
+    session = load_session(session_id)
+    key = answer_key(question, size=size, max_chunks=max_chunks, use_semantic=use_semantic, min_score=min_score)
+    if session is not None and session.turns:
+        key = None
+    if answer_cache is not None and key is not None:
+        with span("answer_cache"):
+            cached = answer_cache.get(key)
+        if cached is not None:
+            meta = {**cached.get("meta", {}), "cached": True, "timing": timer.as_dict()}
+            if session is not None:
+                # Primer turno servido de la caché: la sesión arranca con sus párrafos
+                followup = plan_followup(session, question)
+                save_turn(session, question, cached.get("answer", ""), followup,
+                          search=cached.get("search_results") or {}, max_chunks=max_chunks)
+                meta["session"] = _session_meta(session, followup, 0, 0)
+            return {**cached, "meta": meta}
 
-    # Self-check: si parece respuesta informativa pero no trae secciones, reformatea
-    def _needs_fix(txt: str) -> bool:
-        if not txt:
-            return False
-        # Si contiene bullets y bloques, bien; si no, intenta estructurar
-        headers = ["# Respuesta", "## Detalles", "## Siguientes pasos"]
-        return any(kw in question.lower() for kw in ["requisito", "costo", "beca", "calendario", "plan", "malla", "proceso"]) and not all(h in txt for h in headers)
-
-    if _needs_fix(answer):
-        fix_prompt = (
-            "Reestructura estrictamente en el siguiente esquema Markdown, sin texto fuera del esquema:\n\n"
-            "# Respuesta\n(1–3 líneas)\n\n"
-            "## Detalles\n- puntos clave\n\n"
-            "## Siguientes pasos\n1) …\n\n"
-            "## Fuentes consultadas\n- Título (URL o ID)\n\n"
-            f"=== TEXTO ===\n{answer}"
+    # --- Caso 2: Consulta UVG (o desconocida que intentamos resolver con RAG) ---
+    # Solo este camino llega a Claude: pide cupo de generación (o se rechaza con 503)
+    try:
+        async with admission():
+            return await _rag_answer(
+                question,
+                key,
+                routed,
+                size=size,
+                max_chunks=max_chunks,
+                use_semantic=use_semantic,
+                min_score=min_score,
+                session=session,
+            )
+    except Exception as e:
+        # Nuclia/Claude caídos (tras reintentos) o circuito abierto: la última respuesta buena
+        stale = (
+            answer_cache.get_stale(key)
+            if answer_cache is not None and key is not None and is_upstream_error(e) else None
         )
-        fix = client.messages.create(
-            model=CLAUDE_MODEL,
-            max_tokens=min(600, MAX_TOKENS),
-            temperature=0.0,
-            system="Eres un reformateador estricto de Markdown.",
-            messages=[{"role": "user", "content": fix_prompt}],
+        if stale is None:
+            raise
+        stale_totals["answer"] += 1
+        return {**stale, "meta": {
+            **stale.get("meta", {}),
+            "cached": True,
+            "stale": {"reason": type(e).__name__},
+            "timing": timer.as_dict(),
+        }}
+
+def _session_meta(session: Session, followup: FollowUp, history_turns: int, history_tokens: int) -> Dict[str, Any]:
+    return {
+        "id": session.id,
+        "turn": len(session.turns) + 1,
+        **followup.as_dict(),
+        "history_turns": history_turns,
+        "history_tokens": history_tokens,
+    }
+
+async def _rag_answer(
+    question: str,
+    key: Optional[str],
+    routed: IntentResult,
+    *,
+    size: int,
+    max_chunks: int,
+    use_semantic: bool,
+    min_score: float,
+    session: Optional[Session] = None,
+) -> dict:
+    """`key` None = no se guarda en la caché (seguimientos de una sesión)."""
+    timer = ensure_timer()
+    deadline = current_deadline()
+    followup = plan_followup(session, question) if session is not None else None
+    try:
+        r = await _retrieve(
+            question,
+            size=size,
+            max_chunks=max_chunks,
+            use_semantic=use_semantic,
+            min_score=min_score,
+            followup=followup,
         )
-        answer2 = "".join(getattr(p, "text", "") for p in (fix.content or [])).strip()
-        if answer2:
-            answer = answer2
+    except DeadlineExceeded:
+        # Nuclia no respondió dentro del plazo: no hay fuentes que ofrecer
+        deadline.degrade("fallback_answer")
+        return {
+            "answer": _fallback_answer([]),
+            "sources": [],
+            "search_results": {},
+            "meta": {"intent": routed.as_dict(), "deadline": deadline.as_dict(), "timing": timer.as_dict()},
+        }
 
-    # Fuentes para el frontend
-    sources_info = extract_sources_info(search, max_chunks=max_chunks, score_threshold=min_score)
+    # Presupuesto del prompt: el contexto se recorta antes de elegir fuentes y modelo
+    history, history_tokens = history_messages(session)
+    r, tokens = govern_prompt(r, question, history_tokens)
+
+    # Fuentes para el frontend (los mismos párrafos que entraron al contexto)
+    with span("extract_sources"):
+        sources_info = extract_sources_info(r.selected, max_chunks=r.max_chunks, score_threshold=min_score)
+
+    # 4) Sin tiempo para generar (o la generación no terminó) o sin cuota: solo las fuentes
+    answer = None
+    choice = choose_tier(question, routed.intent, _context_paragraphs(r), _wants_structure(question))
+    in_time = deadline is None or deadline.allows("generation")
+    over_quota = in_time and not allow("generation")
+    if in_time and not over_quota:
+        try:
+            async with gate("llm"):
+                with span("generation", upstream="anthropic"):
+                    resp = await within("generation", create_message(
+                        choice,
+                        temperature=TEMPERATURE,
+                        system=system_prompt(INSTRUCTIONS, choice.tier.model),
+                        messages=history + [
+                            {"role": "user", "content": _user_content(question, r.context, r.no_context)}
+                        ],
+                    ))
+            answer = _text_of(resp)
+            tokens["prompt"] = attribute(tokens["estimated"], getattr(resp, "usage", None))
+        except DeadlineExceeded:
+            pass
+    if answer is None:
+        if over_quota:
+            tokens["quota"] = "exceeded"
+        else:
+            deadline.degrade("fallback_answer")
+        answer, format_path = _fallback_answer(sources_info), "fallback"
+    else:
+        format_path = "ok"
+
+    if format_path == "ok" and _needs_fix(question, answer):
+        # Primero el reestructurador local; el LLM solo si no logra una estructura válida
+        with span("reformat_local"):
+            local = restructure(answer, sources_info) if FIX_ENGINE == "local" else None
+        if local:
+            answer, format_path = local, "local"
+        elif deadline is not None and not deadline.allows("reformat"):
+            # 3) Sin tiempo para la segunda pasada: se entrega tal cual
+            deadline.degrade("skip_reformat")
+            format_path = "skipped"
+        elif not allow("reformat"):
+            # Sin cuota para una segunda llamada: se entrega tal cual
+            format_path = "skipped"
+        else:
+            format_path = "llm"
+            llm = get_async_llm()
+            try:
+                async with gate("llm"):
+                    with span("reformat_llm", upstream="anthropic"):
+                        fix = await within("reformat", resilient("anthropic", lambda: llm.messages.create(
+                            model=CLAUDE_MODEL,
+                            max_tokens=output_cap(min(600, MAX_TOKENS)),
+                            temperature=0.0,
+                            **_fix_request(answer, r.context, r.no_context),
+                        )))
+                record_usage("reformat", getattr(fix, "usage", None))
+                answer2 = _text_of(fix)
+                if answer2:
+                    answer = answer2
+            except DeadlineExceeded:
+                deadline.degrade("skip_reformat")
+                format_path = "skipped"
+            except Exception as e:
+                # La respuesta ya existe: si Claude falla en el reformateo se entrega tal cual
+                if not is_upstream_error(e):
+                    raise
+                format_path = "reformat_error"
+    format_paths[format_path] += 1
 
     # Si no hubo contexto y la respuesta sigue siendo pobre, ofrece guía UVG
-    if no_context and (not answer or len(answer) < 20):
-        answer = (
-            "Puedo ayudarte con información de la UVG aunque no encontré pasajes relevantes ahora mismo.\n\n"
-            "**Dime:** sede (Altiplano, Central, Sur) y programa/carrera que te interesa.\n\n"
-            "**Temas comunes:** admisiones, requisitos, costos/becas, calendario, laboratorios, servicios del campus."
-        )
-
-    return {
+    if r.no_context and (not answer or len(answer) < 20):
+        answer = _NO_CONTEXT_REPLY
+
+    meta: Dict[str, Any] = {"intent": routed.as_dict(), "retrieval": r.info, "format": format_path, "tokens": tokens}
+    if format_path != "fallback":
+        meta["model"] = choice.as_dict()
+    if deadline is not None:
+        meta["deadline"] = deadline.as_dict()
+    result = {
         "answer": answer,
         "sources": sources_info,
-        "search_results": search,
+        "search_results": r.search,
+        "meta": meta,
     }
+    # Sin contexto puede ser un fallo transitorio de la KB, y una respuesta degradada
+    # (por plazo o por una búsqueda incompleta) no debe quedarse en caché
+    degraded = bool(deadline and deadline.applied) or degraded_search(r.info) or over_quota
+    if answer_cache is not None and key is not None and not r.no_context and not degraded:
+        answer_cache.set(key, result)
+    extra: Dict[str, Any] = {"timing": timer.as_dict(), "usage": timer.usage_dict()}
+    if session is not None:
+        extra["session"] = _session_meta(session, followup, len(history) // 2, history_tokens)
+        if format_path != "fallback":
+            save_turn(session, question, answer, followup, search=r.selected,
+                      query=r.info.get("query", ""), max_chunks=r.max_chunks)
+    return {**result, "meta": {**result["meta"], **extra}}
+
+def ask_agent(
+    question: str,
+    *,
+    size: int = 30,
+    max_chunks: int = 20,
+    use_semantic: bool = True,
+    min_score: float = 0.0,
+    deadline: Optional[float] = None,
+    session_id: Optional[str] = None,
+) -> dict:
+    """Versión síncrona de `ask_agent_async` (para scripts y callers existentes)."""
+    return run_sync(ask_agent_async(
+        question,
+        size=size,
+        max_chunks=max_chunks,
+        use_semantic=use_semantic,
+        min_score=min_score,
+        deadline=deadline,
+        session_id=session_id,
+    ))
 
 def extract_sources_info(
     search_json: dict,
@@ -203,9 +743,11 @@ def extract_sources_info(
                         url = file_data.get("uri", "")
                         break
 
+        from .config import NUCLIA_API_BASE, KB
+        # Con búsqueda federada cada hit trae el id de su KB (también para /resources/{rid}/file?kb=)
+        kb = hit.get("kb") or resource_info.get("kb") or KB
         if not url and resource_id:
-            from .config import NUCLIA_API_BASE, KB
-            url = f"{NUCLIA_API_BASE}/kb/{KB}/resource/{resource_id}"
+            url = f"{NUCLIA_API_BASE}/kb/{kb}/resource/{resource_id}"
 
         position = hit.get("position", {}) or {}
         page_num = position.get("page_number")
@@ -225,6 +767,7 @@ def extract_sources_info(
             "page": page_num,
             "field": field,
             "resource_id": resource_id,
+            "kb": kb,
             "url": url,
             "url_type": url_type,
             "has_url": bool(url),
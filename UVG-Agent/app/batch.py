@@ -0,0 +1,69 @@
+# app/batch.py
+from __future__ import annotations
+import asyncio
+from collections import Counter
+from typing import Any, AsyncIterator, Dict, List, Tuple
+
+from .agent import ask_agent_async
+from .cache import answer_key
+from .admission import patient_slot, reset_patient, use_patient
+from .limits import Limits, reset_limits, use_limits
+from .metrics import start_timer
+from .config import BATCH_SEARCH_CONCURRENCY, BATCH_LLM_CONCURRENCY, BATCH_LLM_RPM
+
+# ── Lotes de preguntas (/ask/batch)
+# Preguntas idénticas (misma clave de caché) se resuelven una sola vez; las búsquedas
+# en Nuclia y las llamadas a Claude tienen topes de concurrencia separados, y cada
+# resultado se entrega en cuanto termina, sin esperar a los lentos.
+
+batch_totals: Counter = Counter()
+
+async def _run(params: Dict[str, Any]) -> dict:
+    start_timer()  # cada ítem con sus propios tiempos en meta.timing
+    return await ask_agent_async(**params)
+
+async def ask_batch(items: List[Dict[str, Any]]) -> AsyncIterator[Tuple[List[int], Any]]:
+    """
+    Recibe kwargs de `ask_agent_async` y entrega (índices, resultado) a medida que
+    terminan; si un ítem falla, el resultado es la excepción.
+    """
+    groups: Dict[str, List[int]] = {}
+    unique: List[Tuple[str, Dict[str, Any]]] = []
+    for i, params in enumerate(items):
+        key = answer_key(**{k: v for k, v in params.items() if k != "deadline"})
+        if key not in groups:
+            groups[key] = []
+            unique.append((key, params))
+        groups[key].append(i)
+    batch_totals["batches"] += 1
+    batch_totals["items"] += len(items)
+    batch_totals["unique"] += len(unique)
+
+    limits = Limits(
+        {"search": BATCH_SEARCH_CONCURRENCY, "llm": BATCH_LLM_CONCURRENCY},
+        per_minute={"llm": BATCH_LLM_RPM},
+        hold={"llm": patient_slot},
+    )
+    # Las tareas copian el contexto al crearse: todas heredan los límites del lote y
+    # piden el cupo de admisión (de baja prioridad) solo mientras llaman a Claude
+    token, patient = use_limits(limits), use_patient(True)
+    try:
+        loop = asyncio.get_running_loop()
+        pending = {loop.create_task(_run(params)): key for key, params in unique}
+    finally:
+        reset_patient(patient)
+        reset_limits(token)
+
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                key = pending.pop(task)
+                exc = task.exception()
+                if exc is not None:
+                    batch_totals["errors"] += 1
+                yield groups[key], exc if exc is not None else task.result()
+    finally:
+        # El cliente se desconectó o el lote se canceló: no seguir gastando en Nuclia/Claude
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,307 @@
+# app/cache.py
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from .config import (
+    KB,
+    ANSWER_CACHE_BACKEND,
+    ANSWER_CACHE_TTL,
+    ANSWER_CACHE_MAX_ENTRIES,
+    ANSWER_CACHE_PATH,
+    SEARCH_CACHE_TTL,
+    SEARCH_CACHE_STALE,
+    SEARCH_CACHE_MAX_ENTRIES,
+    STALE_IF_ERROR,
+)
+from .text import normalize_question
+
+# ── Contadores comunes a todos los backends
+class CacheStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.evictions = 0
+        self.stale = 0
+        self.stale_if_error = 0
+
+    def incr(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def as_dict(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "sets": self.sets,
+            "evictions": self.evictions,
+            "stale": self.stale,
+            "stale_if_error": self.stale_if_error,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+# ── Backend en memoria: LRU acotado + TTL (por proceso)
+class MemoryCache:
+    backend = "memory"
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600, grace: float = 0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # Lo vencido se conserva `grace` segundos más para get_stale (stale-if-error)
+        self.grace = grace
+        self.stats = CacheStats()
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] < now:
+                if item[0] + self.grace < now:
+                    del self._data[key]
+                item = None
+            if item is None:
+                self.stats.incr("misses")
+                return None
+            self._data.move_to_end(key)
+        self.stats.incr("hits")
+        return item[1]
+
+    def get_stale(self, key: str) -> Optional[Any]:
+        """Último valor guardado aunque esté vencido (dentro de la ventana `grace`)."""
+        with self._lock:
+            item = self._data.get(key)
+        if item is None or item[0] + self.grace < time.time():
+            return None
+        self.stats.incr("stale_if_error")
+        return item[1]
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        evicted = 0
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                evicted += 1
+        self.stats.incr("sets")
+        if evicted:
+            self.stats.incr("evictions", evicted)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> int:
+        with self._lock:
+            n = len(self._data)
+            self._data.clear()
+        return n
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+# ── Backend SQLite: compartido entre workers de uvicorn en la misma máquina
+class SQLiteCache:
+    backend = "sqlite"
+
+    def __init__(self, path: str, max_entries: int = 1000, ttl: float = 3600, grace: float = 0):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.grace = grace
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " expires REAL NOT NULL, used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS cache_used ON cache(used)")
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[1] < now:
+                if row[1] + self.grace < now:
+                    self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+                row = None
+            if row is not None:
+                self._db.execute("UPDATE cache SET used = ? WHERE key = ?", (now, key))
+        if row is None:
+            self.stats.incr("misses")
+            return None
+        self.stats.incr("hits")
+        return json.loads(row[0])
+
+    def get_stale(self, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM cache WHERE key = ? AND expires >= ?", (key, time.time() - self.grace)
+            ).fetchone()
+        if row is None:
+            return None
+        self.stats.incr("stale_if_error")
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        now = time.time()
+        expires = now + (self.ttl if ttl is None else ttl)
+        payload = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires, used) VALUES (?, ?, ?, ?)",
+                (key, payload, expires, now),
+            )
+            self._db.execute("DELETE FROM cache WHERE expires < ?", (now - self.grace,))
+            cur = self._db.execute(
+                "DELETE FROM cache WHERE key IN ("
+                " SELECT key FROM cache ORDER BY used ASC"
+                " LIMIT max(0, (SELECT COUNT(*) FROM cache) - ?))",
+                (self.max_entries,),
+            )
+            evicted = cur.rowcount or 0
+        self.stats.incr("sets")
+        if evicted > 0:
+            self.stats.incr("evictions", evicted)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self) -> int:
+        with self._lock:
+            cur = self._db.execute("DELETE FROM cache")
+        return cur.rowcount or 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+def make_cache(backend: str, *, path: str, max_entries: int, ttl: float, grace: float = 0):
+    """Crea el backend configurado ('memory' | 'sqlite' | 'off')."""
+    backend = (backend or "memory").lower()
+    if backend in ("off", "none", "disabled"):
+        return None
+    if backend in ("sqlite", "disk"):
+        return SQLiteCache(path, max_entries=max_entries, ttl=ttl, grace=grace)
+    return MemoryCache(max_entries=max_entries, ttl=ttl, grace=grace)
+
+# ── Single-flight: colapsa llamadas idénticas concurrentes en una sola
+class SingleFlight:
+    """
+    La primera llamada con una clave lanza `fn()` como tarea; las que llegan mientras
+    sigue en vuelo esperan esa misma tarea y reciben su resultado (o su excepción).
+    La tarea es independiente de quien la lanzó: si ese request se cancela, los demás
+    siguen esperando el resultado.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[tuple, asyncio.Task] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def _key(self, key: Hashable) -> tuple:
+        # Las tareas de asyncio solo pueden esperarse desde su propio loop
+        return (id(asyncio.get_running_loop()), key)
+
+    def inflight(self, key: Hashable) -> bool:
+        return self._key(key) in self._inflight
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        k = self._key(key)
+        task = self._inflight.get(k)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(fn())
+            self._inflight[k] = task
+            task.add_done_callback(lambda t, k=k: self._done(k, t))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _done(self, k: tuple, task: asyncio.Task) -> None:
+        if self._inflight.get(k) is task:
+            del self._inflight[k]
+        # Evita "Task exception was never retrieved" si todos los que esperaban se fueron
+        if not task.cancelled():
+            task.exception()
+
+    def as_dict(self) -> Dict[str, int]:
+        return {"leaders": self.leaders, "coalesced": self.coalesced, "inflight": len(self._inflight)}
+
+# ── Caché de búsquedas Nuclia: la entrada vive TTL + ventana stale
+search_cache = (
+    MemoryCache(max_entries=SEARCH_CACHE_MAX_ENTRIES, ttl=SEARCH_CACHE_TTL + SEARCH_CACHE_STALE, grace=STALE_IF_ERROR)
+    if SEARCH_CACHE_TTL > 0 else None
+)
+search_flight = SingleFlight()
+
+def search_cache_stats() -> Dict[str, Any]:
+    stats: Dict[str, Any] = {"backend": "off"}
+    if search_cache is not None:
+        stats = {
+            "backend": search_cache.backend,
+            "entries": len(search_cache),
+            "max_entries": search_cache.max_entries,
+            "ttl": SEARCH_CACHE_TTL,
+            "stale_window": SEARCH_CACHE_STALE,
+            **search_cache.stats.as_dict(),
+        }
+    return {**stats, "single_flight": search_flight.as_dict()}
+
+# ── Caché de respuestas de ask_agent
+answer_cache = make_cache(
+    ANSWER_CACHE_BACKEND,
+    path=ANSWER_CACHE_PATH,
+    max_entries=ANSWER_CACHE_MAX_ENTRIES,
+    ttl=ANSWER_CACHE_TTL,
+    grace=STALE_IF_ERROR,
+)
+
+def answer_key(
+    question: str,
+    *,
+    size: int,
+    max_chunks: int,
+    use_semantic: bool,
+    min_score: float
+) -> str:
+    """Clave estable: pregunta normalizada + parámetros de búsqueda + KB."""
+    raw = json.dumps(
+        [KB, normalize_question(question), size, max_chunks, bool(use_semantic), float(min_score or 0.0)],
+        ensure_ascii=False,
+    )
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def invalidate_answers() -> int:
+    """Vacía la caché de respuestas (p.ej. tras actualizar la KB). Devuelve las entradas borradas."""
+    return answer_cache.clear() if answer_cache is not None else 0
+
+def invalidate_searches() -> int:
+    return search_cache.clear() if search_cache is not None else 0
+
+def answer_cache_stats() -> Dict[str, Any]:
+    if answer_cache is None:
+        return {"backend": "off"}
+    return {
+        "backend": answer_cache.backend,
+        "entries": len(answer_cache),
+        "max_entries": answer_cache.max_entries,
+        "ttl": answer_cache.ttl,
+        **answer_cache.stats.as_dict(),
+    }
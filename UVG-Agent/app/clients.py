@@ -1,5 +1,110 @@
-from anthropic import Anthropic
-from .config import ANTHROPIC_KEY
+import asyncio
+import threading
+import weakref
+from typing import Any, Coroutine, TypeVar
+
+import httpx
+from anthropic import Anthropic, AsyncAnthropic
+from .config import (
+    ANTHROPIC_KEY,
+    ANTHROPIC_BASE_URL,
+    HEADERS,
+    NUCLIA_TIMEOUT,
+    NUCLIA_CONNECT_TIMEOUT,
+    NUCLIA_HTTP2,
+    NUCLIA_MAX_CONNECTIONS,
+    NUCLIA_MAX_KEEPALIVE,
+)
+
+T = TypeVar("T")
 
 # ── Cliente Anthropic
-client = Anthropic(api_key=ANTHROPIC_KEY)
+# Sin reintentos del SDK: los hace app/resilience.py (backoff + circuit breaker)
+client = Anthropic(api_key=ANTHROPIC_KEY, base_url=ANTHROPIC_BASE_URL or None, max_retries=0)
+
+# ── Clientes async compartidos
+# httpx.AsyncClient y AsyncAnthropic quedan atados al event loop donde abren sus
+# conexiones, así que se guarda una instancia por loop: la del loop de uvicorn
+# (abierta/cerrada en el lifespan) y la del loop de fondo de la API síncrona.
+_http_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+_llm_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncAnthropic]" = weakref.WeakKeyDictionary()
+
+def _http2_available() -> bool:
+    if not NUCLIA_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401  (extra httpx[http2])
+        return True
+    except Exception:
+        return False
+
+def _new_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        headers=HEADERS,
+        http2=_http2_available(),
+        timeout=httpx.Timeout(NUCLIA_TIMEOUT, connect=NUCLIA_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=NUCLIA_MAX_CONNECTIONS,
+            max_keepalive_connections=NUCLIA_MAX_KEEPALIVE,
+        ),
+    )
+
+def get_http_client() -> httpx.AsyncClient:
+    """Cliente httpx (pool keep-alive) hacia Nuclia para el loop actual."""
+    loop = asyncio.get_running_loop()
+    http = _http_clients.get(loop)
+    if http is None or http.is_closed:
+        http = _http_clients[loop] = _new_http_client()
+    return http
+
+def get_async_llm() -> AsyncAnthropic:
+    """Cliente AsyncAnthropic para el loop actual."""
+    loop = asyncio.get_running_loop()
+    llm = _llm_clients.get(loop)
+    if llm is None:
+        llm = _llm_clients[loop] = AsyncAnthropic(
+            api_key=ANTHROPIC_KEY, base_url=ANTHROPIC_BASE_URL or None, max_retries=0
+        )
+    return llm
+
+async def open_clients() -> None:
+    """Abre los clientes del loop actual (se llama desde el lifespan de FastAPI)."""
+    get_http_client()
+    get_async_llm()
+
+async def close_clients() -> None:
+    """Cierra los clientes del loop actual y libera sus conexiones."""
+    loop = asyncio.get_running_loop()
+    http = _http_clients.pop(loop, None)
+    if http is not None:
+        await http.aclose()
+    llm = _llm_clients.pop(loop, None)
+    if llm is not None:
+        await llm.close()
+
+# ── Puente síncrono
+# La API síncrona (ask_agent, nuclia_search, preprocess_query) corre las versiones
+# async en un único loop de fondo, para que también reutilice conexiones.
+_bg_loop: "asyncio.AbstractEventLoop | None" = None
+_bg_lock = threading.Lock()
+
+def _background_loop() -> asyncio.AbstractEventLoop:
+    global _bg_loop
+    with _bg_lock:
+        if _bg_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="uvg-sync-bridge", daemon=True).start()
+            _bg_loop = loop
+    return _bg_loop
+
+def run_sync(coro: Coroutine[Any, Any, T]) -> T:
+    """Ejecuta una corrutina desde código síncrono y devuelve su resultado."""
+    loop = _background_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        coro.close()
+        raise RuntimeError("run_sync() no puede llamarse desde el loop de fondo; usa la versión async")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
@@ -13,6 +13,12 @@ except Exception:
 def _clean(s: Optional[str]) -> str:
     return (s or "").strip().strip('"').strip("'")
 
+def _flag(name: str, default: bool) -> bool:
+    raw = _clean(os.getenv(name)).lower()
+    if not raw:
+        return default
+    return raw in ("1", "true", "yes", "on")
+
 # ---------------- System Prompt por defecto (UVG) ----------------
 DEFAULT_INSTRUCTIONS = """
 Eres “Jack”, asistente especializado en la Universidad del Valle de Guatemala (UVG).
@@ -60,9 +66,23 @@ class Settings:
     KB: str = _clean(os.getenv("KB"))
     NUCLIA_TOKEN: str = _clean(os.getenv("NUCLIA_TOKEN"))
 
+    # === Búsqueda federada: JSON con varias KB (peso, filtros, sede, token); vacío = solo KB
+    KBS_PATH: str = _clean(os.getenv("KBS_PATH"))
+    KB_TIMEOUT: float = float(os.getenv("KB_TIMEOUT") or 8)     # s por KB; la que tarda más se omite
+    KB_ROUTING: bool = _flag("KB_ROUTING", True)                  # solo las KB de la sede nombrada
+    RRF_K: int = int(os.getenv("RRF_K") or 60)
+
+    # === Pool HTTP compartido hacia Nuclia (keep-alive + HTTP/2)
+    NUCLIA_TIMEOUT: float = float(os.getenv("NUCLIA_TIMEOUT") or 30)
+    NUCLIA_CONNECT_TIMEOUT: float = float(os.getenv("NUCLIA_CONNECT_TIMEOUT") or 10)
+    NUCLIA_HTTP2: bool = _flag("NUCLIA_HTTP2", True)
+    NUCLIA_MAX_CONNECTIONS: int = int(os.getenv("NUCLIA_MAX_CONNECTIONS") or 100)
+    NUCLIA_MAX_KEEPALIVE: int = int(os.getenv("NUCLIA_MAX_KEEPALIVE") or 20)
+
     # === Anthropic (LLM)
     ANTHROPIC_KEY: str = _clean(os.getenv("ANTHROPIC_KEY"))
     CLAUDE_MODEL: str = _clean(os.getenv("CLAUDE_MODEL") or "claude-3-5-sonnet-latest")
+    ANTHROPIC_BASE_URL: str = _clean(os.getenv("ANTHROPIC_BASE_URL"))  # vacío = API oficial
 
     # === Frontends permitidos (CORS)
     FRONT_ORIGIN: str = _clean(os.getenv("FRONT_ORIGIN") or "http://localhost:5173,http://127.0.0.1:5173")
@@ -74,6 +94,129 @@ class Settings:
     MAX_TOKENS: int = int(os.getenv("MAX_TOKENS") or 900)
     TEMPERATURE: float = float(os.getenv("TEMPERATURE") or 0.2)
 
+    # === Router de modelos: tier rápido para preguntas simples, completo (CLAUDE_MODEL) para el resto
+    MODEL_ROUTING: bool = _flag("MODEL_ROUTING", True)
+    FAST_MODEL: str = _clean(os.getenv("FAST_MODEL") or "claude-3-5-haiku-latest")
+    FAST_MAX_TOKENS: int = int(os.getenv("FAST_MAX_TOKENS") or 500)
+    FAST_MAX_WORDS: int = int(os.getenv("FAST_MAX_WORDS") or 12)          # pregunta más larga = completo
+    FAST_MIN_SCORE: float = float(os.getenv("FAST_MIN_SCORE") or 0.5)     # párrafo "fuerte" desde este score
+    FAST_MAX_PARAGRAPHS: int = int(os.getenv("FAST_MAX_PARAGRAPHS") or 6)  # más fuertes = hay que sintetizar
+    MODEL_FALLBACK: bool = _flag("MODEL_FALLBACK", True)                  # overloaded -> el otro tier
+
+    # === Prompt caching de Anthropic (cache_control): system prompt y, opcional, el bloque de contexto
+    PROMPT_CACHE: bool = _flag("PROMPT_CACHE", True)
+    PROMPT_CACHE_CONTEXT: bool = _flag("PROMPT_CACHE_CONTEXT", False)
+
+    # === Motor de reescritura de consultas: llm | local (Claude solo si la local es poco confiable)
+    QUERY_REWRITER: str = _clean(os.getenv("QUERY_REWRITER") or "llm").lower()
+    REWRITE_MIN_CONFIDENCE: float = float(os.getenv("REWRITE_MIN_CONFIDENCE") or 0.5)
+
+    # === Búsqueda especulativa: Nuclia con la pregunta original en paralelo a la reescritura
+    SPECULATIVE_SEARCH: bool = _flag("SPECULATIVE_SEARCH", False)
+    REWRITE_DEADLINE: float = float(os.getenv("REWRITE_DEADLINE") or 1.5)
+
+    # === Empaquetado de contexto: presupuesto de tokens + deduplicación
+    CONTEXT_PACKING: bool = _flag("CONTEXT_PACKING", False)
+    CONTEXT_TOKEN_BUDGET: int = int(os.getenv("CONTEXT_TOKEN_BUDGET") or 3000)
+
+    # === Gobierno de tokens: presupuesto del prompt/salida por llamada y cuotas diarias (0 = sin límite)
+    PROMPT_TOKEN_BUDGET: int = int(os.getenv("PROMPT_TOKEN_BUDGET") or 6000)    # input estimado de la generación
+    OUTPUT_TOKEN_BUDGET: int = int(os.getenv("OUTPUT_TOKEN_BUDGET") or 0)       # tope de max_tokens por llamada
+    DAILY_TOKEN_QUOTA: int = int(os.getenv("DAILY_TOKEN_QUOTA") or 0)           # tokens por día, todo el proceso
+    DAILY_TOKEN_RESERVE: float = float(os.getenv("DAILY_TOKEN_RESERVE") or 0.1)  # parte de la cuota solo para generar
+    CLIENT_DAILY_TOKENS: int = int(os.getenv("CLIENT_DAILY_TOKENS") or 0)       # tokens por día por cliente
+
+    # === Reranker léxico local: menos párrafos (y mejores) al prompt
+    RERANK: bool = _flag("RERANK", True)
+    RERANK_TOP_K: int = int(os.getenv("RERANK_TOP_K") or 8)          # párrafos máximos tras el rerank
+    RERANK_CUTOFF: float = float(os.getenv("RERANK_CUTOFF") or 0.35)  # fracción del mejor score
+    RERANK_MIN_KEEP: int = int(os.getenv("RERANK_MIN_KEEP") or 3)
+
+    # === Reformateo al esquema Markdown: local (LLM solo si falla) | llm
+    FIX_ENGINE: str = _clean(os.getenv("FIX_ENGINE") or "local").lower()
+
+    # === Router de intenciones: JSON opcional {"grupo": [palabras]} y desvío de temas fuera de UVG
+    INTENT_KEYWORDS_PATH: str = _clean(os.getenv("INTENT_KEYWORDS_PATH"))
+    OFFTOPIC_ROUTING: bool = _flag("OFFTOPIC_ROUTING", True)
+
+    # === FAQ precalculadas (camino rápido antes del RAG); el archivo se recarga al cambiar
+    FAQ_INDEX_PATH: str = _clean(os.getenv("FAQ_INDEX_PATH") or "faq_index.json")
+    FAQ_MIN_SCORE: float = float(os.getenv("FAQ_MIN_SCORE") or 0.7)
+    FAQ_RELOAD_INTERVAL: float = float(os.getenv("FAQ_RELOAD_INTERVAL") or 5)
+
+    # === Caché de respuestas (memory | sqlite | off)
+    ANSWER_CACHE_BACKEND: str = _clean(os.getenv("ANSWER_CACHE_BACKEND") or "memory")
+    ANSWER_CACHE_TTL: float = float(os.getenv("ANSWER_CACHE_TTL") or 3600)
+    ANSWER_CACHE_MAX_ENTRIES: int = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES") or 1000)
+    ANSWER_CACHE_PATH: str = _clean(os.getenv("ANSWER_CACHE_PATH") or "answer_cache.sqlite3")
+
+    # === Sesiones multi-turno (memory | sqlite | off): reutilizan los párrafos del turno anterior
+    SESSION_BACKEND: str = _clean(os.getenv("SESSION_BACKEND") or "memory")
+    SESSION_PATH: str = _clean(os.getenv("SESSION_PATH") or "sessions.sqlite3")
+    SESSION_TTL: float = float(os.getenv("SESSION_TTL") or 1800)           # s de inactividad
+    SESSION_MAX_ENTRIES: int = int(os.getenv("SESSION_MAX_ENTRIES") or 5000)
+    SESSION_MAX_TURNS: int = int(os.getenv("SESSION_MAX_TURNS") or 10)      # turnos guardados por sesión
+    SESSION_HISTORY_TOKENS: int = int(os.getenv("SESSION_HISTORY_TOKENS") or 800)  # historial en el prompt
+    SESSION_REUSE_DECAY: float = float(os.getenv("SESSION_REUSE_DECAY") or 0.85)   # score de lo reutilizado
+
+    # === Caché de búsquedas Nuclia (TTL fresco + ventana stale-while-revalidate)
+    SEARCH_CACHE_TTL: float = float(os.getenv("SEARCH_CACHE_TTL") or 300)
+    SEARCH_CACHE_STALE: float = float(os.getenv("SEARCH_CACHE_STALE") or 600)
+    SEARCH_CACHE_MAX_ENTRIES: int = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES") or 500)
+
+    # === Índice local BM25 espejo de la KB (off | fallback | parallel | primary); se recarga al cambiar
+    LOCAL_INDEX_PATH: str = _clean(os.getenv("LOCAL_INDEX_PATH") or "local_index.bin")
+    LOCAL_SEARCH_MODE: str = _clean(os.getenv("LOCAL_SEARCH_MODE") or "fallback").lower()
+    LOCAL_INDEX_RELOAD_INTERVAL: float = float(os.getenv("LOCAL_INDEX_RELOAD_INTERVAL") or 30)
+
+    # === Proxy de archivos originales (/resources/{rid}/file) + caché en disco LRU
+    RESOURCE_TIMEOUT: float = float(os.getenv("RESOURCE_TIMEOUT") or 60)
+    RESOURCE_CACHE_DIR: str = _clean(os.getenv("RESOURCE_CACHE_DIR") or "resource_cache")
+    RESOURCE_CACHE_MAX_MB: float = float(os.getenv("RESOURCE_CACHE_MAX_MB") or 500)
+    RESOURCE_CACHE_MAX_FILE_MB: float = float(os.getenv("RESOURCE_CACHE_MAX_FILE_MB") or 50)
+    RESOURCE_CACHE_TTL: float = float(os.getenv("RESOURCE_CACHE_TTL") or 86400)
+
+    # === /ask/batch: tamaño máximo y límites separados para Nuclia y Claude
+    BATCH_MAX_ITEMS: int = int(os.getenv("BATCH_MAX_ITEMS") or 200)
+    BATCH_SEARCH_CONCURRENCY: int = int(os.getenv("BATCH_SEARCH_CONCURRENCY") or 8)
+    BATCH_LLM_CONCURRENCY: int = int(os.getenv("BATCH_LLM_CONCURRENCY") or 4)
+    BATCH_LLM_RPM: float = float(os.getenv("BATCH_LLM_RPM") or 0)  # 0 = sin tope por minuto
+
+    # === Presupuesto de latencia por request (s); al acercarse se degradan etapas. 0 = sin plazo
+    REQUEST_DEADLINE: float = float(os.getenv("REQUEST_DEADLINE") or 25)
+
+    # === Resiliencia hacia Nuclia y Anthropic: reintentos con backoff + circuit breaker
+    RETRY_ATTEMPTS: int = int(os.getenv("RETRY_ATTEMPTS") or 3)          # intentos totales por llamada
+    RETRY_BASE_DELAY: float = float(os.getenv("RETRY_BASE_DELAY") or 0.25)
+    RETRY_MAX_DELAY: float = float(os.getenv("RETRY_MAX_DELAY") or 2)
+    BREAKER_FAILURES: int = int(os.getenv("BREAKER_FAILURES") or 5)      # 0 = sin breaker
+    BREAKER_RESET: float = float(os.getenv("BREAKER_RESET") or 30)
+    STALE_IF_ERROR: float = float(os.getenv("STALE_IF_ERROR") or 86400)  # s que se guarda lo vencido
+
+    # === Control de admisión: cupos de generación con Claude + cola acotada con plazo (0 = sin límite)
+    ADMISSION_MAX_ACTIVE: int = int(os.getenv("ADMISSION_MAX_ACTIVE") or 16)
+    ADMISSION_QUEUE_SIZE: int = int(os.getenv("ADMISSION_QUEUE_SIZE") or 64)
+    ADMISSION_QUEUE_TIMEOUT: float = float(os.getenv("ADMISSION_QUEUE_TIMEOUT") or 10)
+
+    # === Tasa por cliente (token bucket) en /ask*; el cliente es la IP o CLIENT_ID_HEADER.
+    # Apagada por defecto: detrás de un proxy o NAT todos comparten la IP de la conexión
+    CLIENT_RATE_PER_MIN: float = float(os.getenv("CLIENT_RATE_PER_MIN") or 0)  # 0 = sin límite
+    CLIENT_RATE_BURST: float = float(os.getenv("CLIENT_RATE_BURST") or 10)
+    CLIENT_ID_HEADER: str = _clean(os.getenv("CLIENT_ID_HEADER"))
+    # Proxies propios delante de la app: de X-Forwarded-For se usa el salto que agregó el más externo
+    TRUSTED_PROXY_HOPS: int = int(os.getenv("TRUSTED_PROXY_HOPS") or 1)
+
+    # === Forma de la respuesta de /ask: answer | answer+sources | debug (incluye search_results)
+    RESPONSE_VERBOSITY: str = _clean(os.getenv("RESPONSE_VERBOSITY") or "answer+sources").lower()
+    SOURCE_TEXT_CHARS: int = int(os.getenv("SOURCE_TEXT_CHARS") or 280)              # -1 = texto completo
+    RESPONSE_COMPRESS_MIN_BYTES: int = int(os.getenv("RESPONSE_COMPRESS_MIN_BYTES") or 4096)  # 0 = sin compresión
+
+    # === Línea de log estructurada (JSON) por request
+    REQUEST_LOG: bool = _flag("REQUEST_LOG", True)
+
+    # === Token para endpoints administrativos (vacío = sin protección)
+    ADMIN_TOKEN: str = _clean(os.getenv("ADMIN_TOKEN"))
+
 settings = Settings()
 
 # ---------------- Re-exports convenientes ----------------
@@ -81,8 +224,20 @@ NUCLIA_API_BASE = settings.NUCLIA_API_BASE
 KB = settings.KB
 NUCLIA_TOKEN = settings.NUCLIA_TOKEN
 
+KBS_PATH = settings.KBS_PATH
+KB_TIMEOUT = settings.KB_TIMEOUT
+KB_ROUTING = settings.KB_ROUTING
+RRF_K = settings.RRF_K
+
+NUCLIA_TIMEOUT = settings.NUCLIA_TIMEOUT
+NUCLIA_CONNECT_TIMEOUT = settings.NUCLIA_CONNECT_TIMEOUT
+NUCLIA_HTTP2 = settings.NUCLIA_HTTP2
+NUCLIA_MAX_CONNECTIONS = settings.NUCLIA_MAX_CONNECTIONS
+NUCLIA_MAX_KEEPALIVE = settings.NUCLIA_MAX_KEEPALIVE
+
 ANTHROPIC_KEY = settings.ANTHROPIC_KEY
 CLAUDE_MODEL = settings.CLAUDE_MODEL
+ANTHROPIC_BASE_URL = settings.ANTHROPIC_BASE_URL
 
 FRONT_ORIGIN = settings.FRONT_ORIGIN
 INSTRUCTIONS = settings.INSTRUCTIONS
@@ -90,17 +245,116 @@ INSTRUCTIONS = settings.INSTRUCTIONS
 MAX_TOKENS = settings.MAX_TOKENS
 TEMPERATURE = settings.TEMPERATURE
 
+MODEL_ROUTING = settings.MODEL_ROUTING
+FAST_MODEL = settings.FAST_MODEL
+FAST_MAX_TOKENS = settings.FAST_MAX_TOKENS
+FAST_MAX_WORDS = settings.FAST_MAX_WORDS
+FAST_MIN_SCORE = settings.FAST_MIN_SCORE
+FAST_MAX_PARAGRAPHS = settings.FAST_MAX_PARAGRAPHS
+MODEL_FALLBACK = settings.MODEL_FALLBACK
+
+PROMPT_CACHE = settings.PROMPT_CACHE
+PROMPT_CACHE_CONTEXT = settings.PROMPT_CACHE_CONTEXT
+
+QUERY_REWRITER = settings.QUERY_REWRITER
+REWRITE_MIN_CONFIDENCE = settings.REWRITE_MIN_CONFIDENCE
+
+SPECULATIVE_SEARCH = settings.SPECULATIVE_SEARCH
+REWRITE_DEADLINE = settings.REWRITE_DEADLINE
+
+CONTEXT_PACKING = settings.CONTEXT_PACKING
+CONTEXT_TOKEN_BUDGET = settings.CONTEXT_TOKEN_BUDGET
+
+PROMPT_TOKEN_BUDGET = settings.PROMPT_TOKEN_BUDGET
+OUTPUT_TOKEN_BUDGET = settings.OUTPUT_TOKEN_BUDGET
+DAILY_TOKEN_QUOTA = settings.DAILY_TOKEN_QUOTA
+DAILY_TOKEN_RESERVE = settings.DAILY_TOKEN_RESERVE
+CLIENT_DAILY_TOKENS = settings.CLIENT_DAILY_TOKENS
+
+RERANK = settings.RERANK
+RERANK_TOP_K = settings.RERANK_TOP_K
+RERANK_CUTOFF = settings.RERANK_CUTOFF
+RERANK_MIN_KEEP = settings.RERANK_MIN_KEEP
+
+FIX_ENGINE = settings.FIX_ENGINE
+
+INTENT_KEYWORDS_PATH = settings.INTENT_KEYWORDS_PATH
+OFFTOPIC_ROUTING = settings.OFFTOPIC_ROUTING
+
+FAQ_INDEX_PATH = settings.FAQ_INDEX_PATH
+FAQ_MIN_SCORE = settings.FAQ_MIN_SCORE
+FAQ_RELOAD_INTERVAL = settings.FAQ_RELOAD_INTERVAL
+
+ANSWER_CACHE_BACKEND = settings.ANSWER_CACHE_BACKEND
+ANSWER_CACHE_TTL = settings.ANSWER_CACHE_TTL
+ANSWER_CACHE_MAX_ENTRIES = settings.ANSWER_CACHE_MAX_ENTRIES
+ANSWER_CACHE_PATH = settings.ANSWER_CACHE_PATH
+
+SESSION_BACKEND = settings.SESSION_BACKEND
+SESSION_PATH = settings.SESSION_PATH
+SESSION_TTL = settings.SESSION_TTL
+SESSION_MAX_ENTRIES = settings.SESSION_MAX_ENTRIES
+SESSION_MAX_TURNS = settings.SESSION_MAX_TURNS
+SESSION_HISTORY_TOKENS = settings.SESSION_HISTORY_TOKENS
+SESSION_REUSE_DECAY = settings.SESSION_REUSE_DECAY
+
+SEARCH_CACHE_TTL = settings.SEARCH_CACHE_TTL
+SEARCH_CACHE_STALE = settings.SEARCH_CACHE_STALE
+SEARCH_CACHE_MAX_ENTRIES = settings.SEARCH_CACHE_MAX_ENTRIES
+
+LOCAL_INDEX_PATH = settings.LOCAL_INDEX_PATH
+LOCAL_SEARCH_MODE = settings.LOCAL_SEARCH_MODE
+LOCAL_INDEX_RELOAD_INTERVAL = settings.LOCAL_INDEX_RELOAD_INTERVAL
+
+RESOURCE_TIMEOUT = settings.RESOURCE_TIMEOUT
+RESOURCE_CACHE_DIR = settings.RESOURCE_CACHE_DIR
+RESOURCE_CACHE_MAX_MB = settings.RESOURCE_CACHE_MAX_MB
+RESOURCE_CACHE_MAX_FILE_MB = settings.RESOURCE_CACHE_MAX_FILE_MB
+RESOURCE_CACHE_TTL = settings.RESOURCE_CACHE_TTL
+
+BATCH_MAX_ITEMS = settings.BATCH_MAX_ITEMS
+BATCH_SEARCH_CONCURRENCY = settings.BATCH_SEARCH_CONCURRENCY
+BATCH_LLM_CONCURRENCY = settings.BATCH_LLM_CONCURRENCY
+BATCH_LLM_RPM = settings.BATCH_LLM_RPM
+
+REQUEST_DEADLINE = settings.REQUEST_DEADLINE
+
+RETRY_ATTEMPTS = settings.RETRY_ATTEMPTS
+RETRY_BASE_DELAY = settings.RETRY_BASE_DELAY
+RETRY_MAX_DELAY = settings.RETRY_MAX_DELAY
+BREAKER_FAILURES = settings.BREAKER_FAILURES
+BREAKER_RESET = settings.BREAKER_RESET
+STALE_IF_ERROR = settings.STALE_IF_ERROR
+
+ADMISSION_MAX_ACTIVE = settings.ADMISSION_MAX_ACTIVE
+ADMISSION_QUEUE_SIZE = settings.ADMISSION_QUEUE_SIZE
+ADMISSION_QUEUE_TIMEOUT = settings.ADMISSION_QUEUE_TIMEOUT
+
+CLIENT_RATE_PER_MIN = settings.CLIENT_RATE_PER_MIN
+CLIENT_RATE_BURST = settings.CLIENT_RATE_BURST
+CLIENT_ID_HEADER = settings.CLIENT_ID_HEADER
+TRUSTED_PROXY_HOPS = settings.TRUSTED_PROXY_HOPS
+
+RESPONSE_VERBOSITY = settings.RESPONSE_VERBOSITY
+SOURCE_TEXT_CHARS = settings.SOURCE_TEXT_CHARS
+RESPONSE_COMPRESS_MIN_BYTES = settings.RESPONSE_COMPRESS_MIN_BYTES
+
+REQUEST_LOG = settings.REQUEST_LOG
+
+ADMIN_TOKEN = settings.ADMIN_TOKEN
+
 # ---------------- Cabeceras para Nuclia (lo espera nuclia.py) ----------------
 # ---------------- Cabeceras para Nuclia (auto Cloud/OSS) ----------------
-def _build_nuclia_headers() -> dict:
+def nuclia_headers(token: Optional[str] = None) -> dict:
     """
     Nuclia Cloud (RAG-as-a-Service, p.ej. rag.progress.cloud):
       - Usa x-api-key: <token>
     Nuclia OSS / NucliaDB / otros:
       - Usa Authorization: Bearer <token>
+    `token` None = NUCLIA_TOKEN (las KB federadas pueden traer el suyo).
     """
     base = (NUCLIA_API_BASE or "").lower()
-    token = NUCLIA_TOKEN or ""
+    token = (NUCLIA_TOKEN if token is None else token) or ""
     headers = {
         "Accept": "application/json",
         "Content-Type": "application/json",
@@ -115,5 +369,5 @@ def _build_nuclia_headers() -> dict:
 
     return headers
 
-HEADERS = _build_nuclia_headers()
+HEADERS = nuclia_headers()
 
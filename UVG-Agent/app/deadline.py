@@ -0,0 +1,127 @@
+# app/deadline.py
+from __future__ import annotations
+import asyncio
+import contextvars
+import time
+from collections import Counter
+from typing import Any, Awaitable, Dict, List, Optional, TypeVar
+
+from .config import REQUEST_DEADLINE
+
+T = TypeVar("T")
+
+# ── Presupuesto de latencia por request
+# Cada pregunta lleva un plazo total (REQUEST_DEADLINE o `deadline` del body) que se
+# hereda por contexto hasta cada etapa. Antes de una etapa cara se compara el tiempo
+# restante con lo que suelen tardar las etapas pendientes (promedio móvil por etapa) y,
+# si no alcanza, se degrada en este orden:
+#   1. skip_rewrite     sin reescritura: se busca con la pregunta original
+#   2. shrink_search    menos resultados de Nuclia y menos párrafos en el contexto
+#   3. skip_reformat    sin segunda pasada con Claude para el esquema Markdown
+#   4. fallback_answer  solo las fuentes con una respuesta breve, sin generación
+# Las llamadas a Nuclia y Claude se cortan además al vencer el plazo.
+# Los ítems de /ask/batch crean su plazo en pausa: empieza a correr cuando el ítem obtiene
+# su primer cupo de admisión (antes solo está esperando turno detrás del resto del lote).
+
+DEGRADATIONS = ("skip_rewrite", "shrink_search", "skip_reformat", "fallback_answer")
+
+degradation_totals: Counter = Counter()
+
+# Segundos típicos por etapa; se ajustan con lo que se va observando
+_estimates: Dict[str, float] = {"rewrite": 1.5, "search": 2.0, "generation": 8.0, "reformat": 4.0}
+# La generación se intenta aunque quede menos de su promedio (se corta al vencer)
+_GENERATION_MIN_FRACTION = 0.5
+
+class DeadlineExceeded(Exception):
+    """La etapa no alcanzó a terminar dentro del presupuesto del request."""
+
+def estimate(stage: str) -> float:
+    return _estimates.get(stage, 0.0)
+
+def observe(stage: str, seconds: float) -> None:
+    _estimates[stage] = 0.8 * _estimates.get(stage, seconds) + 0.2 * seconds
+
+def _need(stages: tuple) -> float:
+    need = sum(estimate(s) for s in stages)
+    if "generation" in stages:
+        need -= estimate("generation") * (1 - _GENERATION_MIN_FRACTION)
+    return need
+
+class Deadline:
+    def __init__(self, budget: float, paused: bool = False):
+        self.budget = budget
+        self.expires: Optional[float] = None
+        self.applied: List[str] = []
+        if not paused:
+            self.begin()
+
+    def begin(self) -> None:
+        """Empieza a correr el plazo (si estaba en pausa; si no, no hace nada)."""
+        if self.expires is None:
+            self.expires = time.monotonic() + self.budget
+
+    def remaining(self) -> float:
+        if self.expires is None:
+            return self.budget
+        return self.expires - time.monotonic()
+
+    def allows(self, *stages: str) -> bool:
+        """¿Alcanza el tiempo para estas etapas?"""
+        return self.remaining() >= _need(stages)
+
+    def degrade(self, name: str) -> None:
+        if name not in self.applied:
+            self.applied.append(name)
+            degradation_totals[name] += 1
+
+    async def run(self, stage: str, aw: Awaitable[T], reserve: tuple = ()) -> T:
+        """Espera `aw` hasta el plazo, dejando libre lo que suelen tardar `reserve`."""
+        if self.expires is None:  # en pausa: la etapa aún no cuenta contra el plazo
+            return await aw
+        timeout = self.remaining() - _need(reserve)
+        if timeout <= 0:
+            if asyncio.iscoroutine(aw):
+                aw.close()
+            raise DeadlineExceeded(stage)
+        t0 = time.monotonic()
+        try:
+            result = await asyncio.wait_for(aw, timeout)
+        except asyncio.TimeoutError:
+            # Cortada antes de terminar: su duración real fue al menos la estimada
+            observe(stage, max(time.monotonic() - t0, estimate(stage)))
+            raise DeadlineExceeded(stage) from None
+        observe(stage, time.monotonic() - t0)
+        return result
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "budget_ms": round(self.budget * 1000, 1),
+            "remaining_ms": round(max(0.0, self.remaining()) * 1000, 1),
+            "degraded": sorted(self.applied, key=DEGRADATIONS.index),
+        }
+
+_current: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar("uvg_deadline", default=None)
+
+def start_deadline(budget: Optional[float] = None, paused: bool = False) -> Optional[Deadline]:
+    """Fija el plazo del request actual (None/0 = sin presupuesto)."""
+    budget = budget if budget is not None else REQUEST_DEADLINE
+    deadline = Deadline(budget, paused) if budget and budget > 0 else None
+    _current.set(deadline)
+    return deadline
+
+def current_deadline() -> Optional[Deadline]:
+    return _current.get()
+
+async def within(stage: str, aw: Awaitable[T], reserve: tuple = ()) -> T:
+    """`Deadline.run` si el request tiene plazo; si no, espera sin límite."""
+    deadline = _current.get()
+    if deadline is None:
+        return await aw
+    return await deadline.run(stage, aw, reserve)
+
+def deadline_stats() -> Dict[str, Any]:
+    return {
+        "default_budget_s": REQUEST_DEADLINE,
+        "estimates_s": {k: round(v, 3) for k, v in _estimates.items()},
+        "degradations": {name: degradation_totals[name] for name in DEGRADATIONS},
+    }
@@ -0,0 +1,256 @@
+# app/faq.py
+from __future__ import annotations
+import argparse
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from .config import FAQ_INDEX_PATH, FAQ_MIN_SCORE, FAQ_RELOAD_INTERVAL, KB
+from .rewriter import STOP_WORDS, light_stem
+from .text import normalize_question
+
+# ── Respuestas precalculadas (FAQ) antes del pipeline RAG
+# El índice se arma offline desde tripletas pregunta/respuesta/fuentes curadas y se
+# compara en proceso con TF-IDF sobre n-gramas normalizados (palabras, bigramas y
+# trigramas de caracteres). El archivo se recarga solo cuando cambia su mtime.
+
+log = logging.getLogger("uvg.faq")
+
+_INDEX_VERSION = 1
+# Peso de cada familia de rasgos: los trigramas de caracteres toleran erratas,
+# pero son muchos y no deben dominar el coseno
+_GROUP_WEIGHT = {"w": 1.0, "b": 0.7, "c": 0.4}
+# Stop words que sí cambian la intención de la pregunta ("cuanto cuesta" vs "que es")
+_INTERROGATIVES = frozenset({"que", "cual", "cuales", "cuanto", "cuanta", "cuantos", "cuantas",
+                             "como", "donde", "cuando", "quien", "quienes"})
+
+faq_totals: Counter = Counter()
+
+def features(text: str) -> Dict[str, float]:
+    words = normalize_question(text).split()
+    counts: Counter = Counter()
+    for w in words:
+        if w in STOP_WORDS:
+            continue
+        w = light_stem(w)
+        counts["w:" + w] += 1
+        padded = f" {w} "
+        for i in range(len(padded) - 2):
+            counts["c:" + padded[i:i + 3]] += 1
+    # Bigramas sobre palabras de contenido + interrogativas
+    kept = [light_stem(w) for w in words if w not in STOP_WORDS or w in _INTERROGATIVES]
+    for a, b in zip(kept, kept[1:]):
+        counts[f"b:{a} {b}"] += 1
+    return {f: (1 + math.log(n)) * _GROUP_WEIGHT[f[0]] for f, n in counts.items()}
+
+def _normalize(vec: Dict[str, float]) -> Dict[str, float]:
+    norm = math.sqrt(sum(v * v for v in vec.values()))
+    return {f: v / norm for f, v in vec.items()} if norm else {}
+
+def _as_source(i: int, s: Dict[str, Any]) -> Dict[str, Any]:
+    """Misma forma que extract_sources_info para que el frontend no distinga el origen."""
+    url = s.get("url") or ""
+    return {
+        "id": i + 1,
+        "title": s.get("title") or "Documento sin título",
+        "text": s.get("text") or "",
+        "score": None,
+        "page": s.get("page"),
+        "field": "",
+        "resource_id": s.get("resource_id") or "",
+        "kb": s.get("kb") or KB,
+        "url": url,
+        "url_type": "external" if url.startswith(("http://", "https://")) else ("resource" if url else "none"),
+        "has_url": bool(url),
+    }
+
+def build_index(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Tripletas curadas -> índice serializable (idf + vectores por variante de pregunta)."""
+    entries, docs = [], []
+    for n, rec in enumerate(records):
+        questions = list(rec.get("questions") or [])
+        if rec.get("question"):
+            questions.insert(0, rec["question"])
+        if not questions or not rec.get("answer"):
+            raise ValueError(f"FAQ #{n + 1}: faltan 'question'/'questions' o 'answer'")
+        entries.append({
+            "id": str(rec.get("id") or n + 1),
+            "questions": questions,
+            "answer": rec["answer"].strip(),
+            "sources": [_as_source(i, s) for i, s in enumerate(rec.get("sources") or [])],
+        })
+        docs += [(len(entries) - 1, features(q)) for q in questions]
+
+    df: Counter = Counter(f for _, vec in docs for f in vec)
+    n_docs = len(docs)
+    idf = {f: math.log((1 + n_docs) / (1 + c)) + 1 for f, c in df.items()}
+    vectors = [[e, _normalize({f: w * idf[f] for f, w in vec.items()})] for e, vec in docs]
+    return {
+        "version": _INDEX_VERSION,
+        "built_at": time.time(),
+        "n_docs": n_docs,
+        "idf": idf,
+        "entries": entries,
+        "vectors": vectors,
+    }
+
+@dataclass
+class FaqMatch:
+    id: str
+    score: float
+    question: str
+    answer: str
+    sources: List[Dict[str, Any]] = field(default_factory=list)
+
+class FaqIndex:
+    def __init__(self, data: Dict[str, Any]):
+        if data.get("version") != _INDEX_VERSION:
+            raise ValueError(f"Versión de índice FAQ no soportada: {data.get('version')}")
+        self.entries: List[Dict[str, Any]] = data["entries"]
+        self.idf: Dict[str, float] = data["idf"]
+        self.built_at = data.get("built_at")
+        # Rasgos que no están en ninguna FAQ pesan como el más raro: bajan el coseno
+        self._unknown_idf = math.log(1 + data.get("n_docs", len(data["vectors"]))) + 1
+        self._postings: Dict[str, List[Tuple[int, float]]] = defaultdict(list)
+        self._doc_entry: List[int] = []
+        self._doc_question: List[str] = []
+        per_entry = Counter()
+        for doc, (entry, vec) in enumerate(data["vectors"]):
+            self._doc_entry.append(entry)
+            self._doc_question.append(self.entries[entry]["questions"][per_entry[entry]])
+            per_entry[entry] += 1
+            for f, w in vec.items():
+                self._postings[f].append((doc, w))
+
+    def match(self, question: str) -> Optional[FaqMatch]:
+        q = _normalize({f: w * self.idf.get(f, self._unknown_idf) for f, w in features(question).items()})
+        scores: Dict[int, float] = defaultdict(float)
+        for f, w in q.items():
+            for doc, dw in self._postings.get(f, ()):
+                scores[doc] += w * dw
+        if not scores:
+            return None
+        doc, score = max(scores.items(), key=lambda kv: kv[1])
+        entry = self.entries[self._doc_entry[doc]]
+        return FaqMatch(
+            id=entry["id"],
+            score=round(score, 4),
+            question=self._doc_question[doc],
+            answer=entry["answer"],
+            sources=entry["sources"],
+        )
+
+def load_index(path: str) -> FaqIndex:
+    """Índice construido (.json) o tripletas crudas (.jsonl, se indexan al cargar)."""
+    with open(path, encoding="utf-8") as fh:
+        if path.endswith(".jsonl"):
+            return FaqIndex(build_index([json.loads(line) for line in fh if line.strip()]))
+        return FaqIndex(json.load(fh))
+
+# ── Índice activo con recarga en caliente
+class FaqStore:
+    def __init__(self, path: str, reload_interval: float):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.index: Optional[FaqIndex] = None
+        self.loaded_at: Optional[float] = None
+        self._mtime: Optional[float] = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def _maybe_reload(self) -> None:
+        now = time.monotonic()
+        if now - self._checked < self.reload_interval:
+            return
+        with self._lock:
+            if now - self._checked < self.reload_interval:
+                return
+            self._checked = now
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                if self.index is not None:
+                    log.warning("FAQ: %s ya no existe; se desactiva el índice", self.path)
+                self.index, self._mtime = None, None
+                return
+            if mtime == self._mtime:
+                return
+            try:
+                self.index = load_index(self.path)
+            except Exception as e:
+                # Un archivo a medio escribir no debe tumbar el índice vigente
+                log.warning("FAQ: no se pudo recargar %s (%s); se mantiene el índice anterior", self.path, e)
+                return
+            self._mtime, self.loaded_at = mtime, time.time()
+            faq_totals["reloads"] += 1
+
+    def lookup(self, question: str, min_score: float = FAQ_MIN_SCORE) -> Optional[FaqMatch]:
+        self._maybe_reload()
+        index = self.index
+        if index is None:
+            return None
+        m = index.match(question)
+        if m is None or m.score < min_score:
+            faq_totals["misses"] += 1
+            return None
+        faq_totals["hits"] += 1
+        return m
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "loaded": self.index is not None,
+            "entries": len(self.index.entries) if self.index else 0,
+            "loaded_at": self.loaded_at,
+            "min_score": FAQ_MIN_SCORE,
+            **dict(faq_totals),
+        }
+
+faq_store: Optional[FaqStore] = FaqStore(FAQ_INDEX_PATH, FAQ_RELOAD_INTERVAL) if FAQ_INDEX_PATH else None
+
+def faq_lookup(question: str) -> Optional[FaqMatch]:
+    return faq_store.lookup(question) if faq_store is not None else None
+
+def faq_stats() -> Dict[str, Any]:
+    return faq_store.as_dict() if faq_store is not None else {"loaded": False}
+
+# ── CLI: construir el índice offline y probar coincidencias
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Índice de FAQ para el camino rápido de /ask.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("build", help="construye el índice desde un .jsonl de tripletas curadas")
+    b.add_argument("source", help="JSONL: {question|questions, answer, sources:[{title, url}]}")
+    b.add_argument("-o", "--output", default=FAQ_INDEX_PATH or "faq_index.json")
+    m = sub.add_parser("match", help="muestra la mejor coincidencia para una pregunta")
+    m.add_argument("question")
+    m.add_argument("--index", default=FAQ_INDEX_PATH or "faq_index.json")
+    args = ap.parse_args()
+
+    if args.cmd == "build":
+        with open(args.source, encoding="utf-8") as fh:
+            data = build_index([json.loads(line) for line in fh if line.strip()])
+        # Escritura atómica: el servidor nunca ve un archivo a medias
+        tmp = f"{args.output}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(data, fh, ensure_ascii=False)
+        os.replace(tmp, args.output)
+        print(f"{len(data['entries'])} FAQ, {data['n_docs']} variantes -> {args.output}")
+    else:
+        index = load_index(args.index)
+        t0 = time.perf_counter()
+        hit = index.match(args.question)
+        us = (time.perf_counter() - t0) * 1e6
+        if hit is None:
+            print(f"sin coincidencias ({us:.0f} µs)")
+        else:
+            verdict = "OK" if hit.score >= FAQ_MIN_SCORE else "bajo el umbral"
+            print(f"{hit.score:.3f} ({verdict}, {us:.0f} µs)  #{hit.id}: {hit.question}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+# app/federation.py
+from __future__ import annotations
+import json
+import logging
+import os
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from .intents import route_intent
+from .resilience import CircuitBreaker, breakers
+from .text import normalize_question
+from .config import (
+    KB,
+    KBS_PATH,
+    KB_TIMEOUT,
+    KB_ROUTING,
+    RRF_K,
+    BREAKER_FAILURES,
+    BREAKER_RESET,
+    nuclia_headers,
+)
+
+# ── Búsqueda federada en varias KB (una por sede + admisiones)
+# KBS_PATH apunta a un JSON con la lista de KB:
+#   [{"name": "altiplano", "kb": "<id>", "sede": "altiplano", "weight": 1.0,
+#     "filters": ["/classification.labels/..."], "token_env": "NUCLIA_TOKEN_ALTIPLANO",
+#     "timeout": 5}, ...]
+# Cada búsqueda sale a todas las KB a la vez (cada una con su timeout, su caché y su
+# circuit breaker "nuclia:<name>"); las que fallan o tardan se omiten. Los resultados
+# se combinan con reciprocal rank fusion ponderada (Σ weight / (RRF_K + rank)) y los
+# párrafos con el mismo texto en varias KB quedan una sola vez. Si la consulta nombra
+# una sede (los grupos sede_* del router de intenciones), solo se consultan las KB de
+# esa sede y las que no tienen sede. Sin KBS_PATH se usa solo KB, como siempre.
+
+log = logging.getLogger("uvg.federation")
+
+federation_totals: Counter = Counter()  # (kb, resultado): ok | error | timeout | skipped
+
+@dataclass(frozen=True)
+class KbTarget:
+    name: str
+    kb: str
+    weight: float = 1.0
+    sede: str = ""                               # grupo sede_<sede> del router de intenciones
+    filters: Tuple[str, ...] = ()
+    timeout: float = KB_TIMEOUT
+    headers: Dict[str, str] = field(default_factory=dict, compare=False, hash=False)
+
+    @property
+    def upstream(self) -> str:
+        return f"nuclia:{self.name}"
+
+def load_targets(path: Optional[str]) -> List[KbTarget]:
+    if not path:
+        return []
+    try:
+        with open(path, encoding="utf-8") as fh:
+            raw = json.load(fh)
+        targets = []
+        for n, item in enumerate(raw):
+            if not item.get("kb"):
+                raise ValueError(f"KB #{n + 1}: falta 'kb'")
+            token = os.getenv(item["token_env"]) if item.get("token_env") else None
+            targets.append(KbTarget(
+                name=str(item.get("name") or item["kb"]),
+                kb=str(item["kb"]),
+                weight=float(item.get("weight", 1.0)),
+                sede=normalize_question(str(item.get("sede") or "")).removeprefix("sede "),
+                filters=tuple(item.get("filters") or ()),
+                timeout=float(item.get("timeout") or KB_TIMEOUT),
+                headers=nuclia_headers(token),
+            ))
+    except (OSError, ValueError, AttributeError, TypeError, KeyError) as e:
+        log.warning("Federación: no se pudo leer %s (%s); se usa solo KB=%s", path, e, KB)
+        return []
+    if len({t.name for t in targets}) != len(targets):
+        log.warning("Federación: nombres de KB repetidos en %s; se usa solo KB=%s", path, KB)
+        return []
+    return targets
+
+targets: List[KbTarget] = load_targets(KBS_PATH)
+for _t in targets:
+    breakers.setdefault(_t.upstream, CircuitBreaker(_t.upstream, BREAKER_FAILURES, BREAKER_RESET))
+
+def federated() -> bool:
+    return bool(targets)
+
+def route_kbs(text: str) -> Optional[List[str]]:
+    """KB a consultar según las sedes que nombra `text`; None = todas."""
+    if not targets or not KB_ROUTING:
+        return None
+    sedes = {g[len("sede_"):] for g in route_intent(text).features if g.startswith("sede_")}
+    if not sedes:
+        return None
+    picked = [t.name for t in targets if not t.sede or t.sede in sedes]
+    # Una sede sin KB propia y sin KB generales: mejor buscar en todas que en ninguna
+    return picked if picked and len(picked) < len(targets) else None
+
+def select_targets(names: Optional[List[str]]) -> List[KbTarget]:
+    if names is None:
+        return list(targets)
+    wanted = set(names)
+    return [t for t in targets if t.name in wanted] or list(targets)
+
+# ── Fusión
+def _text_key(hit: dict) -> str:
+    return normalize_question(hit.get("text") or "")
+
+def rrf_merge(results: List[Tuple[KbTarget, dict]], size: int) -> dict:
+    """
+    Reciprocal rank fusion ponderada de las respuestas de cada KB.
+
+    - Los scores de cada KB se dividen por max(1, su mejor score) para quedar en 0–1.
+    - El orden final es Σ weight / (RRF_K + rank) sobre las KB donde aparece el párrafo;
+      el mismo texto en varias KB suma sus aportes y queda con el hit de mayor score.
+    - El `score` publicado es el normalizado, acotado por el del párrafo anterior: así
+      el orden de la fusión se mantiene aunque después se reordene por score
+      (merge_searches, pack_context) y los umbrales nunca ven un score inflado.
+    Cada hit y cada recurso llevan `kb` (id de su KB) para armar URLs correctas.
+    """
+    fused: Dict[str, float] = {}
+    best: Dict[str, dict] = {}
+    resources: Dict[str, Any] = {}
+    for target, search in results:
+        hits = (search.get("paragraphs") or {}).get("results") or []
+        top = max([h.get("score") or 0.0 for h in hits] + [1.0])
+        rank = 0
+        for hit in hits:
+            key = _text_key(hit)
+            if not key:
+                continue
+            rank += 1
+            fused[key] = fused.get(key, 0.0) + target.weight / (RRF_K + rank)
+            score = (hit.get("score") or 0.0) / top
+            prev = best.get(key)
+            if prev is None or score > prev["score"]:
+                best[key] = {**hit, "score": score, "kb": target.kb}
+        res = search.get("resources") or {}
+        if isinstance(res, dict):
+            for rid, info in res.items():
+                resources.setdefault(rid, {**info, "kb": target.kb})
+
+    ranked = sorted(fused, key=lambda k: (fused[k], best[k]["score"]), reverse=True)[:size]
+    merged, ceiling = [], 1.0
+    for key in ranked:
+        hit = best[key]
+        ceiling = min(ceiling, hit["score"])
+        merged.append({**hit, "score": round(ceiling, 4), "rrf": round(fused[key], 5)})
+    used = {h.get("rid") or h.get("resource") for h in merged}
+    return {
+        "paragraphs": {"results": merged, "total": len(merged), "page_number": 0, "page_size": size},
+        "resources": {rid: info for rid, info in resources.items() if rid in used},
+    }
+
+def federation_stats() -> Dict[str, Any]:
+    if not targets:
+        return {"enabled": False, "kb": KB}
+    calls: Dict[str, Dict[str, int]] = {}
+    for (name, outcome), n in federation_totals.items():
+        calls.setdefault(name, {})[outcome] = n
+    return {
+        "enabled": True,
+        "routing": KB_ROUTING,
+        "rrf_k": RRF_K,
+        "kbs": [
+            {"name": t.name, "kb": t.kb, "weight": t.weight, "sede": t.sede or None,
+             "filters": list(t.filters), "timeout": t.timeout, "breaker": breakers[t.upstream].as_dict()}
+            for t in targets
+        ],
+        "calls": calls,
+    }
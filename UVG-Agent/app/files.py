@@ -0,0 +1,508 @@
+# app/files.py
+from __future__ import annotations
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Dict, Optional, Tuple
+
+import httpx
+from fastapi import HTTPException
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+
+from .cache import CacheStats, SingleFlight
+from .clients import get_http_client
+from .config import (
+    KB,
+    NUCLIA_API_BASE,
+    NUCLIA_CONNECT_TIMEOUT,
+    RESOURCE_TIMEOUT,
+    RESOURCE_CACHE_DIR,
+    RESOURCE_CACHE_MAX_MB,
+    RESOURCE_CACHE_MAX_FILE_MB,
+    RESOURCE_CACHE_TTL,
+)
+from .federation import targets
+from .metrics import UPSTREAM_ERRORS, span
+
+# ── Proxy de archivos originales de Nuclia
+# Streaming real por el pool compartido, Range/206 e If-None-Match reenviados a Nuclia,
+# y una caché LRU en disco acotada en bytes que se sirve con FileResponse
+# (Range nativo y sendfile/pathsend cuando el servidor lo soporta).
+# Con búsqueda federada, `?kb=<id>` pide el recurso a esa KB (con su token); el id se
+# valida contra KBS_PATH y forma parte de la clave de la caché.
+
+_CHUNK = 64 * 1024
+_MB = 1024 * 1024
+# Cabeceras de Nuclia que se reenvían al navegador (content-type va por media_type)
+_FORWARD = ("content-length", "content-range", "accept-ranges", "etag", "last-modified")
+_CONTENT_RANGE_TOTAL_RE = re.compile(r"/(\d+)\s*$")
+_PART_MAX_AGE = 3600  # s; temporales huérfanos de un worker caído
+
+@dataclass
+class CachedFile:
+    rid: str
+    size: int
+    etag: str
+    media_type: str
+    disposition: str
+    at: float  # última validación contra Nuclia
+    kb: str = KB
+
+def cache_key(kb: str, rid: str) -> str:
+    return f"{kb}:{rid}"
+
+class ResourceCache:
+    """
+    Caché LRU en disco: <dir>/<sha1(kb:rid)>.bin con el archivo y .json con sus metadatos.
+    El orden LRU sobrevive reinicios (mtime del .bin). Con varios workers cada uno lleva
+    su propia cuenta de bytes, así que el límite es aproximado. El directorio se lee en el
+    primer uso y se crea con la primera descarga (importar el módulo no toca el disco).
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_file_bytes: int, ttl: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._index: "OrderedDict[str, CachedFile]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def _base(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def path(self, key: str) -> str:
+        return self._base(key) + ".bin"
+
+    def _read_meta(self, meta_path: str) -> Optional[Tuple[CachedFile, os.stat_result]]:
+        try:
+            with open(meta_path, encoding="utf-8") as fh:
+                entry = CachedFile(**json.load(fh))
+            return entry, os.stat(self.path(cache_key(entry.kb, entry.rid)))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def _write_meta(self, entry: CachedFile) -> None:
+        base = self._base(cache_key(entry.kb, entry.rid))
+        tmp = base + f".{uuid.uuid4().hex}.json.part"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(asdict(entry), fh)
+        os.replace(tmp, base + ".json")
+
+    def _ensure_loaded(self) -> None:
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+        self._load()
+
+    def _load(self) -> None:
+        found = []
+        now = time.time()
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return  # todavía no se descargó nada
+        for name in names:
+            full = os.path.join(self.directory, name)
+            if name.endswith(".part"):
+                try:
+                    if now - os.stat(full).st_mtime > _PART_MAX_AGE:
+                        os.remove(full)
+                except OSError:
+                    pass
+            elif name.endswith(".json"):
+                item = self._read_meta(full)
+                if item is not None:
+                    found.append(item)
+        found.sort(key=lambda item: item[1].st_mtime)
+        with self._lock:
+            for entry, _ in found:
+                key = cache_key(entry.kb, entry.rid)
+                if key not in self._index:
+                    self._index[key] = entry
+                    self._bytes += entry.size
+        self._evict()
+
+    def get(self, key: str) -> Optional[Tuple[CachedFile, os.stat_result]]:
+        self._ensure_loaded()
+        with self._lock:
+            entry = self._index.get(key)
+        if entry is None:
+            # Puede haberlo descargado otro worker
+            item = self._read_meta(self._base(key) + ".json")
+            if item is not None:
+                with self._lock:
+                    if key not in self._index:
+                        self._index[key] = item[0]
+                        self._bytes += item[0].size
+                self._evict()
+        else:
+            try:
+                item = (entry, os.stat(self.path(key)))
+            except OSError:
+                self.remove(key)
+                item = None
+        if item is None:
+            self.stats.incr("misses")
+            return None
+        with self._lock:
+            if key in self._index:
+                self._index.move_to_end(key)
+        try:
+            os.utime(self.path(key))  # recencia para el LRU tras un reinicio
+        except OSError:
+            pass
+        self.stats.incr("hits")
+        return item
+
+    def writer(self, kb: str, rid: str) -> "CacheWriter":
+        return CacheWriter(self, kb, rid)
+
+    def commit(self, entry: CachedFile, tmp_path: str) -> None:
+        # Primero lo que ya hay en disco: si se leyera después, esta entrada contaría dos veces
+        self._ensure_loaded()
+        key = cache_key(entry.kb, entry.rid)
+        os.replace(tmp_path, self.path(key))
+        self._write_meta(entry)
+        with self._lock:
+            old = self._index.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+            self._index[key] = entry
+            self._bytes += entry.size
+        self.stats.incr("sets")
+        self._evict()
+
+    def touch(self, key: str) -> None:
+        """Marca la entrada como recién validada (Nuclia respondió 304)."""
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is not None:
+                entry.at = time.time()
+        if entry is not None:
+            self._write_meta(entry)
+
+    def remove(self, key: str) -> bool:
+        with self._lock:
+            entry = self._index.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry.size
+        for suffix in (".bin", ".json"):
+            try:
+                os.remove(self._base(key) + suffix)
+            except OSError:
+                pass
+        return entry is not None
+
+    def _evict(self) -> None:
+        while True:
+            with self._lock:
+                if self._bytes <= self.max_bytes or not self._index:
+                    return
+                key = next(iter(self._index))
+            if self.remove(key):
+                self.stats.incr("evictions")
+
+    def clear(self) -> int:
+        self._ensure_loaded()
+        with self._lock:
+            keys = list(self._index)
+        return sum(1 for key in keys if self.remove(key))
+
+    def as_dict(self) -> dict:
+        self._ensure_loaded()
+        with self._lock:
+            entries, used = len(self._index), self._bytes
+        return {
+            **self.stats.as_dict(),
+            "entries": entries,
+            "bytes": used,
+            "max_bytes": self.max_bytes,
+            "max_file_bytes": self.max_file_bytes,
+        }
+
+class CacheWriter:
+    """
+    Escribe una descarga en un temporal; solo entra a la caché si llega completa y dentro del límite.
+    La escritura de cada bloque y el commit corren en un hilo (asyncio.to_thread) para no frenar
+    el event loop con un disco lento.
+    """
+
+    def __init__(self, cache: ResourceCache, kb: str, rid: str):
+        self.cache = cache
+        self.kb = kb
+        self.rid = rid
+        self.tmp_path = cache.path(cache_key(kb, rid)) + f".{uuid.uuid4().hex}.part"
+        self.size = 0
+        self.ok = True
+        self._sha = hashlib.sha1()
+        self._fh = None
+
+    def _open(self):
+        os.makedirs(self.cache.directory, exist_ok=True)
+        return open(self.tmp_path, "wb")
+
+    def _close(self) -> None:
+        if self._fh is None:
+            self._fh = self._open()  # descarga vacía
+        self._fh.close()
+
+    async def write(self, chunk: bytes) -> None:
+        if not self.ok:
+            return
+        self.size += len(chunk)
+        if self.size > self.cache.max_file_bytes:
+            self.abort()
+            return
+        if self._fh is None:
+            self._fh = await asyncio.to_thread(self._open)
+        await asyncio.to_thread(self._fh.write, chunk)
+        self._sha.update(chunk)
+
+    async def commit(self, etag: Optional[str], media_type: str, disposition: str, expected: Optional[int]) -> None:
+        if not self.ok:
+            return
+        await asyncio.to_thread(self._close)
+        if expected is not None and expected != self.size:
+            self.abort()
+            return
+        self.ok = False
+        entry = CachedFile(
+            rid=self.rid,
+            size=self.size,
+            etag=etag or f'"{self._sha.hexdigest()[:20]}"',
+            media_type=media_type,
+            disposition=disposition,
+            at=time.time(),
+            kb=self.kb,
+        )
+        await asyncio.to_thread(self.cache.commit, entry, self.tmp_path)
+
+    def abort(self) -> None:
+        # Sincrónico a propósito: corre en finally, también al cancelarse la descarga
+        self.ok = False
+        if self._fh is not None:
+            self._fh.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+resource_cache: Optional[ResourceCache] = (
+    ResourceCache(
+        RESOURCE_CACHE_DIR,
+        max_bytes=int(RESOURCE_CACHE_MAX_MB * _MB),
+        max_file_bytes=int(RESOURCE_CACHE_MAX_FILE_MB * _MB),
+        ttl=RESOURCE_CACHE_TTL,
+    )
+    if RESOURCE_CACHE_MAX_MB > 0
+    else None
+)
+resource_flight = SingleFlight()
+_background: set = set()
+
+def resource_cache_stats() -> dict:
+    if resource_cache is None:
+        return {"backend": "off"}
+    return {"backend": "disk", **resource_cache.as_dict()}
+
+def invalidate_resources() -> int:
+    return resource_cache.clear() if resource_cache is not None else 0
+
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    """Comparación débil de If-None-Match (lista separada por comas o '*')."""
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tag = etag.removeprefix("W/")
+    return any(t.strip().removeprefix("W/") == tag for t in if_none_match.split(","))
+
+def _int(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+def resolve_kb(kb: Optional[str]) -> Tuple[str, Dict[str, str]]:
+    """KB del recurso y sus cabeceras; solo se aceptan KB y las de KBS_PATH (404 si no)."""
+    if not kb or kb == KB:
+        return KB, {}  # las del cliente compartido
+    for target in targets:
+        if target.kb == kb:
+            return target.kb, target.headers
+    raise HTTPException(status_code=404, detail=f"KB desconocida: {kb}")
+
+def _resource_url(kb: str, rid: str) -> str:
+    return f"{NUCLIA_API_BASE}/kb/{kb}/resource/{rid}/file/original"
+
+async def _open_upstream(
+    kb: str, rid: str, range_header: Optional[str], if_none_match: Optional[str]
+) -> httpx.Response:
+    headers = {**resolve_kb(kb)[1], "Accept": "*/*"}
+    if range_header:
+        headers["Range"] = range_header
+    if if_none_match:
+        headers["If-None-Match"] = if_none_match
+    http = get_http_client()
+    request = http.build_request(
+        "GET",
+        _resource_url(kb, rid),
+        headers=headers,
+        timeout=httpx.Timeout(RESOURCE_TIMEOUT, connect=NUCLIA_CONNECT_TIMEOUT),
+    )
+    with span("resource_upstream", upstream="nuclia"):
+        return await http.send(request, stream=True)
+
+def _from_disk(entry: CachedFile, stat_result: os.stat_result, if_none_match: Optional[str]) -> Response:
+    headers = {
+        "ETag": entry.etag,
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": entry.disposition,
+        "X-Cache": "HIT",
+    }
+    if etag_matches(if_none_match, entry.etag):
+        return Response(status_code=304, headers=headers)
+    # FileResponse resuelve Range/If-Range y usa pathsend si el servidor lo ofrece
+    return FileResponse(
+        resource_cache.path(cache_key(entry.kb, entry.rid)),
+        media_type=entry.media_type,
+        headers=headers,
+        stat_result=stat_result,
+    )
+
+async def _proxy(kb: str, rid: str, upstream: httpx.Response) -> Response:
+    status = upstream.status_code
+    if status == 304:
+        await upstream.aclose()
+        return Response(status_code=304, headers={k: upstream.headers[k] for k in ("etag",) if k in upstream.headers})
+    if status not in (200, 206):
+        try:
+            detail = (await upstream.aread())[:800].decode("utf-8", "replace")
+        finally:
+            await upstream.aclose()
+        if status >= 500:
+            UPSTREAM_ERRORS.inc(upstream="nuclia", error="HTTPStatusError")
+        raise HTTPException(status_code=status, detail=detail)
+
+    headers = {k: upstream.headers[k] for k in _FORWARD if k in upstream.headers}
+    if "content-encoding" in upstream.headers:
+        headers.pop("content-length", None)  # aiter_bytes entrega el cuerpo ya descomprimido
+    # Forzar inline para que el navegador lo pueda mostrar
+    disposition = upstream.headers.get("content-disposition", f'inline; filename="{rid}.pdf"')
+    headers["Content-Disposition"] = disposition
+    headers["X-Cache"] = "MISS"
+    media_type = upstream.headers.get("content-type", "application/octet-stream")
+
+    writer: Optional[CacheWriter] = None
+    if resource_cache is not None:
+        if status == 200:
+            length = _int(headers.get("content-length"))
+            if length is None or length <= resource_cache.max_file_bytes:
+                writer = resource_cache.writer(kb, rid)
+        else:
+            # El visor pidió un rango: se entrega tal cual y el archivo completo se baja aparte
+            m = _CONTENT_RANGE_TOTAL_RE.search(upstream.headers.get("content-range", ""))
+            if m and int(m.group(1)) <= resource_cache.max_file_bytes:
+                _fill_in_background(kb, rid)
+
+    async def body():
+        complete = False
+        try:
+            async for chunk in upstream.aiter_bytes(_CHUNK):
+                if writer is not None:
+                    await writer.write(chunk)
+                yield chunk
+            complete = True
+        finally:
+            await upstream.aclose()
+            if writer is not None:
+                if complete:
+                    await writer.commit(upstream.headers.get("etag"), media_type, disposition,
+                                        _int(headers.get("content-length")))
+                else:
+                    writer.abort()
+
+    return StreamingResponse(
+        body(),
+        status_code=status,
+        media_type=media_type,
+        headers=headers,
+        background=BackgroundTask(upstream.aclose),  # por si el cliente se desconecta antes de terminar
+    )
+
+def _fill_in_background(kb: str, rid: str) -> None:
+    key = cache_key(kb, rid)
+    if resource_flight.inflight(key):
+        return
+
+    async def fill():
+        try:
+            await resource_flight.do(key, lambda: _download(kb, rid))
+        except Exception:
+            pass  # la caché es opcional; el visor ya recibió su rango
+
+    task = asyncio.get_running_loop().create_task(fill())
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+async def _download(kb: str, rid: str) -> None:
+    upstream = await _open_upstream(kb, rid, None, None)
+    writer: Optional[CacheWriter] = None
+    try:
+        if upstream.status_code != 200:
+            return
+        writer = resource_cache.writer(kb, rid)
+        async for chunk in upstream.aiter_bytes(_CHUNK):
+            await writer.write(chunk)
+            if not writer.ok:
+                return
+        length = None if "content-encoding" in upstream.headers else _int(upstream.headers.get("content-length"))
+        await writer.commit(
+            upstream.headers.get("etag"),
+            upstream.headers.get("content-type", "application/octet-stream"),
+            upstream.headers.get("content-disposition", f'inline; filename="{rid}.pdf"'),
+            length,
+        )
+    finally:
+        await upstream.aclose()
+        if writer is not None and writer.ok:
+            writer.abort()
+
+async def serve_resource(
+    rid: str,
+    range_header: Optional[str] = None,
+    if_none_match: Optional[str] = None,
+    kb: Optional[str] = None,
+) -> Response:
+    """Respuesta para GET /resources/{rid}/file: caché en disco o streaming desde Nuclia."""
+    kb = resolve_kb(kb)[0]
+    if resource_cache is not None:
+        key = cache_key(kb, rid)
+        hit = resource_cache.get(key)
+        if hit is not None:
+            entry, stat_result = hit
+            if time.time() - entry.at < resource_cache.ttl:
+                return _from_disk(entry, stat_result, if_none_match)
+            # Vencida: se revalida con el ETag guardado; 304 = la copia local sigue vigente
+            resource_cache.stats.incr("stale")
+            upstream = await _open_upstream(kb, rid, range_header, entry.etag)
+            if upstream.status_code == 304:
+                await upstream.aclose()
+                resource_cache.touch(key)
+                return _from_disk(entry, stat_result, if_none_match)
+            resource_cache.remove(key)
+            return await _proxy(kb, rid, upstream)
+
+    return await _proxy(kb, rid, await _open_upstream(kb, rid, range_header, if_none_match))
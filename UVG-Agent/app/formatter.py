@@ -0,0 +1,126 @@
+# app/formatter.py
+from __future__ import annotations
+import re
+from typing import List, Optional, Tuple
+
+from .text import normalize_question
+
+# ── Reestructurador local del esquema Markdown
+# Reemplaza la segunda llamada "fix" al LLM: reparte la respuesta en
+#   # Respuesta / ## Detalles / ## Siguientes pasos / ## Fuentes consultadas
+# y arma las fuentes directamente desde extract_sources_info.
+
+DEFAULT_NEXT_STEP = "Confirma los detalles con Admisiones, Registro o Finanzas de tu sede."
+
+_HEADING_RE = re.compile(r"^\s{0,3}#{1,6}\s+(.*?)\s*#*\s*$")
+_BOLD_HEADING_RE = re.compile(r"^\s*\*\*(.+?)\*\*:?\s*$")
+_COLON_HEADING_RE = re.compile(r"^\s*([^\-*•\d\s][^:]{0,40}):\s*$")
+_BULLET_RE = re.compile(r"^\s*[-*•]\s+(.*)$")
+_NUMBERED_RE = re.compile(r"^\s*\d+[.)]\s+(.*)$")
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+(?=[A-ZÁÉÍÓÚÑ¿¡0-9])")
+
+# Encabezados (normalizados) que se mapean a cada sección del esquema
+_ALIASES = {
+    "respuesta": ("respuesta", "resumen", "en resumen", "respuesta corta", "conclusion"),
+    "detalles": ("detalle", "detalles", "informacion", "puntos clave", "datos", "descripcion"),
+    "pasos": (
+        "siguientes pasos", "proximos pasos", "pasos", "que hacer", "como", "para",
+        "proceso", "procedimiento", "recomendacion",
+    ),
+    "fuentes": ("fuentes", "fuentes consultadas", "referencias", "bibliografia"),
+}
+
+def source_lines(sources: List[dict]) -> List[str]:
+    """Líneas '- Título (URL o ID)' sin duplicados, en el orden de las fuentes."""
+    seen = set()
+    lines = []
+    for s in sources:
+        ref = s.get("url") or s.get("resource_id") or ""
+        key = (s.get("title"), ref)
+        if key in seen:
+            continue
+        seen.add(key)
+        title = s.get("title") or "Documento sin título"
+        lines.append(f"- {title} ({ref})" if ref else f"- {title}")
+    return lines
+
+def _section_for(heading: str) -> Optional[str]:
+    h = normalize_question(heading)
+    for section, aliases in _ALIASES.items():
+        if any(h == a or h.startswith(a + " ") for a in aliases):
+            return section
+    return None
+
+def _split_sections(text: str) -> List[Tuple[Optional[str], List[str]]]:
+    sections: List[Tuple[Optional[str], List[str]]] = [(None, [])]
+    for line in text.splitlines():
+        m = _HEADING_RE.match(line) or _BOLD_HEADING_RE.match(line) or _COLON_HEADING_RE.match(line)
+        if m:
+            sections.append((m.group(1).strip().rstrip(":"), []))
+        elif line.strip():
+            sections[-1][1].append(line.rstrip())
+    return [(h, lines) for h, lines in sections if h is not None or lines]
+
+def _item(line: str) -> Tuple[str, str]:
+    """Clasifica una línea en ('bullet'|'numbered'|'text', contenido)."""
+    m = _BULLET_RE.match(line)
+    if m:
+        return "bullet", m.group(1).strip()
+    m = _NUMBERED_RE.match(line)
+    if m:
+        return "numbered", m.group(1).strip()
+    return "text", line.strip()
+
+def restructure(answer: str, sources: List[dict]) -> Optional[str]:
+    """
+    Devuelve la respuesta en el esquema obligatorio, o None si no se puede armar
+    una estructura válida (sin resumen o sin detalles) y hace falta el LLM.
+    """
+    respuesta: List[str] = []
+    detalles: List[str] = []
+    pasos: List[str] = []
+
+    for heading, lines in _split_sections(answer or ""):
+        section = _section_for(heading) if heading else None
+        if section == "fuentes":
+            continue  # se regeneran desde las fuentes reales
+        if heading and section is None:
+            # Subtítulo propio del modelo (p. ej. "Costos por carrera"): se conserva como grupo
+            detalles.append(f"- **{heading}**")
+            detalles.extend(f"  - {_item(line)[1]}" for line in lines)
+            continue
+        for line in lines:
+            kind, content = _item(line)
+            if section == "respuesta":
+                respuesta.append(content)
+            elif section == "detalles":
+                detalles.append(f"- {content}")
+            elif section == "pasos" or (section is None and kind == "numbered"):
+                pasos.append(content)
+            elif kind == "bullet":
+                detalles.append(f"- {content}")
+            elif not respuesta:
+                respuesta.append(content)
+            else:
+                detalles.append(f"- {content}")
+
+    # Un solo párrafo largo: la primera oración resume, el resto va a detalles
+    if respuesta and not detalles:
+        sentences = _SENTENCE_RE.split(" ".join(respuesta))
+        if len(sentences) > 1:
+            respuesta = sentences[:1]
+            detalles = [f"- {s}" for s in sentences[1:]]
+    # El resumen es de 1–3 líneas
+    if len(respuesta) > 3:
+        detalles = [f"- {r}" for r in respuesta[3:]] + detalles
+        respuesta = respuesta[:3]
+
+    if not respuesta or not detalles:
+        return None
+
+    out = ["# Respuesta", "\n".join(respuesta), "", "## Detalles", "\n".join(detalles), ""]
+    out += ["## Siguientes pasos", "\n".join(f"{i}) {p}" for i, p in enumerate(pasos or [DEFAULT_NEXT_STEP], 1))]
+    lines = source_lines(sources)
+    if lines:
+        out += ["", "## Fuentes consultadas", "\n".join(lines)]
+    return "\n".join(out)
@@ -0,0 +1,157 @@
+# app/intents.py
+from __future__ import annotations
+import json
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Literal, Optional, Set
+
+from .config import INTENT_KEYWORDS_PATH
+from .text import normalize_question
+
+# ── Router de intenciones
+# Grupos de palabras clave (configurables) compilados una sola vez en una regex
+# combinada; una pasada sobre la pregunta normalizada devuelve la intención y los
+# rasgos que la activaron.
+
+log = logging.getLogger("uvg.intents")
+
+Intent = Literal["greeting", "uvg", "offtopic", "unknown"]
+
+# Formas normalizadas (minúsculas, sin acentos); el plural (-s/-es) se acepta solo
+DEFAULT_KEYWORDS: Dict[str, List[str]] = {
+    "greeting": [
+        "hola", "buenas", "buenos dias", "buenas tardes", "buenas noches", "que tal",
+        "como estas", "como esta", "saludos", "hi", "hello", "hey",
+    ],
+    "uvg": [
+        "uvg", "universidad del valle", "admision", "admisiones", "carrera", "inscripcion",
+        "beca", "pensum", "malla", "facultad", "laboratorio", "crea", "makerspace",
+        "licenciatura", "maestria", "posgrado", "doctorado", "graduacion", "titulo",
+        "biblioteca", "reglamento", "catedratico", "estudiante", "semestre", "ciclo",
+    ],
+    "sede_altiplano": ["altiplano", "campus altiplano", "solola"],
+    "sede_sur": ["campus sur", "escuintla"],
+    "sede_central": ["campus central"],
+    "costos": [
+        "arancel", "costo", "precio", "colegiatura", "mensualidad", "cuota", "pago",
+        "cuanto cuesta", "financiamiento", "descuento",
+    ],
+    "calendario": [
+        "calendario", "fecha", "horario", "inicio de clases", "vacaciones", "examen",
+        "asueto", "cuando empieza", "cuando inicia",
+    ],
+    "offtopic": [
+        "receta", "futbol", "clima", "pelicula", "serie", "cancion", "chiste", "horoscopo",
+        "bitcoin", "criptomoneda", "loteria", "videojuego", "celebridad", "novela",
+    ],
+}
+
+# Grupos que indican un tema UVG (los sede_* cuentan también)
+_TOPICAL_PREFIXES = ("uvg", "sede_", "costos", "calendario")
+# Los acentos se aceptan dentro de la regex (la ñ se conserva): así la pregunta solo
+# pasa por lower() y únicamente el texto encontrado se dobla para buscar su grupo
+_VOWELS = {"a": "[aáà]", "e": "[eéè]", "i": "[iíì]", "o": "[oóò]", "u": "[uúüù]"}
+_FOLD = str.maketrans("áéíóúüàèìòù", "aeiouuaeiou")
+_GREETING_MAX_WORDS = 8
+_KEYS_MEMO_MAX = 4096
+
+def _char_pattern(ch: str) -> str:
+    if ch == " ":
+        return r"\s+"
+    return _VOWELS.get(ch) or re.escape(ch)
+
+def _trie_pattern(words: Iterable[str]) -> str:
+    """Alternativa con prefijos factorizados: `re` no lo hace solo y prueba cada palabra."""
+    trie: Dict[str, dict] = {}
+    for w in words:
+        node = trie
+        for ch in w:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def walk(node: Dict[str, dict]) -> str:
+        optional = "" in node
+        branches = [_char_pattern(ch) + walk(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if optional:
+            # Un solo átomo no necesita grupo para el "?"
+            return (body if len(branches) > 1 or len(body) == 1 else "(?:" + body + ")") + "?"
+        return body
+
+    return walk(trie)
+
+@dataclass
+class IntentResult:
+    intent: Intent
+    features: Dict[str, List[str]] = field(default_factory=dict)  # grupo -> palabras encontradas
+
+    @property
+    def topics(self) -> List[str]:
+        return [g for g in self.features if g.startswith(_TOPICAL_PREFIXES)]
+
+    def as_dict(self) -> Dict[str, object]:
+        return {"name": self.intent, "features": self.features}
+
+class IntentRouter:
+    def __init__(self, keywords: Dict[str, Iterable[str]]):
+        self._groups: Dict[str, Set[str]] = {}
+        for group, words in keywords.items():
+            for w in words:
+                norm = normalize_question(w)
+                if norm:
+                    self._groups.setdefault(norm, set()).add(group)
+        # El trie es codicioso: "campus sur" gana sobre "campus"; el lookahead descarta
+        # de entrada las posiciones cuya letra no inicia ninguna palabra clave
+        pattern = _trie_pattern(self._groups)
+        firsts = "".join(sorted({_VOWELS.get(k[0], re.escape(k[0])).strip("[]") for k in self._groups}))
+        self._re = re.compile(rf"\b(?=[{firsts}])({pattern})(?:e?s)?\b") if pattern else None
+        # Texto encontrado (con acentos/espacios tal cual) -> palabra clave normalizada
+        self._keys: Dict[str, str] = {}
+
+    def route(self, question: str) -> IntentResult:
+        q = (question or "").lower()
+        features: Dict[str, List[str]] = {}
+        if self._re is not None:
+            for m in self._re.finditer(q):
+                found = m.group(1)
+                key = self._keys.get(found)
+                if key is None:
+                    key = " ".join(found.translate(_FOLD).split())
+                    if len(self._keys) < _KEYS_MEMO_MAX:  # \s+ admite variantes sin fin
+                        self._keys[found] = key
+                for group in self._groups[key]:
+                    hits = features.setdefault(group, [])
+                    if key not in hits:
+                        hits.append(key)
+        if not features:
+            return IntentResult("unknown")
+
+        intent: Intent = "unknown"
+        if any(g.startswith(_TOPICAL_PREFIXES) for g in features):
+            intent = "uvg"
+        elif "greeting" in features and len(q.split()) <= _GREETING_MAX_WORDS:
+            intent = "greeting"
+        elif "offtopic" in features:
+            intent = "offtopic"
+        return IntentResult(intent, features)
+
+def load_keywords(path: Optional[str]) -> Dict[str, List[str]]:
+    """Grupos por defecto + los del archivo JSON ({"grupo": [palabras...]}), que los reemplazan."""
+    keywords = {group: list(words) for group, words in DEFAULT_KEYWORDS.items()}
+    if not path:
+        return keywords
+    try:
+        with open(path, encoding="utf-8") as fh:
+            custom = json.load(fh)
+        keywords.update({str(g): [str(w) for w in words] for g, words in custom.items()})
+    except (OSError, ValueError, AttributeError, TypeError) as e:
+        log.warning("Intenciones: no se pudo leer %s (%s); se usan las palabras por defecto", path, e)
+    return keywords
+
+router = IntentRouter(load_keywords(INTENT_KEYWORDS_PATH))
+
+def route_intent(question: str) -> IntentResult:
+    return router.route(question)
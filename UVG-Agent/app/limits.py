@@ -0,0 +1,80 @@
+# app/limits.py
+from __future__ import annotations
+import asyncio
+import contextvars
+import time
+from contextlib import asynccontextmanager, nullcontext
+from typing import AsyncContextManager, AsyncIterator, Callable, Dict, Optional
+
+# ── Límites de concurrencia por tipo de upstream ("search" = Nuclia, "llm" = Anthropic)
+# Se activan por contexto: quien los fija (p. ej. /ask/batch) los hereda en todas las
+# tareas que crea, y los puntos de llamada solo hacen `async with gate("llm")`.
+# `hold` agrega algo que se toma recién con el turno obtenido (p. ej. el cupo de
+# admisión de los ítems de un lote). Sin límites fijados, gate() no hace nada.
+
+class RateLimiter:
+    """Espacia los arranques para no pasar de `per_minute` llamadas por minuto."""
+
+    def __init__(self, per_minute: float):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+class Limits:
+    def __init__(
+        self,
+        concurrency: Dict[str, int],
+        per_minute: Optional[Dict[str, float]] = None,
+        hold: Optional[Dict[str, Callable[[], AsyncContextManager[None]]]] = None,
+    ):
+        self._sems = {kind: asyncio.Semaphore(n) for kind, n in concurrency.items() if n > 0}
+        self._rates = {kind: RateLimiter(r) for kind, r in (per_minute or {}).items() if r > 0}
+        self._hold = dict(hold or {})
+        self.active: Dict[str, int] = {kind: 0 for kind in concurrency}
+
+    @asynccontextmanager
+    async def acquire(self, kind: str) -> AsyncIterator[None]:
+        sem = self._sems.get(kind)
+        if sem is not None:
+            await sem.acquire()
+        try:
+            rate = self._rates.get(kind)
+            if rate is not None:
+                await rate.wait()
+            hold = self._hold.get(kind)
+            async with (hold() if hold is not None else nullcontext()):
+                self.active[kind] = self.active.get(kind, 0) + 1
+                try:
+                    yield
+                finally:
+                    self.active[kind] -= 1
+        finally:
+            if sem is not None:
+                sem.release()
+
+_current: contextvars.ContextVar[Optional[Limits]] = contextvars.ContextVar("uvg_limits", default=None)
+
+def use_limits(limits: Optional[Limits]) -> contextvars.Token:
+    return _current.set(limits)
+
+def reset_limits(token: contextvars.Token) -> None:
+    _current.reset(token)
+
+@asynccontextmanager
+async def gate(kind: str) -> AsyncIterator[None]:
+    limits = _current.get()
+    if limits is None:
+        yield
+        return
+    async with limits.acquire(kind):
+        yield
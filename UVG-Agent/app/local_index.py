@@ -0,0 +1,467 @@
+# app/local_index.py
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .clients import get_http_client
+from .resilience import resilient
+from .rewriter import STOP_WORDS, light_stem
+from .text import normalize_question
+from .config import (
+    NUCLIA_API_BASE,
+    KB,
+    LOCAL_INDEX_PATH,
+    LOCAL_SEARCH_MODE,
+    LOCAL_INDEX_RELOAD_INTERVAL,
+)
+
+# ── Índice local BM25 (espejo de la KB de Nuclia)
+# `python -m app.local_index sync` baja todos los recursos y sus párrafos (texto, rid,
+# campo, página, offsets, título, URL de origen y etiquetas) y arma un índice invertido
+# BM25 en un solo archivo:
+#
+#   MAGIC | u32 largo de la cabecera | cabecera JSON | arreglos u32 little-endian
+#
+# La cabecera lleva el diccionario de términos (offset y df de sus postings), los
+# metadatos de cada párrafo y los recursos; los postings (doc, tf), el largo de cada
+# párrafo y el texto (UTF-8 + offsets) quedan en arreglos que se leen con mmap, sin
+# copiarlos a memoria. `LocalIndex.search` devuelve la misma forma que nuclia_search
+# (`paragraphs.results` + `resources`), así build_context y extract_sources_info no
+# distinguen el origen. LOCAL_SEARCH_MODE decide cómo se usa (ver nuclia.py):
+#   off       nunca
+#   fallback  solo si Nuclia falla y no hay búsqueda vencida en caché
+#   parallel  a la vez que Nuclia; se fusionan ambos resultados
+#   primary   primero el índice local; Nuclia solo si no encuentra nada
+# Es búsqueda léxica: la parte semántica sigue siendo de Nuclia.
+
+log = logging.getLogger("uvg.local_index")
+
+_MAGIC = b"UVGBM25\x01"
+_INDEX_VERSION = 1
+_K1 = 1.2
+_B = 0.75
+# Score normalizado = bm25 / (bm25 + _HALF * Σ idf de la consulta): un párrafo que
+# contiene una vez cada término (con largo promedio) queda en ~0.67, y el orden se mantiene
+_HALF = 0.5
+# Campos de un recurso de Nuclia -> prefijo del `field` en los resultados de /search
+_FIELD_TYPES = {"files": "f", "texts": "t", "links": "u", "generics": "a", "conversations": "c"}
+_SECTIONS = ("post_docs", "post_tfs", "doc_len", "text_offsets")
+
+local_totals: Counter = Counter()  # búsquedas por uso (primary | parallel | fallback) y resultado
+
+def terms(text: str) -> List[str]:
+    """Términos indexables: normalizados, sin stop words y con plurales reducidos."""
+    return [light_stem(w) for w in normalize_question(text).split() if len(w) > 1 and w not in STOP_WORDS]
+
+# ── Construcción
+def build_index(paragraphs: Iterable[Dict[str, Any]], resources: Dict[str, Dict[str, Any]]) -> bytes:
+    """
+    Párrafos {rid, field, text, page, start, end, index} + recursos {rid: {title, url, labels}}
+    -> contenido del archivo de índice.
+    """
+    rids: List[str] = []
+    rid_pos: Dict[str, int] = {}
+    fields: List[str] = []
+    field_pos: Dict[str, int] = {}
+    docs: List[list] = []
+    postings: Dict[str, List[Tuple[int, int]]] = {}
+    doc_len = array("I")
+    text_offsets = array("I", [0])
+    blob = bytearray()
+
+    for p in paragraphs:
+        text = (p.get("text") or "").strip()
+        tf = Counter(terms(text))
+        if not tf:
+            continue
+        rid, field = p.get("rid") or "", p.get("field") or ""
+        if rid not in rid_pos:
+            rid_pos[rid] = len(rids)
+            rids.append(rid)
+        if field not in field_pos:
+            field_pos[field] = len(fields)
+            fields.append(field)
+        doc = len(docs)
+        docs.append([rid_pos[rid], field_pos[field], p.get("page"), p.get("start"), p.get("end"), p.get("index")])
+        for term, n in tf.items():
+            postings.setdefault(term, []).append((doc, n))
+        doc_len.append(sum(tf.values()))
+        blob += text.encode("utf-8")
+        text_offsets.append(len(blob))
+
+    post_docs, post_tfs = array("I"), array("I")
+    dictionary: Dict[str, List[int]] = {}
+    for term in sorted(postings):
+        plist = postings[term]
+        dictionary[term] = [len(post_docs), len(plist)]
+        post_docs.extend(d for d, _n in plist)
+        post_tfs.extend(n for _d, n in plist)
+
+    arrays = {"post_docs": post_docs, "post_tfs": post_tfs, "doc_len": doc_len, "text_offsets": text_offsets}
+    if sys.byteorder == "big":
+        for arr in arrays.values():
+            arr.byteswap()
+
+    header = {
+        "version": _INDEX_VERSION,
+        "built_at": time.time(),
+        "kb": KB,
+        "n_docs": len(docs),
+        "avgdl": (sum(doc_len) / len(doc_len)) if doc_len else 0.0,
+        "rids": rids,
+        "fields": fields,
+        "docs": docs,
+        "terms": dictionary,
+        "resources": {rid: resources.get(rid) or {} for rid in rids},
+    }
+    # Offsets relativos al inicio de los datos (tras la cabecera, alineado a 4 bytes)
+    sections: Dict[str, List[int]] = {}
+    offset = 0
+    for name in _SECTIONS:
+        sections[name] = [offset, len(arrays[name])]
+        offset += 4 * len(arrays[name])
+    sections["text"] = [offset, len(blob)]
+    header["sections"] = sections
+
+    raw = json.dumps(header, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    out = bytearray(_MAGIC + struct.pack("<I", len(raw)) + raw)
+    out += b"\0" * (-len(out) % 4)
+    for name in _SECTIONS:
+        out += arrays[name].tobytes()
+    return bytes(out + blob)
+
+def write_index(path: str, data: bytes) -> None:
+    # Escritura atómica: el servidor nunca mapea un archivo a medias
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(data)
+    os.replace(tmp, path)
+
+# ── Lectura (mmap) y búsqueda
+class LocalIndex:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as fh:
+            self._mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if self._mm[: len(_MAGIC)] != _MAGIC:
+                raise ValueError(f"{path} no es un índice local UVG")
+            (size,) = struct.unpack_from("<I", self._mm, len(_MAGIC))
+            start = len(_MAGIC) + 4
+            header = json.loads(self._mm[start:start + size].decode("utf-8"))
+        except Exception:
+            self._mm.close()
+            raise
+        if header.get("version") != _INDEX_VERSION:
+            self._mm.close()
+            raise ValueError(f"Versión de índice local no soportada: {header.get('version')}")
+        self.built_at: float = header.get("built_at") or 0.0
+        self.kb: str = header.get("kb") or ""
+        self.n_docs: int = header["n_docs"]
+        self.avgdl: float = header["avgdl"] or 1.0
+        self.rids: List[str] = header["rids"]
+        self.fields: List[str] = header["fields"]
+        self.docs: List[list] = header["docs"]
+        self.terms: Dict[str, List[int]] = header["terms"]
+        self.resources: Dict[str, Dict[str, Any]] = header["resources"]
+        self._sections = header["sections"]
+        base = start + size + (-(start + size) % 4)
+        view = memoryview(self._mm)
+        self._views = [view]
+        arrays = {}
+        for name in _SECTIONS:
+            offset, count = self._sections[name]
+            part = view[base + offset:base + offset + 4 * count]
+            if sys.byteorder == "big":
+                arr = array("I", part.tobytes())  # el archivo es little-endian: copia invertida
+                arr.byteswap()
+                arrays[name] = arr
+            else:
+                arrays[name] = part.cast("I")
+                self._views.append(arrays[name])
+        self._post_docs = arrays["post_docs"]
+        self._post_tfs = arrays["post_tfs"]
+        self._doc_len = arrays["doc_len"]
+        self._text_offsets = arrays["text_offsets"]
+        self._text_start = base + self._sections["text"][0]
+
+    def close(self) -> None:
+        for v in reversed(self._views):
+            v.release()
+        self._views = []
+        self._mm.close()
+
+    def text(self, doc: int) -> str:
+        a, b = self._text_offsets[doc], self._text_offsets[doc + 1]
+        return self._mm[self._text_start + a:self._text_start + b].decode("utf-8")
+
+    def _labels_ok(self, rid: str, filters: Optional[List[str]]) -> bool:
+        if not filters:
+            return True
+        labels = set((self.resources.get(rid) or {}).get("labels") or ())
+        return all(f in labels for f in filters)
+
+    def search(
+        self,
+        query: str,
+        size: int = 20,
+        filters: Optional[List[str]] = None,
+        min_score: Optional[float] = None,
+    ) -> dict:
+        """BM25 sobre los párrafos; misma forma que la respuesta de /search de Nuclia."""
+        qtf = Counter(t for t in terms(query) if t in self.terms)
+        n = self.n_docs
+        scores: Dict[int, float] = {}
+        idf_sum = 0.0
+        for term, q in qtf.items():
+            offset, df = self.terms[term]
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            idf_sum += idf * q
+            for i in range(offset, offset + df):
+                doc, tf = self._post_docs[i], self._post_tfs[i]
+                norm = _K1 * (1 - _B + _B * self._doc_len[doc] / self.avgdl)
+                scores[doc] = scores.get(doc, 0.0) + q * idf * tf * (_K1 + 1) / (tf + norm)
+
+        results, resources = [], {}
+        if scores:
+            floor = min_score or 0.0
+            for doc, raw in sorted(scores.items(), key=lambda kv: kv[1], reverse=True):
+                score = raw / (raw + _HALF * idf_sum)
+                if score < floor:
+                    break
+                rid_i, field_i, page, start, end, index = self.docs[doc]
+                rid = self.rids[rid_i]
+                if not self._labels_ok(rid, filters):
+                    continue
+                field = self.fields[field_i]
+                position: Dict[str, Any] = {"page_number": page, "start": start, "end": end}
+                if index is not None:
+                    position["index"] = index
+                results.append({
+                    "rid": rid,
+                    "field": field,
+                    "field_type": field.split("/")[1] if field.count("/") >= 2 else "",
+                    "text": self.text(doc),
+                    "score": round(score, 4),
+                    "score_type": "BM25",
+                    "position": position,
+                })
+                if rid not in resources:
+                    info = self.resources.get(rid) or {}
+                    resources[rid] = {"id": rid, "title": info.get("title") or "", "origin": {"url": info.get("url") or ""}}
+                if len(results) >= size:
+                    break
+        return {
+            "paragraphs": {"results": results, "total": len(results), "page_number": 0, "page_size": size},
+            "resources": resources,
+            "local": {"engine": "bm25", "age_s": round(time.time() - self.built_at)},
+        }
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "kb": self.kb,
+            "paragraphs": self.n_docs,
+            "resources": len(self.rids),
+            "terms": len(self.terms),
+            "bytes": len(self._mm),
+            "built_at": self.built_at,
+        }
+
+# ── Índice activo con recarga en caliente (como el de FAQ)
+class LocalIndexStore:
+    def __init__(self, path: str, reload_interval: float):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.index: Optional[LocalIndex] = None
+        self.loaded_at: Optional[float] = None
+        self._mtime: Optional[float] = None
+        self._checked = -math.inf
+        self._lock = threading.Lock()
+
+    def _maybe_reload(self) -> None:
+        now = time.monotonic()
+        if now - self._checked < self.reload_interval:
+            return
+        with self._lock:
+            if now - self._checked < self.reload_interval:
+                return
+            self._checked = now
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                if self.index is not None:
+                    log.warning("Índice local: %s ya no existe; se desactiva", self.path)
+                self.index, self._mtime = None, None
+                return
+            if mtime == self._mtime:
+                return
+            try:
+                index = LocalIndex(self.path)
+            except Exception as e:
+                log.warning("Índice local: no se pudo cargar %s (%s); se mantiene el anterior", self.path, e)
+                return
+            # El mmap anterior no se cierra: puede haber búsquedas en curso sobre él,
+            # y se libera solo cuando deja de estar referenciado
+            self.index, self._mtime, self.loaded_at = index, mtime, time.time()
+            local_totals["reloads"] += 1
+
+    def get(self) -> Optional[LocalIndex]:
+        self._maybe_reload()
+        return self.index
+
+    def as_dict(self) -> Dict[str, Any]:
+        index = self.get()
+        return {
+            "mode": LOCAL_SEARCH_MODE,
+            "path": self.path,
+            "loaded": index is not None,
+            **(index.as_dict() if index is not None else {}),
+            "loaded_at": self.loaded_at,
+        }
+
+local_store: Optional[LocalIndexStore] = (
+    LocalIndexStore(LOCAL_INDEX_PATH, LOCAL_INDEX_RELOAD_INTERVAL)
+    if LOCAL_INDEX_PATH and LOCAL_SEARCH_MODE != "off" else None
+)
+
+def local_index() -> Optional[LocalIndex]:
+    return local_store.get() if local_store is not None else None
+
+def local_search(
+    query: str,
+    size: int = 20,
+    filters: Optional[List[str]] = None,
+    min_score: Optional[float] = None,
+    use: str = "direct",
+) -> Optional[dict]:
+    """Búsqueda en el índice local con la forma de nuclia_search; None si no hay índice."""
+    index = local_index()
+    if index is None:
+        return None
+    result = index.search(query, size=size, filters=filters, min_score=min_score)
+    result["local"]["use"] = use
+    local_totals[(use, "hit" if result["paragraphs"]["results"] else "miss")] += 1
+    return result
+
+def local_stats() -> Dict[str, Any]:
+    if local_store is None:
+        return {"mode": "off", "loaded": False}
+    searches: Dict[str, Dict[str, int]] = {}
+    for key, n in local_totals.items():
+        if isinstance(key, tuple):
+            searches.setdefault(key[0], {})[key[1]] = n
+    return {**local_store.as_dict(), "reloads": local_totals["reloads"], "searches": searches}
+
+# ── Sincronización desde Nuclia
+def _labels(resource: Dict[str, Any]) -> List[str]:
+    classes = (resource.get("usermetadata") or {}).get("classifications") or []
+    return [f"/classification.labels/{c.get('labelset')}/{c.get('label')}" for c in classes if c.get("labelset")]
+
+def resource_paragraphs(resource: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Párrafos de un recurso de Nuclia (`show=extracted`, texto + metadatos de cada campo)."""
+    rid = resource.get("id") or ""
+    out: List[Dict[str, Any]] = []
+    for kind, prefix in _FIELD_TYPES.items():
+        for field_id, field in ((resource.get("data") or {}).get(kind) or {}).items():
+            extracted = (field or {}).get("extracted") or {}
+            text = ((extracted.get("text") or {}).get("text")) or ""
+            meta = ((extracted.get("metadata") or {}).get("metadata")) or {}
+            paragraphs = meta.get("paragraphs") or []
+            name = f"/{prefix}/{field_id}"
+            if not paragraphs and text.strip():
+                paragraphs = [{"start": 0, "end": len(text)}]  # campo sin partir: un solo párrafo
+            for i, p in enumerate(paragraphs):
+                start, end = p.get("start") or 0, p.get("end") or len(text)
+                page = (p.get("page") or {}).get("page")
+                out.append({
+                    "rid": rid, "field": name, "text": text[start:end],
+                    "page": page, "start": start, "end": end, "index": i,
+                })
+    return out
+
+async def fetch_kb(concurrency: int = 8, page_size: int = 50) -> Tuple[List[dict], Dict[str, dict]]:
+    """Todos los recursos de la KB con sus párrafos; devuelve (párrafos, recursos)."""
+    http = get_http_client()
+    base = f"{NUCLIA_API_BASE}/kb/{KB}"
+
+    async def get(url: str, params: Dict[str, Any]) -> dict:
+        async def attempt() -> dict:
+            r = await http.get(url, params=params)
+            r.raise_for_status()
+            return r.json()
+        return await resilient("nuclia", attempt)
+
+    rids: List[str] = []
+    page = 0
+    while True:
+        listing = await get(f"{base}/resources", {"page": page, "size": page_size})
+        rids += [r["id"] for r in listing.get("resources") or [] if r.get("id")]
+        if (listing.get("pagination") or {}).get("last", True):
+            break
+        page += 1
+
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(rid: str) -> dict:
+        async with sem:
+            return await get(f"{base}/resource/{rid}", {
+                "show": ["basic", "origin", "extracted"], "extracted": ["text", "metadata"],
+            })
+
+    paragraphs: List[dict] = []
+    resources: Dict[str, dict] = {}
+    for res in await asyncio.gather(*(one(rid) for rid in rids)):
+        rid = res.get("id") or ""
+        resources[rid] = {
+            "title": res.get("title") or "",
+            "url": (res.get("origin") or {}).get("url") or "",
+            "labels": _labels(res),
+        }
+        paragraphs += resource_paragraphs(res)
+    return paragraphs, resources
+
+# ── CLI: sincronizar el índice y probar búsquedas
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Índice local BM25 espejo de la KB de Nuclia.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    s = sub.add_parser("sync", help="baja recursos y párrafos de Nuclia y reescribe el índice")
+    s.add_argument("-o", "--output", default=LOCAL_INDEX_PATH or "local_index.bin")
+    s.add_argument("-c", "--concurrency", type=int, default=8, help="recursos descargados a la vez")
+    q = sub.add_parser("search", help="muestra los mejores párrafos para una consulta")
+    q.add_argument("query")
+    q.add_argument("-n", "--size", type=int, default=5)
+    q.add_argument("--index", default=LOCAL_INDEX_PATH or "local_index.bin")
+    args = ap.parse_args()
+
+    if args.cmd == "sync":
+        t0 = time.perf_counter()
+        paragraphs, resources = asyncio.run(fetch_kb(args.concurrency))
+        data = build_index(paragraphs, resources)
+        write_index(args.output, data)
+        print(f"{len(resources)} recursos, {len(paragraphs)} párrafos, {len(data) / 1024:.0f} KiB "
+              f"-> {args.output} ({time.perf_counter() - t0:.1f} s)")
+    else:
+        index = LocalIndex(args.index)
+        t0 = time.perf_counter()
+        found = index.search(args.query, size=args.size)
+        us = (time.perf_counter() - t0) * 1e6
+        hits = found["paragraphs"]["results"]
+        print(f"{len(hits)} párrafos ({us:.0f} µs)")
+        for h in hits:
+            title = found["resources"][h["rid"]]["title"]
+            print(f"{h['score']:.3f}  {title} {h['field']} p.{h['position']['page_number']}: {h['text'][:100]}")
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,48 @@
 # app/main.py
 import os
+import time
+from contextlib import asynccontextmanager
+
 import httpx
-import requests
-from fastapi import FastAPI, HTTPException
+from typing import Optional
+
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 
-from .schemas import AskBody
-from .agent import ask_agent
-from .nuclia import nuclia_search, build_context
-from .config import CLAUDE_MODEL, KB, NUCLIA_API_BASE, HEADERS
+from .schemas import AskBody, BatchAskBody
+from .agent import ask_agent_async, format_paths, retrieval_paths
+from .llm import rewrite_engines
+from .streaming import ask_agent_stream, sse
+from .batch import ask_batch, batch_totals
+from .deadline import DEGRADATIONS, deadline_stats, degradation_totals
+from .resilience import CircuitOpen, breaker_states, is_upstream_error, retry_totals, stale_totals
+from .nuclia import nuclia_search_async, build_context, packing_totals
+from .clients import open_clients, close_clients
+from .cache import answer_cache_stats, invalidate_answers, search_cache_stats, invalidate_searches
+from .faq import faq_stats, faq_totals
+from .local_index import local_stats, local_totals
+from .federation import federation_stats, federation_totals
+from .rerank import rerank_totals
+from .files import invalidate_resources, resource_cache_stats, serve_resource
+from .models import model_stats, model_totals
+from .sessions import end_session, session_stats, session_totals
+from .admission import Overloaded, admission_stats, admission_totals, check_client, client_key
+from .tokens import VIOLATIONS, PROMPT_PARTS, governor_totals, prompt_totals, quota, token_stats, use_client
+from .responses import FastJSONResponse, dumps, json_response, shape_answer, shape_event
+from .metrics import CallbackCounter, CallbackGauge, TimingMiddleware, register, render_metrics
+from .config import CLAUDE_MODEL, KB, ADMIN_TOKEN
 
-app = FastAPI(title="Jack AI – Backend")
+# ---- Ciclo de vida: pool HTTP hacia Nuclia + AsyncAnthropic compartidos
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    await open_clients()
+    try:
+        yield
+    finally:
+        await close_clients()
+
+app = FastAPI(title="Jack AI – Backend", lifespan=lifespan, default_response_class=FastJSONResponse)
 
 # ---- CORS
 FRONT_ORIGIN = os.getenv(
@@ -27,34 +58,302 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ---- Server-Timing + histograma de latencia + log estructurado por request
+app.add_middleware(TimingMiddleware)
+
 # ---- Health
 @app.get("/health")
 def health():
-    return {"ok": True, "kb": KB}
+    # El servicio sigue arriba con un circuito abierto (sirve caché/FAQ), pero se indica
+    breakers = breaker_states()
+    return {
+        "ok": True,
+        "kb": KB,
+        "degraded": any(b["state"] != "closed" for b in breakers.values()),
+        "upstreams": breakers,
+    }
+
+def _ask_params(body: AskBody) -> dict:
+    return dict(
+        question=body.query,
+        size=body.size or 30,
+        max_chunks=body.max_chunks or 20,
+        use_semantic=True if body.use_semantic is None else body.use_semantic,
+        min_score=body.min_score or 0.0,
+        deadline=body.deadline,
+    )
+
+def _nuclia_error_detail(e: httpx.HTTPStatusError) -> str:
+    status = getattr(e.response, "status_code", 502)
+    detail = (getattr(e.response, "text", "") or str(e))[:800]
+    return f"Error consultando Nuclia ({status}): {detail}"
+
+# ---- Control de admisión: 429 por cliente / 503 por saturación, siempre con Retry-After
+def _reject(e) -> HTTPException:
+    # Overloaded (429/503) o CircuitOpen (503): ambos con Retry-After
+    return HTTPException(status_code=getattr(e, "status", 503), detail=str(e), headers=e.headers)
+
+def _admit_client(request: Request, cost: float = 1.0) -> None:
+    client = client_key(request.headers, request.client.host if request.client else None)
+    try:
+        check_client(client, cost)
+    except Overloaded as e:
+        raise _reject(e)
+    use_client(client)  # los tokens de este request cuentan para la cuota del cliente
 
 # ---- Ask (usa tu pipeline existente)
 @app.post("/ask")
-def ask(body: AskBody):
+async def ask(body: AskBody, request: Request):
+    _admit_client(request)
     try:
-        return ask_agent(
-            question=body.query,
-            size=body.size or 30,
-            max_chunks=body.max_chunks or 20,
-            use_semantic=True if body.use_semantic is None else body.use_semantic,
-            min_score=body.min_score or 0.0,
-        )
-    except requests.HTTPError as e:
-        status = getattr(e.response, "status_code", 502)
-        detail = (getattr(e.response, "text", "") or str(e))[:800]
-        raise HTTPException(status_code=502, detail=f"Error consultando Nuclia ({status}): {detail}")
+        result = await ask_agent_async(**_ask_params(body), session_id=body.session_id)
+    except (Overloaded, CircuitOpen) as e:
+        raise _reject(e)
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=502, detail=_nuclia_error_detail(e))
     except Exception as e:
+        if is_upstream_error(e):
+            # Claude/Nuclia siguieron fallando tras los reintentos y no hay respuesta vencida
+            raise HTTPException(status_code=502, detail=f"Error en upstream: {e}")
         raise HTTPException(status_code=500, detail=f"Error interno: {e}")
+    # Sin search_results salvo verbosity=debug; orjson directo y comprimido si es grande
+    return json_response(
+        shape_answer(result, body.verbosity, body.source_text),
+        request.headers.get("accept-encoding", ""),
+    )
+
+# ---- Ask en streaming (SSE): event sources → event token* → event done
+def _stream_error(e: BaseException) -> str:
+    if isinstance(e, CircuitOpen):
+        return sse("error", {"detail": str(e), "retry_after": e.retry_after})
+    if isinstance(e, httpx.HTTPStatusError):
+        return sse("error", {"detail": _nuclia_error_detail(e)})
+    return sse("error", {"detail": f"Error interno: {e}"})
+
+@app.post("/ask/stream")
+async def ask_stream(body: AskBody, request: Request):
+    _admit_client(request)
+    stream = ask_agent_stream(**_ask_params(body), session_id=body.session_id)
+    # El primer evento llega después de pedir cupo: si no hay, 503 antes de abrir el stream
+    first, failure = None, None
+    try:
+        first = await stream.__anext__()
+    except (Overloaded, CircuitOpen) as e:
+        raise _reject(e)
+    except StopAsyncIteration:
+        pass
+    except Exception as e:
+        failure = e
+
+    async def events():
+        if failure is not None:
+            yield _stream_error(failure)
+            return
+        if first is None:
+            return
+        yield sse(first[0], shape_event(*first, body.verbosity, body.source_text))
+        try:
+            async for event, data in stream:
+                yield sse(event, shape_event(event, data, body.verbosity, body.source_text))
+        except Exception as e:
+            yield _stream_error(e)
+        finally:
+            await stream.aclose()  # libera el cupo si el cliente se desconecta
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# ---- Lote de preguntas: NDJSON, una línea por ítem en cuanto termina + resumen final
+def _error_payload(e: BaseException) -> dict:
+    if isinstance(e, Overloaded):
+        return {**e.as_dict(), "detail": str(e)}
+    if isinstance(e, CircuitOpen):
+        return {"status": 503, "retry_after": e.retry_after, "detail": str(e)}
+    if isinstance(e, httpx.HTTPStatusError):
+        return {"status": 502, "detail": _nuclia_error_detail(e)}
+    return {"status": 500, "detail": f"Error interno: {e}"}
+
+@app.post("/ask/batch")
+async def ask_batch_endpoint(body: BatchAskBody, request: Request):
+    # Cada ítem cuenta contra la tasa del cliente (hasta el tamaño de la ráfaga)
+    _admit_client(request, cost=len(body.items))
+    items = [_ask_params(item) for item in body.items]
+
+    async def lines():
+        t0 = time.perf_counter()
+        unique = errors = 0
+        async for indices, result in ask_batch(items):
+            unique += 1
+            failed = isinstance(result, BaseException)
+            errors += len(indices) if failed else 0
+            for i in indices:
+                line = {"index": i, "query": items[i]["question"], "ok": not failed}
+                if failed:
+                    line["error"] = _error_payload(result)
+                else:
+                    line["result"] = shape_answer(result, body.items[i].verbosity, body.items[i].source_text)
+                yield dumps(line) + b"\n"
+        yield dumps({
+            "summary": {
+                "items": len(items),
+                "unique": unique,
+                "errors": errors,
+                "elapsed_ms": round((time.perf_counter() - t0) * 1000, 1),
+            }
+        }) + b"\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+# ---- Administración de cachés (respuestas + búsquedas Nuclia)
+def require_admin(x_admin_token: Optional[str] = Header(default=None)):
+    if ADMIN_TOKEN and x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Token de administración inválido")
+
+@app.get("/cache/stats")
+def cache_stats():
+    return {"answers": answer_cache_stats(), "search": search_cache_stats(), "resources": resource_cache_stats()}
+
+@app.post("/cache/invalidate", dependencies=[Depends(require_admin)])
+def cache_invalidate():
+    # Llamar después de actualizar la KB en Nuclia
+    return {
+        "answers_removed": invalidate_answers(),
+        "searches_removed": invalidate_searches(),
+        "resources_removed": invalidate_resources(),
+    }
+
+# ---- Qué camino de búsqueda ganó (especulativo vs secuencial) y qué motor reescribió
+@app.get("/stats/retrieval")
+def retrieval_stats():
+    return {
+        "paths": dict(retrieval_paths),
+        "rewrite_engines": dict(rewrite_engines),
+        "packing": dict(packing_totals),
+        "rerank": dict(rerank_totals),
+        "batch": dict(batch_totals),
+        "deadline": deadline_stats(),
+    }
+
+# ---- FAQ precalculadas: índice cargado y hits/misses
+@app.get("/stats/faq")
+def faq_stats_endpoint():
+    return faq_stats()
+
+# ---- Búsqueda federada: KB configuradas, sus breakers y resultados por KB
+@app.get("/stats/kbs")
+def kbs_stats_endpoint():
+    return federation_stats()
+
+# ---- Índice local BM25: modo, tamaño, antigüedad y búsquedas por uso
+@app.get("/stats/local-index")
+def local_index_stats_endpoint():
+    return local_stats()
+
+# ---- Control de admisión: cupos en uso, profundidad de la cola y rechazos
+# (async: el controlador vive en el event loop de la app)
+@app.get("/stats/admission")
+async def admission_stats_endpoint():
+    return admission_stats()
+
+# ---- Sesiones multi-turno: cuántas hay, turnos por modo y cierre explícito
+@app.get("/stats/sessions")
+def sessions_stats_endpoint():
+    return session_stats()
+
+@app.delete("/sessions/{session_id}")
+def delete_session(session_id: str):
+    if not end_session(session_id):
+        raise HTTPException(status_code=404, detail="Sesión no encontrada o vencida")
+    return {"ok": True}
+
+# ---- Router de modelos: tiers configurados y llamadas por tier/resultado
+@app.get("/stats/models")
+def models_stats_endpoint():
+    return model_stats()
+
+# ---- Tokens: presupuestos, cuota del día, reparto del prompt y violaciones
+@app.get("/stats/tokens")
+def tokens_stats_endpoint():
+    return token_stats()
+
+# ---- Cuántas respuestas necesitaron reformateo y por qué camino (local vs LLM)
+@app.get("/stats/format")
+def format_stats():
+    return {"paths": dict(format_paths)}
+
+# ---- Métricas Prometheus
+def _by_label(counter) -> dict:
+    return {(str(k),): v for k, v in dict(counter).items()}
+
+def _cache_counts(kind: str) -> dict:
+    out = {}
+    for name, stats in (
+        ("answers", answer_cache_stats()),
+        ("search", search_cache_stats()),
+        ("resources", resource_cache_stats()),
+    ):
+        if kind in stats:
+            out[(name,)] = stats[kind]
+    return out
+
+register(CallbackCounter("uvg_retrieval_path_total", "Camino de búsqueda usado", ("path",), lambda: _by_label(retrieval_paths)))
+register(CallbackCounter("uvg_rewrite_engine_total", "Motor de reescritura usado", ("engine",), lambda: _by_label(rewrite_engines)))
+register(CallbackCounter("uvg_rerank_removed_total", "Párrafos y tokens que el reranker local sacó del prompt", ("kind",),
+                         lambda: {("chunks",): rerank_totals["removed_chunks"], ("tokens",): rerank_totals["removed_tokens"]}))
+register(CallbackCounter("uvg_prompt_tokens_total", "Input de la generación atribuido por parte del prompt", ("part",),
+                         lambda: {(k,): prompt_totals[k] for k in PROMPT_PARTS}))
+register(CallbackCounter("uvg_token_violations_total", "Violaciones de presupuesto y cuota de tokens", ("kind",),
+                         lambda: {(k,): governor_totals[k] for k in VIOLATIONS}))
+register(CallbackCounter("uvg_prompt_trimmed_tokens_total", "Tokens de contexto recortados por el presupuesto del prompt", (),
+                         lambda: {(): governor_totals["trimmed_tokens"]}))
+register(CallbackGauge("uvg_daily_tokens_used", "Tokens consumidos hoy (cuota diaria)", (), lambda: {(): quota.total()}))
+register(CallbackCounter("uvg_format_path_total", "Camino de reformateo del esquema", ("path",), lambda: _by_label(format_paths)))
+register(CallbackCounter("uvg_faq_total", "Consultas al índice de FAQ", ("result",),
+                         lambda: {(k,): faq_totals[k] for k in ("hits", "misses")}))
+register(CallbackCounter("uvg_degradations_total", "Degradaciones aplicadas por falta de plazo", ("degradation",),
+                         lambda: {(k,): degradation_totals[k] for k in DEGRADATIONS}))
+register(CallbackCounter("uvg_upstream_retries_total", "Reintentos hacia upstreams", ("upstream",), lambda: _by_label(retry_totals)))
+register(CallbackCounter("uvg_stale_served_total", "Respuestas/búsquedas vencidas servidas por fallo del upstream", ("kind",),
+                         lambda: _by_label(stale_totals)))
+register(CallbackGauge("uvg_circuit_open", "Circuito del upstream abierto (1) o cerrado (0)", ("upstream",),
+                       lambda: {(k,): int(v["state"] != "closed") for k, v in breaker_states().items()}))
+register(CallbackCounter("uvg_model_calls_total", "Generaciones por tier de modelo y resultado", ("tier", "outcome"),
+                         lambda: dict(model_totals)))
+register(CallbackCounter("uvg_kb_search_total", "Búsquedas por KB federada y resultado", ("kb", "result"),
+                         lambda: dict(federation_totals)))
+register(CallbackCounter("uvg_local_search_total", "Búsquedas en el índice local por uso y resultado", ("use", "result"),
+                         lambda: {k: v for k, v in local_totals.items() if isinstance(k, tuple)}))
+register(CallbackCounter("uvg_session_turns_total", "Turnos de sesión por modo de recuperación", ("mode",),
+                         lambda: _by_label(session_totals)))
+register(CallbackCounter("uvg_cache_hits_total", "Hits de caché", ("cache",), lambda: _cache_counts("hits")))
+register(CallbackCounter("uvg_cache_misses_total", "Misses de caché", ("cache",), lambda: _cache_counts("misses")))
+register(CallbackCounter("uvg_context_tokens_saved_total", "Tokens ahorrados por el empaquetado de contexto", (),
+                         lambda: {(): packing_totals["baseline_tokens"] - packing_totals["tokens"]}))
+
+def _admission_gauge(field: str) -> dict:
+    llm = admission_stats()["llm"]
+    return {(): llm[field]} if field in llm else {}
+
+register(CallbackCounter("uvg_admission_total", "Decisiones del control de admisión", ("result",),
+                         lambda: {(k,): admission_totals[k] for k in
+                                  ("admitted", "queued", "queued_patient", "shed_queue_full", "shed_timeout", "rate_limited")}))
+register(CallbackGauge("uvg_admission_queue_depth", "Preguntas esperando cupo de generación", (),
+                       lambda: _admission_gauge("queued")))
+register(CallbackGauge("uvg_admission_active", "Generaciones con Claude en curso", (),
+                       lambda: _admission_gauge("active")))
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
 
 # ---- (Opcional) Endpoint de búsqueda directa a Nuclia para debug
 @app.get("/search")
-def search(query: str, size: int = 20, min_score: float = 0.0):
+async def search(query: str, size: int = 20, min_score: float = 0.0):
     try:
-        data = nuclia_search(query=query, size=size, min_score=min_score)
+        data = await nuclia_search_async(query=query, size=size, min_score=min_score)
         # también te regreso un contexto ensamblado por si lo quieres ver
         context = build_context(data, max_chunks=20)
         return {"raw": data, "context": context}
@@ -63,27 +362,20 @@ def search(query: str, size: int = 20, min_score: float = 0.0):
 
 # ---- 🔥 Nuevo: proxy/stream del archivo original (PDF u otros)
 @app.get("/resources/{rid}/file")
-async def resource_file(rid: str):
+async def resource_file(
+    rid: str,
+    kb: Optional[str] = Query(default=None),
+    range: Optional[str] = Header(default=None),
+    if_none_match: Optional[str] = Header(default=None),
+):
     """
     Sirve el archivo original del recurso de Nuclia en streaming.
     Esto evita exponer el token en el frontend y pone el Content-Type correcto (application/pdf).
+    Soporta Range (206) para que el visor pida páginas bajo demanda, ETag/If-None-Match,
+    y guarda los archivos más pedidos en una caché LRU en disco.
+    Con búsqueda federada, `kb` es el id de la KB del recurso (el `kb` de cada fuente).
     """
-    # Ajusta el path al de "download/original" que use tu tenant (según Nuclia)
-    url = f"{NUCLIA_API_BASE}/kb/{KB}/resource/{rid}/file/original"
-    headers = {**HEADERS}  # HEADERS = {"x-api-key": "<token>"}
-    timeout = httpx.Timeout(60.0, connect=20.0)
-
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        r = await client.get(url, headers=headers)
-        if r.status_code != 200:
-            raise HTTPException(status_code=r.status_code, detail=r.text)
-
-        media_type = r.headers.get("content-type", "application/octet-stream")
-        # Forzar inline para que el navegador lo pueda mostrar
-        dispo = r.headers.get("content-disposition", f'inline; filename="{rid}.pdf"')
-
-        return StreamingResponse(
-            r.aiter_bytes(),
-            media_type=media_type,
-            headers={"Content-Disposition": dispo},
-        )
+    try:
+        return await serve_resource(rid, range_header=range, if_none_match=if_none_match, kb=kb)
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail=f"Error descargando el recurso de Nuclia: {e}")
@@ -0,0 +1,239 @@
+# app/metrics.py
+from __future__ import annotations
+import contextvars
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from .tokens import charge
+from .config import REQUEST_LOG
+
+# ── Instrumentación del hot path
+# Spans por etapa (contextvar por request), cabecera Server-Timing, una línea de log
+# estructurada por request y exposición en formato Prometheus sin dependencias extra.
+
+log = logging.getLogger("uvg.request")
+if REQUEST_LOG:
+    log.setLevel(logging.INFO)
+    if not log.handlers:
+        log.addHandler(logging.StreamHandler())
+
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = list(self._values.items())
+        out += [f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in items]
+        return out
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=_LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames, self.buckets = name, help, labelnames, buckets
+        self._series: Dict[Tuple[str, ...], list] = {}  # key -> [counts por bucket..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._series.items()]
+        names = self.labelnames + ("le",)
+        for key, series in items:
+            for bound, count in zip(self.buckets, series):
+                out.append(f"{self.name}_bucket{_labels(names, key + (repr(bound),))} {count}")
+            out.append(f"{self.name}_bucket{_labels(names, key + ('+Inf',))} {series[-1]}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, key)} {series[-2]}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, key)} {series[-1]}")
+        return out
+
+class CallbackCounter:
+    """Contador cuyo valor se lee al exportar (p.ej. los Counter de collections del pipeline)."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...], fn: Callable[[], Dict[Tuple[str, ...], float]]):
+        self.name, self.help, self.labelnames, self.fn = name, help, labelnames, fn
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        out += [f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in self.fn().items()]
+        return out
+
+class CallbackGauge(CallbackCounter):
+    """Valor instantáneo leído al exportar (p.ej. profundidad de una cola)."""
+
+    kind = "gauge"
+
+_registry: List[Any] = []
+
+def register(metric):
+    _registry.append(metric)
+    return metric
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+STAGE_LATENCY = register(Histogram("uvg_stage_latency_seconds", "Latencia por etapa del pipeline", ("stage",)))
+REQUEST_LATENCY = register(Histogram("uvg_request_latency_seconds", "Latencia total por endpoint", ("path", "status")))
+UPSTREAM_ERRORS = register(Counter("uvg_upstream_errors_total", "Errores de Nuclia/Anthropic", ("upstream", "error")))
+LLM_TOKENS = register(Counter("uvg_llm_tokens_total", "Tokens reportados en usage de Anthropic", ("stage", "type")))
+MODEL_LATENCY = register(Histogram("uvg_model_latency_seconds", "Latencia de la generación por tier de modelo", ("tier",)))
+MODEL_TOKENS = register(Counter("uvg_model_tokens_total", "Tokens de la generación por tier de modelo", ("tier", "type")))
+
+# ── Spans por request
+class RequestTimer:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages: Dict[str, float] = {}  # etapa -> ms acumulados
+        self.usage: Dict[str, Dict[str, int]] = {}  # etapa -> tokens por tipo (usage de Anthropic)
+
+    def add(self, stage: str, ms: float) -> None:
+        self.stages[stage] = self.stages.get(stage, 0.0) + ms
+
+    def add_usage(self, stage: str, kind: str, n: int) -> None:
+        counts = self.usage.setdefault(stage, {})
+        counts[kind] = counts.get(kind, 0) + n
+
+    def usage_dict(self) -> Dict[str, Dict[str, int]]:
+        return {stage: dict(counts) for stage, counts in self.usage.items()}
+
+    def total_ms(self) -> float:
+        return (time.perf_counter() - self.start) * 1000
+
+    def as_dict(self) -> Dict[str, float]:
+        out = {k: round(v, 1) for k, v in self.stages.items()}
+        out["total"] = round(self.total_ms(), 1)
+        return out
+
+    def server_timing(self) -> str:
+        parts = [f"{k};dur={v:.1f}" for k, v in self.stages.items()]
+        parts.append(f"total;dur={self.total_ms():.1f}")
+        return ", ".join(parts)
+
+_current: contextvars.ContextVar[Optional[RequestTimer]] = contextvars.ContextVar("uvg_request_timer", default=None)
+
+def current_timer() -> Optional[RequestTimer]:
+    return _current.get()
+
+def ensure_timer() -> RequestTimer:
+    """Timer del request actual; si no hay (API síncrona, scripts), crea uno para esta tarea."""
+    timer = _current.get()
+    if timer is None:
+        timer = RequestTimer()
+        _current.set(timer)
+    return timer
+
+def start_timer() -> RequestTimer:
+    """Timer nuevo para la tarea actual (p. ej. cada ítem de /ask/batch)."""
+    timer = RequestTimer()
+    _current.set(timer)
+    return timer
+
+@contextmanager
+def span(stage: str, upstream: Optional[str] = None) -> Iterator[None]:
+    """Mide una etapa (sirve en código sync y dentro de corrutinas) y cuenta errores del upstream."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        if upstream:
+            count_error(upstream, e)
+        raise
+    finally:
+        elapsed = time.perf_counter() - t0
+        STAGE_LATENCY.observe(elapsed, stage=stage)
+        timer = _current.get()
+        if timer is not None:
+            timer.add(stage, elapsed * 1000)
+
+def count_error(upstream: str, exc: BaseException) -> None:
+    UPSTREAM_ERRORS.inc(upstream=upstream, error=type(exc).__name__)
+
+def record_usage(stage: str, usage: Any, tier: Optional[str] = None) -> None:
+    """Tokens de una llamada a Claude (incluye escritura/lectura de la caché de prompts); cuentan para la cuota diaria."""
+    if usage is None:
+        return
+    timer = _current.get()
+    for kind in ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens"):
+        n = getattr(usage, kind, None)
+        if n:
+            charge(stage, n)
+            LLM_TOKENS.inc(n, stage=stage, type=kind)
+            if tier is not None:
+                MODEL_TOKENS.inc(n, tier=tier, type=kind)
+            if timer is not None:
+                timer.add_usage(stage, kind, n)
+
+# ── Middleware ASGI: Server-Timing + latencia total + log estructurado
+class TimingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timer = RequestTimer()
+        token = _current.set(timer)
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timer.server_timing().encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            # Ruta plantilla (/resources/{rid}/file) para no disparar la cardinalidad
+            path = getattr(scope.get("route"), "path", None) or "unmatched"
+            REQUEST_LATENCY.observe(timer.total_ms() / 1000, path=path, status=status["code"])
+            if log.isEnabledFor(logging.INFO):
+                log.info(json.dumps({
+                    "method": scope.get("method"),
+                    "path": path,
+                    "status": status["code"],
+                    "timing_ms": timer.as_dict(),
+                    **({"llm_usage": timer.usage} if timer.usage else {}),
+                }, ensure_ascii=False))
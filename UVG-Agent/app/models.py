@@ -0,0 +1,141 @@
+# app/models.py
+from __future__ import annotations
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from .resilience import CircuitOpen, is_overloaded, resilient
+from .clients import get_async_llm
+from .metrics import MODEL_LATENCY, record_usage
+from .tokens import output_cap
+from .config import (
+    CLAUDE_MODEL,
+    MAX_TOKENS,
+    MODEL_ROUTING,
+    FAST_MODEL,
+    FAST_MAX_TOKENS,
+    FAST_MAX_WORDS,
+    FAST_MIN_SCORE,
+    FAST_MAX_PARAGRAPHS,
+    MODEL_FALLBACK,
+)
+
+# ── Router de modelos
+# La generación elige entre dos tiers con señales que el pipeline ya tiene:
+#   - fast: FAST_MODEL con FAST_MAX_TOKENS, para consultas puntuales de la UVG
+#   - full: CLAUDE_MODEL con MAX_TOKENS, en cuanto aparece cualquier señal de dificultad
+# Señales que mandan al tier completo (quedan en meta.model.reasons):
+#   structured        la pregunta pide el esquema Markdown (palabras de `_needs_fix`)
+#   long_question     más de FAST_MAX_WORDS palabras
+#   unknown_intent    el router de intenciones no la reconoce como tema UVG
+#   weak_retrieval    hay párrafos pero ninguno llega a FAST_MIN_SCORE
+#   broad_context     más de FAST_MAX_PARAGRAPHS párrafos fuertes: hay que sintetizar
+# Si el tier elegido responde overloaded (429/503/529) se pasa una vez al otro tier.
+# La reescritura y el reformateo no pasan por aquí: siguen con CLAUDE_MODEL.
+
+@dataclass(frozen=True)
+class Tier:
+    name: str
+    model: str
+    max_tokens: int
+
+TIERS: Dict[str, Tier] = {
+    "fast": Tier("fast", FAST_MODEL, FAST_MAX_TOKENS),
+    "full": Tier("full", CLAUDE_MODEL, MAX_TOKENS),
+}
+
+# Llamadas por (tier, resultado): ok | overloaded | error
+model_totals: Counter = Counter()
+
+def routing_enabled() -> bool:
+    return MODEL_ROUTING and bool(FAST_MODEL) and FAST_MODEL != CLAUDE_MODEL
+
+@dataclass
+class ModelChoice:
+    tier: Tier
+    reasons: List[str] = field(default_factory=list)
+    fallback_from: Optional[str] = None
+
+    def fallback(self, exc: BaseException) -> bool:
+        """Ante un overloaded, cambia al otro tier (una sola vez). ¿Hay que reintentar?"""
+        if (not MODEL_FALLBACK or not routing_enabled() or self.fallback_from is not None
+                or isinstance(exc, CircuitOpen) or not is_overloaded(exc)):
+            return False
+        self.fallback_from = self.tier.name
+        self.tier = TIERS["full" if self.tier.name == "fast" else "fast"]
+        return True
+
+    @property
+    def can_fallback(self) -> bool:
+        return MODEL_FALLBACK and routing_enabled() and self.fallback_from is None
+
+    def as_dict(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"tier": self.tier.name, "model": self.tier.model, "reasons": self.reasons}
+        if self.fallback_from is not None:
+            out["fallback_from"] = self.fallback_from
+        return out
+
+def choose_tier(question: str, intent: str, paragraphs: List[dict], structured: bool) -> ModelChoice:
+    """`paragraphs`: los párrafos que entraron al contexto (con su `score`)."""
+    if not routing_enabled():
+        return ModelChoice(TIERS["full"], ["routing_off"])
+    reasons: List[str] = []
+    if structured:
+        reasons.append("structured")
+    if len(question.split()) > FAST_MAX_WORDS:
+        reasons.append("long_question")
+    if intent != "uvg":
+        reasons.append("unknown_intent")
+    if paragraphs:
+        strong = sum(1 for p in paragraphs if (p.get("score") or 0.0) >= FAST_MIN_SCORE)
+        if not strong:
+            reasons.append("weak_retrieval")
+        elif strong > FAST_MAX_PARAGRAPHS:
+            reasons.append("broad_context")
+    return ModelChoice(TIERS["full" if reasons else "fast"], reasons)
+
+def observe_call(tier: Tier, seconds: float, outcome: str, usage: Any = None) -> None:
+    model_totals[(tier.name, outcome)] += 1
+    if outcome == "ok":
+        MODEL_LATENCY.observe(seconds, tier=tier.name)
+    record_usage("generation", usage, tier=tier.name)
+
+async def create_message(choice: ModelChoice, **request: Any) -> Any:
+    """
+    `messages.create` con el modelo y max_tokens del tier elegido. Un overloaded en el
+    primer tier no se reintenta ahí: se pasa directo al otro (que sí reintenta).
+    """
+    llm = get_async_llm()
+    while True:
+        tier = choice.tier
+        t0 = time.perf_counter()
+        try:
+            resp = await resilient(
+                "anthropic",
+                lambda: llm.messages.create(model=tier.model, max_tokens=output_cap(tier.max_tokens), **request),
+                retry_if=(lambda e: not is_overloaded(e)) if choice.can_fallback else None,
+            )
+        except Exception as e:
+            model_totals[(tier.name, "overloaded" if is_overloaded(e) else "error")] += 1
+            if choice.fallback(e):
+                continue
+            raise
+        observe_call(tier, time.perf_counter() - t0, "ok", getattr(resp, "usage", None))
+        return resp
+
+def model_stats() -> Dict[str, Any]:
+    calls: Dict[str, Dict[str, int]] = {}
+    for (tier, outcome), n in model_totals.items():
+        calls.setdefault(tier, {})[outcome] = n
+    return {
+        "routing": routing_enabled(),
+        "fallback": MODEL_FALLBACK,
+        "tiers": {name: {"model": t.model, "max_tokens": output_cap(t.max_tokens)} for name, t in TIERS.items()},
+        "thresholds": {
+            "max_words": FAST_MAX_WORDS,
+            "min_score": FAST_MIN_SCORE,
+            "max_paragraphs": FAST_MAX_PARAGRAPHS,
+        },
+        "calls": calls,
+    }
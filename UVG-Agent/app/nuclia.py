@@ -1,9 +1,23 @@
-import requests
-from .config import NUCLIA_API_BASE, KB, HEADERS
-from typing import Optional, List, Dict, Any
+import asyncio
+import json
+import time
+from collections import Counter
+
+import httpx
+
+from .config import NUCLIA_API_BASE, KB, SEARCH_CACHE_TTL, LOCAL_SEARCH_MODE
+from .clients import get_http_client, run_sync
+from .cache import search_cache, search_flight
+from .text import estimate_tokens, normalize_question
+from .limits import gate
+from .local_index import local_index, local_search
+from .federation import KbTarget, federated, federation_totals, route_kbs, rrf_merge, select_targets, targets
+from .metrics import count_error, span
+from .resilience import is_upstream_error, resilient, stale_totals
+from typing import Optional, List, Dict, Any, Awaitable, Tuple
 
 # ── Búsqueda Nuclia mejorada
-def nuclia_search(
+async def nuclia_search_async(
     query: str, 
     size: int = 20,
     features: Optional[List[str]] = None,
@@ -11,7 +25,8 @@ def nuclia_search(
     faceted: Optional[List[str]] = None,
     sort: Optional[str] = None,
     min_score: Optional[float] = None,
-    vectorset: str = "multilingual-2024-05-06"
+    vectorset: str = "multilingual-2024-05-06",
+    kbs: Optional[List[str]] = None,
 ) -> dict:
     """
     Búsqueda mejorada en Nuclia con múltiples opciones.
@@ -25,8 +40,226 @@ def nuclia_search(
         sort: Ordenamiento ('created', 'modified', 'score')
         min_score: Score mínimo para resultados (0.0-1.0)
         vectorset: Conjunto de vectores para búsqueda semántica
+        kbs: Con KBS_PATH, nombres de las KB a consultar (None = según las sedes de `query`)
     """
-    url = f"{NUCLIA_API_BASE}/kb/{KB}/search"
+    search_args = (size, features, filters, faceted, sort, min_score, vectorset)
+
+    def remote() -> Awaitable[dict]:
+        if federated():
+            return _federated_search(query, route_kbs(query) if kbs is None else kbs, *search_args)
+        url, params = _search_params(query, *search_args)
+        key = json.dumps([url, params], sort_keys=True, ensure_ascii=False)
+        return _remote_search(key, url, params)
+
+    with span("nuclia_search"):
+        mode = LOCAL_SEARCH_MODE if local_index() is not None else "off"
+        local_kw = {"size": size, "filters": filters, "min_score": min_score}
+        if mode == "primary":
+            found = local_search(query, use="primary", **local_kw)
+            if found is not None and found["paragraphs"]["results"]:
+                return found
+        elif mode == "parallel":
+            # El índice local responde mientras la petición a Nuclia está en vuelo: el
+            # sleep(0) deja que la tarea la envíe antes de la búsqueda local (síncrona)
+            pending = asyncio.ensure_future(remote())
+            await asyncio.sleep(0)
+            try:
+                found = local_search(query, use="parallel", **local_kw)
+                data = await pending
+            except Exception as e:
+                pending.cancel()
+                if not is_upstream_error(e) or found is None or not found["paragraphs"]["results"]:
+                    raise
+                return {**found, "local": {**found["local"], "reason": type(e).__name__}}
+            if found is None:
+                return data
+            merged = merge_searches(_scaled(data), _scaled(found))
+            merged["paragraphs"]["results"] = merged["paragraphs"]["results"][:size]
+            return {**merged, "local": found["local"]}
+
+        try:
+            return await remote()
+        except Exception as e:
+            # Sin búsqueda vencida en caché: el índice local, si está habilitado como respaldo
+            found = local_search(query, use="fallback", **local_kw) \
+                if mode == "fallback" and is_upstream_error(e) else None
+            if found is None or not found["paragraphs"]["results"]:
+                raise
+            return {**found, "local": {**found["local"], "reason": type(e).__name__}}
+
+def _stale_entry(key: str, exc: BaseException) -> Optional[dict]:
+    # Nuclia caído o circuito abierto: lo último bueno de la caché, marcado como vencido
+    entry = search_cache.get_stale(key) if search_cache is not None and is_upstream_error(exc) else None
+    if entry is None:
+        return None
+    stale_totals["search"] += 1
+    return {**entry["data"], "stale": {"age_s": round(time.time() - entry["at"]), "reason": type(exc).__name__}}
+
+async def _remote_search(
+    key: str,
+    url: str,
+    params: Dict[str, Any],
+    upstream: str = "nuclia",
+    headers: Optional[Dict[str, str]] = None,
+) -> dict:
+    """Nuclia con caché (stale-while-revalidate) y, si falla, lo último bueno vencido."""
+    if search_cache is not None:
+        entry = search_cache.get(key)
+        if entry is not None:
+            # Stale-while-revalidate: se sirve lo que hay y se refresca en segundo plano
+            if time.time() - entry["at"] >= SEARCH_CACHE_TTL:
+                search_cache.stats.incr("stale")
+                _revalidate(key, url, params, upstream, headers)
+            return entry["data"]
+
+    try:
+        return await search_flight.do(key, lambda: _fetch_search(key, url, params, upstream, headers))
+    except Exception as e:
+        stale = _stale_entry(key, e)
+        if stale is None:
+            raise
+        return stale
+
+_background: set = set()
+
+def _revalidate(key: str, url: str, params: Dict[str, Any], upstream: str, headers: Optional[Dict[str, str]]) -> None:
+    if search_flight.inflight(key):
+        return
+
+    async def refresh():
+        try:
+            await search_flight.do(key, lambda: _fetch_search(key, url, params, upstream, headers))
+        except Exception:
+            pass  # se conserva la entrada stale hasta que expire
+
+    task = asyncio.get_running_loop().create_task(refresh())
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+async def _fetch_search(
+    key: str,
+    url: str,
+    params: Dict[str, Any],
+    upstream: str = "nuclia",
+    headers: Optional[Dict[str, str]] = None,
+) -> dict:
+    # Los errores se cuentan aquí (una vez por petición real), no por cada request que esperaba
+    async def attempt() -> dict:
+        async with gate("search"):
+            r = await get_http_client().get(url, params=params, headers=headers)
+        r.raise_for_status()
+        return r.json()
+
+    try:
+        data = await resilient(upstream, attempt)
+    except Exception as e:
+        count_error("nuclia", e)
+        raise
+    if search_cache is not None:
+        search_cache.set(key, {"at": time.time(), "data": data})
+    return data
+
+# ── Búsqueda federada: todas las KB a la vez, fusión RRF (ver federation.py)
+async def _federated_search(
+    query: str,
+    kbs: Optional[List[str]],
+    size: int,
+    features: Optional[List[str]],
+    filters: Optional[List[str]],
+    faceted: Optional[List[str]],
+    sort: Optional[str],
+    min_score: Optional[float],
+    vectorset: str,
+) -> dict:
+    chosen = select_targets(kbs)
+    for t in targets:
+        if t not in chosen:
+            federation_totals[(t.name, "skipped")] += 1
+
+    async def one(target: KbTarget) -> dict:
+        url, params = _search_params(
+            query, size, features, [*(filters or ()), *target.filters] or None,
+            faceted, sort, min_score, vectorset, kb=target.kb,
+        )
+        key = json.dumps([url, params], sort_keys=True, ensure_ascii=False)
+        try:
+            return await asyncio.wait_for(
+                _remote_search(key, url, params, target.upstream, target.headers), target.timeout
+            )
+        except asyncio.TimeoutError:
+            # La KB lenta no frena a las demás (su petición sigue en vuelo y llena la caché)
+            error = httpx.ReadTimeout(f"KB {target.name}: sin respuesta en {target.timeout:g} s")
+            stale = _stale_entry(key, error)
+            if stale is None:
+                raise error from None
+            return stale
+
+    results = await asyncio.gather(*(one(t) for t in chosen), return_exceptions=True)
+    ok: List[Tuple[KbTarget, dict]] = []
+    failed: Dict[str, str] = {}
+    errors: List[Exception] = []
+    for target, res in zip(chosen, results):
+        if isinstance(res, Exception):
+            federation_totals[(target.name, "timeout" if isinstance(res, httpx.TimeoutException) else "error")] += 1
+            failed[target.name] = type(res).__name__
+            errors.append(res)
+        elif isinstance(res, BaseException):
+            raise res
+        else:
+            federation_totals[(target.name, "ok")] += 1
+            ok.append((target, res))
+    if not ok:
+        # Todas fallaron: se relanza de preferencia un error del upstream (habilita los respaldos)
+        raise next((e for e in errors if is_upstream_error(e)), errors[0])
+
+    merged = rrf_merge(ok, size)
+    info: Dict[str, Any] = {"kbs": [t.name for t in chosen]}
+    if kbs is not None:
+        info["routed"] = True
+    if failed:
+        info["failed"] = failed
+    stale = [t.name for t, res in ok if "stale" in res]
+    if stale:
+        merged["stale"] = {"kbs": stale}
+    merged["federation"] = info
+    return merged
+
+def nuclia_search(
+    query: str,
+    size: int = 20,
+    features: Optional[List[str]] = None,
+    filters: Optional[List[str]] = None,
+    faceted: Optional[List[str]] = None,
+    sort: Optional[str] = None,
+    min_score: Optional[float] = None,
+    vectorset: str = "multilingual-2024-05-06",
+    kbs: Optional[List[str]] = None,
+) -> dict:
+    """Versión síncrona de `nuclia_search_async` (mismos argumentos)."""
+    return run_sync(nuclia_search_async(
+        query,
+        size=size,
+        features=features,
+        filters=filters,
+        faceted=faceted,
+        sort=sort,
+        min_score=min_score,
+        vectorset=vectorset,
+        kbs=kbs,
+    ))
+
+def _search_params(
+    query: str,
+    size: int,
+    features: Optional[List[str]],
+    filters: Optional[List[str]],
+    faceted: Optional[List[str]],
+    sort: Optional[str],
+    min_score: Optional[float],
+    vectorset: str,
+    kb: str = KB,
+) -> Tuple[str, Dict[str, Any]]:
+    url = f"{NUCLIA_API_BASE}/kb/{kb}/search"
     
     # Parámetros base
     params: Dict[str, Any] = {
@@ -59,16 +292,61 @@ def nuclia_search(
     if min_score is not None:
         params["min_score"] = min_score
     
-    r = requests.get(url, headers=HEADERS, params=params, timeout=30)
-    r.raise_for_status()
-    return r.json()
+    return url, params
+
+# ── Fusión de resultados de varias búsquedas
+def paragraph_key(hit: dict) -> tuple:
+    """Identidad de un párrafo: recurso + campo + offsets (o el texto si no hay offsets)."""
+    rid = hit.get("rid", "") or hit.get("resource", "")
+    position = hit.get("position") or {}
+    if position.get("start") is not None:
+        return (rid, hit.get("field", ""), position.get("start"), position.get("end"))
+    return (rid, hit.get("field", ""), (hit.get("text") or "").strip())
+
+def _scaled(search: dict) -> dict:
+    """
+    Copia de `search` con los scores divididos por max(1, su mejor score), como en
+    rrf_merge: el BM25 de Nuclia no tiene techo y el del índice local ya viene en 0–1.
+    """
+    hits = (search.get("paragraphs") or {}).get("results") or []
+    top = max([h.get("score") or 0.0 for h in hits] + [1.0])
+    if top == 1.0:
+        return search
+    results = [{**h, "score": (h.get("score") or 0.0) / top} for h in hits]
+    return {**search, "paragraphs": {**search["paragraphs"], "results": results}}
+
+def merge_searches(*searches: dict) -> dict:
+    """
+    Une respuestas de nuclia_search sin duplicar párrafos (se queda con el mayor score)
+    y ordena por score. No modifica las respuestas originales (pueden venir de caché).
+    """
+    best: Dict[tuple, dict] = {}
+    resources: Dict[str, Any] = {}
+    for search in searches:
+        for hit in (search.get("paragraphs") or {}).get("results", []):
+            key = paragraph_key(hit)
+            prev = best.get(key)
+            if prev is None or hit.get("score", 0.0) > prev.get("score", 0.0):
+                best[key] = hit
+        res = search.get("resources") or {}
+        if isinstance(res, dict):
+            for rid, info in res.items():
+                resources.setdefault(rid, info)
+    merged = sorted(best.values(), key=lambda h: h.get("score", 0.0), reverse=True)
+    base = searches[0] if searches else {}
+    return {
+        **base,
+        "paragraphs": {**(base.get("paragraphs") or {}), "results": merged},
+        "resources": resources,
+    }
 
 # ── Construcción de contexto mejorada
 def build_context(
     search_json: dict, 
     max_chunks: int = 20,
     include_metadata: bool = True,
-    score_threshold: float = 0.0
+    score_threshold: float = 0.0,
+    token_budget: Optional[int] = None
 ) -> str:
     """
     Construye contexto desde resultados de búsqueda con mejoras.
@@ -78,7 +356,18 @@ def build_context(
         max_chunks: Máximo de párrafos a incluir
         include_metadata: Si incluir título/fuente del documento
         score_threshold: Score mínimo para incluir un resultado (0.0-1.0)
+        token_budget: Si se indica, usa el empaquetado con presupuesto (ver pack_context)
     """
+    if token_budget:
+        context, _hits, _stats = pack_context(
+            search_json,
+            token_budget=token_budget,
+            max_chunks=max_chunks,
+            include_metadata=include_metadata,
+            score_threshold=score_threshold,
+        )
+        return context
+
     para = (search_json.get("paragraphs") or {}).get("results", [])
     resources = (search_json.get("resources") or {})  # Información de archivos
     blocks = []
@@ -126,3 +415,150 @@ def build_context(
     
     return "\n\n---\n\n".join(blocks)  # Separador más visible
 
+
+# ── Empaquetado de contexto con presupuesto de tokens
+# Totales acumulados del modo empaquetado (para /stats/retrieval)
+packing_totals: Counter = Counter()
+
+def record_packing(stats: Dict[str, Any]) -> None:
+    """Suma a packing_totals las estadísticas de un contexto que se envió (una vez por request)."""
+    packing_totals["requests"] += 1
+    packing_totals["duplicates"] += stats["duplicates"]
+    packing_totals["tokens"] += stats["tokens"]
+    packing_totals["baseline_tokens"] += stats["baseline_tokens"]
+
+def _header(hits: List[dict], resources: dict) -> str:
+    first = hits[0]
+    title = (resources.get(first.get("rid", ""), {}) or {}).get("title", "")
+    parts = []
+    if title:
+        parts.append(f"📄 {title}")
+    elif first.get("field"):
+        parts.append(f"Fuente: {first.get('field')}")
+    pages = sorted({(h.get("position") or {}).get("page_number") for h in hits} - {None})
+    if len(pages) == 1:
+        parts.append(f"(página {pages[0]})")
+    elif pages:
+        parts.append(f"(páginas {pages[0]}–{pages[-1]})")
+    return "[" + " ".join(parts) + "]\n" if parts else ""
+
+def _shingles(text: str, n: int = 3) -> frozenset:
+    words = normalize_question(text).split()
+    if len(words) <= n:
+        return frozenset([" ".join(words)])
+    return frozenset(" ".join(words[i:i + n]) for i in range(len(words) - n + 1))
+
+def _adjacent(prev: dict, nxt: dict) -> bool:
+    a, b = prev.get("position") or {}, nxt.get("position") or {}
+    if a.get("end") is not None and b.get("start") is not None:
+        return b["start"] - a["end"] <= 2 and b["start"] >= a.get("start", 0)
+    if a.get("index") is not None and b.get("index") is not None:
+        return b["index"] == a["index"] + 1
+    return False
+
+def _append_text(block_text: str, prev: dict, nxt: dict) -> str:
+    text = (nxt.get("text") or "").strip()
+    a, b = prev.get("position") or {}, nxt.get("position") or {}
+    overlap = (a.get("end") or 0) - (b.get("start") or 0)
+    if a.get("end") is not None and b.get("start") is not None and 0 < overlap < len(text):
+        text = text[overlap:].lstrip()  # párrafos solapados: solo lo nuevo
+    return f"{block_text}\n{text}" if text else block_text
+
+def pack_context(
+    search_json: dict,
+    token_budget: int,
+    max_chunks: int = 20,
+    include_metadata: bool = True,
+    score_threshold: float = 0.0,
+    dedup_threshold: float = 0.8,
+    diversity: float = 0.85,
+    record: bool = True,
+) -> Tuple[str, List[dict], Dict[str, Any]]:
+    """
+    Variante de build_context con presupuesto de tokens.
+
+    - Descarta párrafos casi duplicados (Jaccard de shingles de 3 palabras >= dedup_threshold),
+      aunque vengan de otro recurso/campo/página.
+    - Elige por score (`rerank` si pasó por el reranker local), penalizando cada párrafo
+      extra del mismo recurso (x diversity) para favorecer recursos distintos.
+    - Une en un solo bloque los párrafos contiguos del mismo recurso y campo.
+
+    Devuelve (contexto, párrafos usados, estadísticas). Los párrafos usados sirven para
+    que extract_sources_info reporte exactamente lo que entró al prompt. Con record=False
+    no se suma a packing_totals (el llamador registra el contexto final con record_packing).
+    """
+    para = (search_json.get("paragraphs") or {}).get("results", [])
+    resources = search_json.get("resources") or {}
+    if not isinstance(resources, dict):
+        resources = {}
+
+    candidates = []
+    for hit in para:
+        score = hit.get("score", 1.0)
+        text = (hit.get("text") or "").strip()
+        if score < score_threshold or not text:
+            continue
+        # Con el reranker local se elige por su score (el de Nuclia solo filtra)
+        score = hit.get("rerank", score)
+        candidates.append({"hit": hit, "score": score, "shingles": _shingles(text), "tokens": estimate_tokens(text)})
+
+    kept: List[dict] = []
+    per_resource: Counter = Counter()
+    used = duplicates = over_budget = 0
+    while candidates and len(kept) < max_chunks:
+        best = max(candidates, key=lambda c: c["score"] * diversity ** per_resource[c["hit"].get("rid", "")])
+        candidates.remove(best)
+        sh = best["shingles"]
+        if any(len(sh & k["shingles"]) / len(sh | k["shingles"]) >= dedup_threshold for k in kept):
+            duplicates += 1
+            continue
+        cost = best["tokens"] + (12 if include_metadata else 2)  # encabezado + separador
+        if used + cost > token_budget:
+            over_budget += 1
+            continue
+        kept.append(best)
+        used += cost
+        per_resource[best["hit"].get("rid", "")] += 1
+
+    # Agrupar por recurso/campo y unir párrafos contiguos
+    groups: Dict[tuple, List[dict]] = {}
+    for c in kept:
+        h = c["hit"]
+        groups.setdefault((h.get("rid", ""), h.get("field", "")), []).append(c)
+    blocks = []  # (mejor score, hits, texto)
+    for group in groups.values():
+        group.sort(key=lambda c: ((c["hit"].get("position") or {}).get("page_number") or 0,
+                                  (c["hit"].get("position") or {}).get("start") or 0))
+        current = [group[0]]
+        text = (group[0]["hit"].get("text") or "").strip()
+        for c in group[1:]:
+            if _adjacent(current[-1]["hit"], c["hit"]):
+                text = _append_text(text, current[-1]["hit"], c["hit"])
+                current.append(c)
+            else:
+                blocks.append((max(x["score"] for x in current), [x["hit"] for x in current], text))
+                current, text = [c], (c["hit"].get("text") or "").strip()
+        blocks.append((max(x["score"] for x in current), [x["hit"] for x in current], text))
+    blocks.sort(key=lambda b: b[0], reverse=True)
+
+    rendered = [(_header(hits, resources) if include_metadata else "") + text for _s, hits, text in blocks]
+    context = "\n\n---\n\n".join(rendered)
+    used_hits = [h for _s, hits, _t in blocks for h in hits]
+
+    baseline = estimate_tokens(build_context(
+        search_json, max_chunks=max_chunks, include_metadata=include_metadata, score_threshold=score_threshold
+    ))
+    tokens = estimate_tokens(context)
+    stats = {
+        "token_budget": token_budget,
+        "kept": len(used_hits),
+        "blocks": len(blocks),
+        "duplicates": duplicates,
+        "over_budget": over_budget,
+        "tokens": tokens,
+        "baseline_tokens": baseline,
+        "tokens_saved": baseline - tokens,
+    }
+    if record:
+        record_packing(stats)
+    return context, used_hits, stats
@@ -0,0 +1,188 @@
+# app/rerank.py
+from __future__ import annotations
+import math
+import time
+from collections import Counter
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+from .intents import route_intent
+from .rewriter import STOP_WORDS, light_stem
+from .text import estimate_tokens, normalize_question
+from .config import RERANK_TOP_K, RERANK_CUTOFF, RERANK_MIN_KEEP
+
+# ── Reranker léxico local (entre la búsqueda y build_context)
+# Nuclia devuelve ~30 párrafos ordenados por su score y hasta 20 entraban al prompt.
+# Aquí se puntúan todos a la vez contra la pregunta original y la consulta reescrita,
+# con rasgos baratos calculados en lote sobre un vocabulario común:
+#   bm25    BM25 de los términos (pregunta + reescritura, esta con menos peso) con df
+#           del propio lote de candidatos, normalizado por el mejor
+#   phrase  fracción de bigramas de la pregunta presentes tal cual (nombres de
+#           carreras, "campus altiplano", "prueba de aptitud"...)
+#   sede    +1 si el párrafo nombra la sede de la pregunta, -1 si solo nombra otras
+#   title   fracción de términos de la pregunta en el título del recurso
+#   prior   el score de Nuclia
+# Se quedan los RERANK_TOP_K mejores por encima de un corte adaptativo
+# (RERANK_CUTOFF × el mejor score del lote), nunca menos de RERANK_MIN_KEEP.
+
+_K1 = 1.2
+_B = 0.75
+_QUERY_WEIGHT = 0.5   # términos que solo trae la reescritura
+_WEIGHTS = {"bm25": 0.45, "phrase": 0.2, "sede": 0.1, "title": 0.1, "prior": 0.15}
+
+_MEMO_MAX = 8192      # párrafos analizados que se recuerdan (la KB es chica y se repiten)
+
+rerank_totals: Counter = Counter()
+
+def _route_sedes(text: str) -> frozenset:
+    return frozenset(g for g in route_intent(text).features if g.startswith("sede_"))
+
+# Lo caro es tokenizar y rutear el texto de cada párrafo; el mismo párrafo vuelve en
+# muchas búsquedas, así que su análisis se memoriza (igual que el stem de cada palabra).
+# Las sedes de un párrafo solo se buscan si la pregunta nombra alguna.
+_stems: Dict[str, str] = {}
+_sedes: Dict[str, frozenset] = {}
+def _terms(text: str) -> List[str]:
+    """Los términos de local_index.terms, con el stem de cada palabra memorizado."""
+    out = []
+    for w in normalize_question(text).split():
+        if len(w) > 1 and w not in STOP_WORDS:
+            stem = _stems.get(w)
+            if stem is None:
+                stem = light_stem(w)
+                if len(_stems) < _MEMO_MAX * 4:
+                    _stems[w] = stem
+            out.append(stem)
+    return out
+
+def _bigrams(words: List[str]) -> frozenset:
+    return frozenset(f"{a} {b}" for a, b in zip(words, words[1:]))
+
+class _Analysis(NamedTuple):
+    length: int                # términos del párrafo
+    tf: Counter                # término -> frecuencia
+    bigrams: frozenset
+
+_analyzed: Dict[str, _Analysis] = {}
+
+def _analyze(text: str) -> _Analysis:
+    found = _analyzed.get(text)
+    if found is None:
+        words = _terms(text)
+        found = _Analysis(len(words), Counter(words), _bigrams(words))
+        if len(_analyzed) < _MEMO_MAX:
+            _analyzed[text] = found
+    return found
+
+def _text_sedes(text: str) -> frozenset:
+    """Grupos sede_* que nombra un párrafo."""
+    found = _sedes.get(text)
+    if found is None:
+        found = _route_sedes(text)
+        if len(_sedes) < _MEMO_MAX:
+            _sedes[text] = found
+    return found
+
+def score_candidates(
+    hits: List[dict],
+    resources: Dict[str, Any],
+    question: str,
+    query: str = "",
+) -> List[Tuple[float, Dict[str, float]]]:
+    """Score combinado (0–1) y rasgos de cada candidato, en el orden de `hits`."""
+    q_terms = _terms(question)
+    weights: Dict[str, float] = {t: 1.0 for t in q_terms}
+    for t in _terms(query):
+        weights.setdefault(t, _QUERY_WEIGHT)
+    q_bigrams = _bigrams(q_terms)
+    q_sedes = _route_sedes(question)
+    q_set = set(q_terms)
+
+    # Un solo recorrido por candidato: términos -> postings del lote (solo vocabulario de la consulta)
+    n = len(hits)
+    postings: Dict[str, List[Tuple[int, int]]] = {t: [] for t in weights}
+    lengths: List[int] = []
+    phrase: List[float] = []
+    for i, hit in enumerate(hits):
+        doc = _analyze(hit.get("text") or "")
+        lengths.append(doc.length)
+        for t, plist in postings.items():
+            tf = doc.tf.get(t)
+            if tf:
+                plist.append((i, tf))
+        phrase.append(len(q_bigrams & doc.bigrams) / len(q_bigrams) if q_bigrams else 0.0)
+    avgdl = (sum(lengths) / n) if n else 1.0
+
+    bm25 = [0.0] * n
+    for t, plist in postings.items():
+        if not plist:
+            continue
+        idf = math.log(1 + (n - len(plist) + 0.5) / (len(plist) + 0.5))
+        for i, tf in plist:
+            norm = _K1 * (1 - _B + _B * lengths[i] / (avgdl or 1.0))
+            bm25[i] += weights[t] * idf * tf * (_K1 + 1) / (tf + norm)
+    top = max(bm25, default=0.0) or 1.0
+
+    titles: Dict[str, float] = {}
+    out = []
+    for i, hit in enumerate(hits):
+        rid = hit.get("rid") or hit.get("resource") or ""
+        if rid not in titles:
+            title = set(_terms((resources.get(rid) or {}).get("title") or ""))
+            titles[rid] = len(q_set & title) / len(q_set) if q_set else 0.0
+        sede = 0.0
+        if q_sedes:
+            found = _text_sedes(hit.get("text") or "")
+            sede = 1.0 if found & q_sedes else (-1.0 if found else 0.0)
+        features = {
+            "bm25": bm25[i] / top,
+            "phrase": phrase[i],
+            "sede": sede,
+            "title": titles[rid],
+            "prior": min(1.0, max(0.0, hit.get("score") or 0.0)),
+        }
+        out.append((sum(_WEIGHTS[k] * v for k, v in features.items()), features))
+    return out
+
+def rerank(
+    search: dict,
+    question: str,
+    query: str = "",
+    *,
+    max_chunks: int = 20,
+    min_score: float = 0.0,
+    top_k: int = RERANK_TOP_K,
+) -> Tuple[dict, Dict[str, Any]]:
+    """
+    Devuelve (búsqueda con solo los párrafos elegidos, en el nuevo orden; estadísticas).
+    Lo "quitado" se mide contra lo que build_context habría puesto en el prompt:
+    los primeros `max_chunks` párrafos con texto y score >= `min_score`.
+    """
+    t0 = time.perf_counter()
+    hits = [h for h in (search.get("paragraphs") or {}).get("results") or []
+            if (h.get("text") or "").strip() and (h.get("score") or 0.0) >= min_score]
+    resources = search.get("resources") or {}
+    scored = score_candidates(hits, resources if isinstance(resources, dict) else {}, question, query)
+    order = sorted(range(len(hits)), key=lambda i: scored[i][0], reverse=True)
+
+    limit = max(1, min(top_k, max_chunks))
+    best = scored[order[0]][0] if order else 0.0
+    cutoff = best * RERANK_CUTOFF
+    kept = [i for n, i in enumerate(order[:limit]) if n < RERANK_MIN_KEEP or scored[i][0] >= cutoff]
+
+    ranked = [{**hits[i], "rerank": round(scored[i][0], 4)} for i in kept]
+    baseline = hits[:max_chunks]
+    baseline_tokens = sum(estimate_tokens(h.get("text") or "") for h in baseline)
+    tokens = sum(estimate_tokens(h.get("text") or "") for h in ranked)
+    stats = {
+        "candidates": len(hits),
+        "kept": len(ranked),
+        "cutoff": round(cutoff, 4),
+        "removed_chunks": len(baseline) - len(ranked),
+        "removed_tokens": baseline_tokens - tokens,
+        "ms": round((time.perf_counter() - t0) * 1000, 2),
+    }
+    rerank_totals["requests"] += 1
+    rerank_totals["candidates"] += len(hits)
+    rerank_totals["removed_chunks"] += stats["removed_chunks"]
+    rerank_totals["removed_tokens"] += stats["removed_tokens"]
+    return {**search, "paragraphs": {**(search.get("paragraphs") or {}), "results": ranked}}, stats
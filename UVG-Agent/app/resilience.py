@@ -0,0 +1,189 @@
+# app/resilience.py
+from __future__ import annotations
+import asyncio
+import random
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, TypeVar
+
+import anthropic
+import httpx
+
+from .deadline import current_deadline
+from .config import (
+    RETRY_ATTEMPTS,
+    RETRY_BASE_DELAY,
+    RETRY_MAX_DELAY,
+    BREAKER_FAILURES,
+    BREAKER_RESET,
+)
+
+T = TypeVar("T")
+
+# ── Reintentos + circuit breaker por upstream ("nuclia", "anthropic")
+# Los errores transitorios (conexión, timeouts, 408/425/429/5xx, 529 overloaded) se
+# reintentan con backoff exponencial acotado y jitter completo, respetando Retry-After
+# y el plazo del request. Tras BREAKER_FAILURES fallos seguidos el circuito se abre:
+# durante BREAKER_RESET segundos se falla de inmediato (CircuitOpen) y quien llama
+# puede servir lo último bueno de la caché; luego se deja pasar una sola prueba.
+
+retry_totals: Counter = Counter()   # reintentos por upstream
+stale_totals: Counter = Counter()   # respuestas servidas desde caché vencida por tipo
+
+_RETRY_STATUS = frozenset({408, 425, 429, 500, 502, 503, 504, 529})
+
+class CircuitOpen(Exception):
+    """El upstream está marcado como caído: no se intenta la llamada."""
+
+    def __init__(self, upstream: str, retry_after: float):
+        self.upstream = upstream
+        self.retry_after = max(1, int(retry_after + 0.999))
+        super().__init__(f"{upstream} no disponible (circuito abierto, reintentar en {self.retry_after} s)")
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {"Retry-After": str(self.retry_after)}
+
+def status_of(exc: BaseException) -> Optional[int]:
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+def is_transient(exc: BaseException) -> bool:
+    """¿Vale la pena reintentar? (y cuenta como fallo del upstream)."""
+    if isinstance(exc, (httpx.TransportError, anthropic.APIConnectionError)):
+        return True
+    status = status_of(exc)
+    return status is not None and status in _RETRY_STATUS
+
+def is_overloaded(exc: BaseException) -> bool:
+    """Rechazo por capacidad (429/503/529): otro modelo puede tener cupo."""
+    return status_of(exc) in (429, 503, 529)
+
+def is_upstream_error(exc: BaseException) -> bool:
+    return isinstance(exc, (CircuitOpen, httpx.HTTPError, anthropic.APIError))
+
+def _retry_after(exc: BaseException) -> Optional[float]:
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    value = headers.get("retry-after") if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+class CircuitBreaker:
+    def __init__(self, name: str, failures: int, reset: float):
+        self.name = name
+        self.threshold = failures
+        self.reset = reset
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self._probing = False
+
+    def check(self) -> None:
+        """Lanza CircuitOpen si no se debe llamar; en half-open deja pasar una prueba."""
+        if self.threshold <= 0 or self.state == "closed":
+            return
+        wait = self.opened_at + self.reset - time.monotonic()
+        if self.state == "open" and wait <= 0:
+            self.state = "half_open"
+        if self.state == "half_open" and not self._probing:
+            self._probing = True
+            return
+        raise CircuitOpen(self.name, max(wait, 1.0))
+
+    def success(self) -> None:
+        self.state, self.failures, self._probing = "closed", 0, False
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.threshold > 0:
+            if self.state != "open":
+                self.opens += 1
+            self.state, self.opened_at = "open", time.monotonic()
+        self._probing = False
+
+    def abandon(self) -> None:
+        """La prueba se canceló (plazo, cliente desconectado) sin veredicto."""
+        self._probing = False
+
+    def as_dict(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"state": self.state, "failures": self.failures, "opens": self.opens}
+        if self.state != "closed":
+            out["retry_in_s"] = round(max(0.0, self.opened_at + self.reset - time.monotonic()), 1)
+        return out
+
+breakers: Dict[str, CircuitBreaker] = {
+    name: CircuitBreaker(name, BREAKER_FAILURES, BREAKER_RESET) for name in ("nuclia", "anthropic")
+}
+
+def _verdict(breaker: CircuitBreaker, exc: BaseException) -> None:
+    if is_transient(exc):
+        breaker.failure()
+    elif isinstance(exc, Exception):
+        breaker.success()  # el upstream respondió (p. ej. 400): está vivo
+    else:
+        breaker.abandon()
+
+@asynccontextmanager
+async def guarded(upstream: str) -> AsyncIterator[None]:
+    """Un solo intento bajo el breaker (p. ej. el stream de Claude, que no se reintenta)."""
+    breaker = breakers[upstream]
+    breaker.check()
+    try:
+        yield
+    except BaseException as e:
+        _verdict(breaker, e)
+        raise
+    breaker.success()
+
+async def resilient(
+    upstream: str,
+    fn: Callable[[], Awaitable[T]],
+    attempts: int = RETRY_ATTEMPTS,
+    retry_if: Optional[Callable[[BaseException], bool]] = None,
+) -> T:
+    """
+    Llama `fn()` (idempotente) con reintentos y breaker; relanza el último error.
+    `retry_if` puede excluir errores transitorios que quien llama prefiere manejar
+    (p. ej. un overloaded que se resuelve cambiando de modelo).
+    """
+    breaker = breakers[upstream]
+    attempt = 0
+    while True:
+        breaker.check()
+        try:
+            result = await fn()
+        except BaseException as e:
+            _verdict(breaker, e)
+            if (not isinstance(e, Exception) or not is_transient(e) or attempt + 1 >= attempts
+                    or (retry_if is not None and not retry_if(e))):
+                raise
+            error = e
+        else:
+            breaker.success()
+            return result
+        # Backoff exponencial acotado con jitter completo; Retry-After manda si es mayor
+        delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+        hinted = _retry_after(error)
+        if hinted is not None:
+            delay = max(delay, hinted)
+        deadline = current_deadline()
+        if delay > RETRY_MAX_DELAY * 4 or (deadline is not None and delay >= deadline.remaining()):
+            raise error  # esperar no cabe en el plazo: mejor fallar ya
+        attempt += 1
+        retry_totals[upstream] += 1
+        await asyncio.sleep(delay)
+
+def breaker_states() -> Dict[str, Dict[str, Any]]:
+    return {name: b.as_dict() for name, b in breakers.items()}
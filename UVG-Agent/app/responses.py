@@ -0,0 +1,114 @@
+# app/responses.py
+from __future__ import annotations
+import gzip
+import json
+from typing import Any, Dict, List, Literal, Mapping, Optional
+
+from fastapi.responses import JSONResponse, Response
+
+from .config import RESPONSE_VERBOSITY, SOURCE_TEXT_CHARS, RESPONSE_COMPRESS_MIN_BYTES
+
+try:  # serialización rápida (opcional)
+    import orjson
+except ImportError:
+    orjson = None
+
+try:  # compresión brotli (opcional); sin ella se usa gzip
+    import brotli
+except ImportError:
+    brotli = None
+
+# ── Forma de la respuesta de /ask
+# `verbosity` decide qué viaja al cliente:
+#   answer          solo la respuesta y los datos mínimos de meta (caché, sesión, plazo)
+#   answer+sources  + fuentes compactas (texto recortado a `source_text` caracteres) y meta completa
+#   debug           todo, incluida la respuesta cruda de Nuclia en `search_results`
+# El JSON se serializa con orjson directo desde los dicts del pipeline (sin
+# jsonable_encoder) y, si es grande y el cliente lo acepta, va comprimido.
+
+Verbosity = Literal["answer", "answer+sources", "debug"]
+
+# Lo que se conserva de meta con verbosity=answer
+_META_COMPACT = ("cached", "stale", "faq", "session", "deadline")
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse con orjson (o json compacto si no está instalado)."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+def _clip(text: str, limit: int) -> str:
+    if len(text) <= limit:
+        return text
+    return text[:limit].rstrip() + "…"
+
+def compact_sources(sources: List[dict], text_chars: Optional[int] = None) -> List[dict]:
+    """Fuentes sin el texto completo: recortado a `text_chars` (0 = sin texto, -1 = completo)."""
+    limit = SOURCE_TEXT_CHARS if text_chars is None else text_chars
+    if limit < 0:
+        return sources
+    out = []
+    for src in sources:
+        src = dict(src)
+        text = src.pop("text", "") or ""
+        if limit:
+            src["text"] = _clip(text, limit)
+        out.append(src)
+    return out
+
+def shape_answer(result: Mapping[str, Any], verbosity: Optional[str] = None, source_text: Optional[int] = None) -> Dict[str, Any]:
+    """Recorta el resultado de `ask_agent_async` según `verbosity` (None = RESPONSE_VERBOSITY)."""
+    verbosity = verbosity or RESPONSE_VERBOSITY
+    if verbosity == "debug":
+        return dict(result)
+    meta = result.get("meta") or {}
+    if verbosity == "answer":
+        out: Dict[str, Any] = {"answer": result.get("answer", "")}
+        compact = {k: meta[k] for k in _META_COMPACT if k in meta}
+        if compact:
+            out["meta"] = compact
+        return out
+    out = {"answer": result.get("answer", ""), "sources": compact_sources(result.get("sources") or [], source_text)}
+    if meta:
+        out["meta"] = meta
+    return out
+
+def shape_event(event: str, data: Dict[str, Any], verbosity: Optional[str] = None, source_text: Optional[int] = None) -> Dict[str, Any]:
+    """Mismo recorte para el evento `sources` de /ask/stream."""
+    verbosity = verbosity or RESPONSE_VERBOSITY
+    if event != "sources" or verbosity == "debug":
+        return data
+    if verbosity == "answer":
+        return {**data, "sources": []}
+    return {**data, "sources": compact_sources(data.get("sources") or [], source_text)}
+
+def _accepts(accept_encoding: str, coding: str) -> bool:
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        if name.strip() == coding:
+            return params.replace(" ", "") not in ("q=0", "q=0.0")
+    return False
+
+def json_response(
+    content: Any,
+    accept_encoding: str = "",
+    status_code: int = 200,
+    headers: Optional[Dict[str, str]] = None,
+) -> Response:
+    """JSON rápido; comprimido con br/gzip si supera RESPONSE_COMPRESS_MIN_BYTES y el cliente lo acepta."""
+    body = dumps(content)
+    headers = dict(headers or {})
+    if 0 < RESPONSE_COMPRESS_MIN_BYTES <= len(body):
+        headers["Vary"] = "Accept-Encoding"
+        if brotli is not None and _accepts(accept_encoding, "br"):
+            body = brotli.compress(body, quality=4)
+            headers["Content-Encoding"] = "br"
+        elif _accepts(accept_encoding, "gzip"):
+            body = gzip.compress(body, compresslevel=5)
+            headers["Content-Encoding"] = "gzip"
+    return Response(body, status_code=status_code, headers=headers, media_type="application/json")
@@ -0,0 +1,116 @@
+# app/rewriter.py
+from __future__ import annotations
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+from .text import normalize_question
+
+# ── Reescritor local de consultas (sin LLM)
+# Convierte la pregunta en palabras clave: quita stop words, dobla acentos,
+# aplica un stemming ligero (plurales) y expande sinónimos propios de la UVG.
+
+STOP_WORDS = frozenset("""
+a al algo algun alguna algunas alguno algunos ante antes aqui asi aun bajo bien cada casi
+como con contra cual cuales cualquier cuando cuanta cuantas cuanto cuantos de del desde
+donde dos el ella ellas ello ellos en entre era eran es esa esas ese eso esos esta estan
+estar estas este esto estos fue fueron ha haber habia hace hacer han has hasta hay la las
+le les lo los mas me mi mis mucho muy nada ni no nos nosotros o os otra otras otro otros
+para pero poco por porque puede pueden puedo que quien quienes se ser si sido sin sobre
+son su sus tal tambien tan tanto te tener tengo ti tiene tienen todo todos tu tus un una
+unas uno unos usted ustedes y ya yo
+quiero quisiera necesito saber favor informacion info ayuda ayudame dime decir gustaria
+podrias podria hola buenas buenos dias tardes noches gracias ver conocer encontrar
+""".split())
+
+# Formas normalizadas (sin acentos, singular) -> términos con los que se expande la consulta
+UVG_SYNONYMS: Dict[str, List[str]] = {
+    # Planes de estudio
+    "pensum": ["malla curricular", "plan de estudios"],
+    "malla": ["pensum", "plan de estudios"],
+    "plan de estudio": ["pensum", "malla curricular"],
+    # Costos
+    "arancel": ["costo", "cuota"],
+    "costo": ["arancel", "cuota"],
+    "precio": ["costo", "arancel"],
+    "colegiatura": ["cuota", "arancel"],
+    "mensualidad": ["cuota", "colegiatura"],
+    "pago": ["cuota", "forma de pago"],
+    # Sedes
+    "altiplano": ["sede altiplano", "campus altiplano"],
+    "campus sur": ["sede sur"],
+    "campus central": ["sede central"],
+    "sede": ["campus"],
+    "campus": ["sede"],
+    # Facultades
+    "ingenieria": ["facultad de ingenieria"],
+    "ciencias y humanidades": ["facultad de ciencias y humanidades"],
+    "ciencias sociales": ["facultad de ciencias sociales"],
+    "educacion": ["facultad de educacion"],
+    # Procesos
+    "beca": ["ayuda financiera", "financiamiento"],
+    "inscripcion": ["admision", "matricula"],
+    "admision": ["inscripcion", "requisitos de admision"],
+    "requisito": ["admision"],
+    "carrera": ["licenciatura", "programa"],
+    "calendario": ["fechas", "ciclo academico"],
+    "horario": ["calendario"],
+}
+
+# Vocabulario del dominio: sube la confianza cuando aparece en la consulta
+DOMAIN_TERMS = frozenset(
+    set(UVG_SYNONYMS)
+    | {
+        "uvg", "universidad", "valle", "facultad", "laboratorio", "makerspace", "crea",
+        "biblioteca", "examen", "titulo", "licenciatura", "maestria", "doctorado",
+        "posgrado", "semestre", "ciclo", "curso", "clase", "reglamento", "graduacion",
+        "financiamiento", "descuento", "sur", "central", "estudiante", "docente",
+    }
+)
+
+_MAX_TERMS = 12
+
+@dataclass
+class LocalRewrite:
+    query: str
+    confidence: float
+    keywords: List[str] = field(default_factory=list)
+    expansions: List[str] = field(default_factory=list)
+
+def light_stem(word: str) -> str:
+    """Stemming ligero en español: solo plurales ('becas'->'beca', 'inscripciones'->'inscripcion')."""
+    if len(word) <= 4:
+        return word
+    if word.endswith("ces"):
+        return word[:-3] + "z"
+    if word.endswith("iones"):
+        return word[:-2]
+    if word.endswith("es") and word[-3] in "rlnd" and len(word) > 5:
+        return word[:-2]
+    if word.endswith("s") and word[-2] in "aeo":  # 'campus', 'tesis' se quedan igual
+        return word[:-1]
+    return word
+
+def local_rewrite(question: str) -> LocalRewrite:
+    norm = normalize_question(question)
+    tokens = [light_stem(t) for t in re.findall(r"\w+", norm) if t not in STOP_WORDS]
+    keywords = list(dict.fromkeys(t for t in tokens if len(t) > 1))
+    if not keywords:
+        return LocalRewrite(query=question.strip(), confidence=0.0)
+
+    # Frases de varias palabras se buscan sobre el texto ya normalizado y con plurales reducidos
+    stemmed_text = " " + " ".join(light_stem(t) for t in norm.split()) + " "
+    expansions: List[str] = []
+    for term, syns in UVG_SYNONYMS.items():
+        if (" " in term and f" {term} " in stemmed_text) or term in keywords:
+            expansions.extend(s for s in syns if s not in keywords and s not in expansions)
+
+    known = sum(1 for k in keywords if k in DOMAIN_TERMS)
+    confidence = 0.4 + 0.6 * (known / len(keywords))
+    if len(keywords) > 8:
+        # Preguntas largas suelen necesitar la comprensión del LLM
+        confidence -= 0.2
+    confidence = round(max(0.0, min(1.0, confidence)), 3)
+
+    terms = (keywords + expansions)[:_MAX_TERMS]
+    return LocalRewrite(query=" ".join(terms), confidence=confidence, keywords=keywords, expansions=expansions)
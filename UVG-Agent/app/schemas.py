@@ -1,6 +1,9 @@
 from pydantic import BaseModel, Field
 from typing import Optional, List, Dict, Any
 
+from .config import BATCH_MAX_ITEMS
+from .responses import Verbosity
+
 # ── Esquemas mejorados
 class AskBody(BaseModel):
     query: str = Field(..., min_length=2, max_length=2000)
@@ -8,3 +11,10 @@ class AskBody(BaseModel):
     max_chunks: Optional[int] = Field(default=20, ge=1, le=50)   # cuántos párrafos meter al contexto
     use_semantic: Optional[bool] = Field(default=True)           # búsqueda semántica + keyword
     min_score: Optional[float] = Field(default=0.0, ge=0.0, le=1.0)  # score mínimo
+    deadline: Optional[float] = Field(default=None, gt=0, le=120)  # presupuesto (s); None = REQUEST_DEADLINE
+    session_id: Optional[str] = Field(default=None, min_length=8, max_length=128)  # conversación multi-turno; ignorado en /ask/batch
+    verbosity: Optional[Verbosity] = None                        # answer | answer+sources | debug; None = RESPONSE_VERBOSITY
+    source_text: Optional[int] = Field(default=None, ge=-1, le=5000)  # caracteres de texto por fuente; -1 = completo
+
+class BatchAskBody(BaseModel):
+    items: List[AskBody] = Field(..., min_length=1, max_length=BATCH_MAX_ITEMS)
@@ -0,0 +1,209 @@
+# app/sessions.py
+from __future__ import annotations
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from .cache import make_cache
+from .rewriter import STOP_WORDS, light_stem
+from .text import estimate_tokens, normalize_question
+from .config import (
+    SESSION_BACKEND,
+    SESSION_PATH,
+    SESSION_TTL,
+    SESSION_MAX_ENTRIES,
+    SESSION_MAX_TURNS,
+    SESSION_HISTORY_TOKENS,
+    SESSION_REUSE_DECAY,
+)
+
+# ── Sesiones multi-turno
+# Con `session_id` cada pregunta guarda su turno (pregunta, respuesta, párrafos que
+# entraron al contexto y términos del tema). La siguiente pregunta de la sesión:
+#   reuse        no trae términos nuevos ("¿y cuáles son los requisitos?" sobre lo mismo):
+#                se responde con los párrafos guardados, sin reescritura ni Nuclia
+#   incremental  agrega entidades ("¿y para la sede Altiplano?"): una búsqueda solo con
+#                el tema + lo nuevo, fusionada con lo guardado (que pesa un poco menos)
+#   new_topic    casi todo es nuevo: pipeline completo, como una pregunta suelta
+# El historial entra al prompt como turnos previos, del más reciente hacia atrás,
+# hasta SESSION_HISTORY_TOKENS. Las sesiones vencen tras SESSION_TTL s sin uso.
+
+session_totals: Counter = Counter()  # turnos por modo (new | reuse | incremental | new_topic)
+
+session_store = make_cache(
+    SESSION_BACKEND, path=SESSION_PATH, max_entries=SESSION_MAX_ENTRIES, ttl=SESSION_TTL
+)
+
+# Palabras de continuación que no cambian el tema por sí solas
+_CARRY_WORDS = frozenset("""
+tambien entonces igual mismo misma mismos mismas caso ahi alla otra otro otras otros
+sede campus ademas solo sola aplica aplicar sirve funciona vale incluye incluir significa
+explica explicar explicame detalle ejemplo
+""".split())
+# Una sede nueva reemplaza a la anterior en el tema ("¿y en Altiplano?" tras Campus Central)
+_SEDES = frozenset({"altiplano", "solola", "sur", "escuintla", "central"})
+# Términos del tema que acompañan a los nuevos en la búsqueda incremental
+_ANCHOR_TERMS = 6
+_MAX_KEYWORDS = 12
+_NEW_TOPIC_TERMS = 3
+_SOURCES_HEAD = "## Fuentes consultadas"
+
+def keywords(question: str) -> List[str]:
+    """Términos de contenido de la pregunta (sin stop words, plurales reducidos)."""
+    tokens = (light_stem(t) for t in re.findall(r"\w+", normalize_question(question)))
+    return list(dict.fromkeys(t for t in tokens if len(t) > 2 and t not in STOP_WORDS))
+
+@dataclass
+class Session:
+    id: str
+    turns: List[Dict[str, str]] = field(default_factory=list)  # [{"q": ..., "a": ...}]
+    search: Dict[str, Any] = field(default_factory=dict)       # párrafos del último contexto
+    keywords: List[str] = field(default_factory=list)          # términos del tema actual
+    query: str = ""                                            # última consulta a Nuclia
+
+    @property
+    def paragraphs(self) -> List[dict]:
+        return (self.search.get("paragraphs") or {}).get("results") or []
+
+@dataclass
+class FollowUp:
+    mode: str                                            # new | reuse | incremental | new_topic
+    keywords: List[str]                                  # términos del tema tras este turno
+    new_terms: List[str] = field(default_factory=list)
+    query: str = ""                                      # consulta de la búsqueda incremental
+    prior: Dict[str, Any] = field(default_factory=dict)  # búsqueda guardada a reutilizar
+
+    def as_dict(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"mode": self.mode}
+        if self.new_terms:
+            out["new_terms"] = self.new_terms
+        return out
+
+def sessions_enabled() -> bool:
+    return session_store is not None
+
+def load_session(session_id: Optional[str]) -> Optional[Session]:
+    """Sesión guardada o una vacía; None si no hay `session_id` o las sesiones están apagadas."""
+    if not session_id or session_store is None:
+        return None
+    data = session_store.get(session_id)
+    if not data:
+        return Session(session_id)
+    return Session(
+        session_id,
+        turns=list(data.get("turns") or []),
+        search=data.get("search") or {},
+        keywords=list(data.get("keywords") or []),
+        query=data.get("query") or "",
+    )
+
+def _decayed(search: Dict[str, Any], factor: float) -> Dict[str, Any]:
+    # Copia: lo guardado puede ser el mismo objeto que vive en la caché en memoria
+    hits = [{**h, "score": (h.get("score") or 0.0) * factor} for h in (search.get("paragraphs") or {}).get("results") or []]
+    return {**search, "paragraphs": {**(search.get("paragraphs") or {}), "results": hits}}
+
+def plan_followup(session: Session, question: str) -> FollowUp:
+    terms = keywords(question)
+    if not session.paragraphs:
+        mode = "new_topic" if session.turns else "new"
+        return FollowUp(mode, terms[:_MAX_KEYWORDS])
+    known = set(session.keywords)
+    new = [t for t in terms if t not in known and t not in _CARRY_WORDS]
+    if not new:
+        return FollowUp("reuse", session.keywords, prior=session.search)
+    overlap = sum(1 for t in terms if t in known)
+    if len(new) >= _NEW_TOPIC_TERMS and len(new) > overlap:
+        return FollowUp("new_topic", terms[:_MAX_KEYWORDS], new_terms=new)
+    topic = session.keywords
+    if any(t in _SEDES for t in new):
+        topic = [t for t in topic if t not in _SEDES]
+    anchor = topic[-_ANCHOR_TERMS:]
+    return FollowUp(
+        "incremental",
+        (topic + new)[-_MAX_KEYWORDS:],
+        new_terms=new,
+        query=" ".join(anchor + new),
+        prior=_decayed(session.search, SESSION_REUSE_DECAY),
+    )
+
+def _compact_answer(answer: str) -> str:
+    # Las fuentes ya están en los párrafos: en el historial solo ocupan tokens
+    head, _sep, _tail = (answer or "").partition(_SOURCES_HEAD)
+    return head.strip()
+
+def history_messages(session: Optional[Session], budget: int = SESSION_HISTORY_TOKENS) -> Tuple[List[Dict[str, str]], int]:
+    """Turnos previos como mensajes user/assistant dentro de `budget` tokens; devuelve (mensajes, tokens)."""
+    if session is None or not session.turns or budget <= 0:
+        return [], 0
+    picked: List[Tuple[str, str]] = []
+    used = 0
+    for turn in reversed(session.turns):
+        q, a = turn.get("q") or "", turn.get("a") or ""
+        if not q or not a:
+            continue  # la API no acepta mensajes vacíos
+        cost = estimate_tokens(q) + estimate_tokens(a)
+        if used + cost > budget:
+            room = budget - used - estimate_tokens(q)
+            if not picked and room > 20:
+                # El turno más reciente siempre entra, aunque sea recortado
+                a = a[: int(room * 3.5)].rstrip() + " …"
+                picked.append((q, a))
+                used += estimate_tokens(q) + estimate_tokens(a)
+            break
+        picked.append((q, a))
+        used += cost
+    messages: List[Dict[str, str]] = []
+    for q, a in reversed(picked):
+        messages += [{"role": "user", "content": q}, {"role": "assistant", "content": a}]
+    return messages, used
+
+def _prune_search(search: Dict[str, Any], max_chunks: int) -> Dict[str, Any]:
+    hits = ((search.get("paragraphs") or {}).get("results") or [])[:max_chunks]
+    rids = {h.get("rid") or h.get("resource") for h in hits}
+    resources = search.get("resources") or {}
+    return {
+        "paragraphs": {"results": hits},
+        "resources": {rid: info for rid, info in resources.items() if rid in rids} if isinstance(resources, dict) else {},
+    }
+
+def save_turn(
+    session: Session,
+    question: str,
+    answer: str,
+    followup: FollowUp,
+    *,
+    search: Optional[Dict[str, Any]] = None,
+    query: str = "",
+    max_chunks: int = 20,
+) -> None:
+    """Agrega el turno y guarda la sesión (renueva su TTL). Sin `search` se conservan los párrafos previos."""
+    if session_store is None:
+        return
+    session_totals[followup.mode] += 1
+    turns = (session.turns + [{"q": question, "a": _compact_answer(answer)}])[-max(1, SESSION_MAX_TURNS):]
+    paragraphs = session.search if search is None else _prune_search(search, max_chunks)
+    session_store.set(session.id, {
+        "turns": turns,
+        "search": paragraphs,
+        "keywords": followup.keywords,
+        "query": query or session.query,
+    })
+
+def end_session(session_id: str) -> bool:
+    if session_store is None or session_store.get(session_id) is None:
+        return False
+    session_store.delete(session_id)
+    return True
+
+def session_stats() -> Dict[str, Any]:
+    if session_store is None:
+        return {"backend": "off"}
+    return {
+        "backend": session_store.backend,
+        "sessions": len(session_store),
+        "max_entries": session_store.max_entries,
+        "ttl": session_store.ttl,
+        "history_tokens": SESSION_HISTORY_TOKENS,
+        "turns": dict(session_totals),
+    }
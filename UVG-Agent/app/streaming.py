@@ -0,0 +1,376 @@
+# app/streaming.py
+from __future__ import annotations
+import asyncio
+import json
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Dict, List, Optional, Tuple, TypeVar
+
+from .agent import (
+    _EMPTY_REPLY,
+    _fallback_answer,
+    _FIX_HEADERS,
+    _NO_CONTEXT_REPLY,
+    _context_paragraphs,
+    _retrieve,
+    _session_meta,
+    _user_content,
+    _wants_structure,
+    degraded_search,
+    extract_sources_info,
+    faq_meta,
+    govern_prompt,
+    offtopic_reply,
+    smalltalk_reply,
+)
+from .faq import faq_lookup
+from .intents import route_intent
+from .clients import get_async_llm
+from .cache import answer_cache, answer_key
+from .formatter import DEFAULT_NEXT_STEP, source_lines
+from .admission import admission
+from .deadline import Deadline, DeadlineExceeded, estimate, observe, start_deadline
+from .resilience import guarded, is_upstream_error, stale_totals
+from .limits import gate
+from .llm import system_prompt
+from .metrics import span
+from .sessions import history_messages, load_session, plan_followup, save_turn
+from .models import choose_tier, model_totals, observe_call
+from .tokens import allow, attribute, output_cap
+from .resilience import is_overloaded
+from .config import INSTRUCTIONS, TEMPERATURE, OFFTOPIC_ROUTING
+
+Event = Tuple[str, Dict[str, Any]]
+T = TypeVar("T")
+
+_HEAD = "# Respuesta"
+
+# Refuerzo del esquema cuando no hay segunda pasada de reformateo
+_SCHEMA_HINT = (
+    "\n\nUsa obligatoriamente el esquema Markdown: # Respuesta, ## Detalles, "
+    "## Siguientes pasos y ## Fuentes consultadas."
+)
+
+def sse(event: str, data: Dict[str, Any]) -> str:
+    """Serializa un evento en formato Server-Sent Events."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+class StructureGuard:
+    """
+    Reemplazo incremental de `_needs_fix` para respuestas en streaming.
+
+    En lugar de una segunda llamada al LLM:
+      - Si la respuesta no arranca con "# Respuesta", antepone el encabezado.
+      - Al cerrar, agrega "## Siguientes pasos" y "## Fuentes consultadas" si faltaron.
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.text = ""
+        self.patched: List[str] = []
+        # Buffer del inicio mientras no sabemos si trae el encabezado
+        self._head: Optional[str] = "" if enabled else None
+
+    def feed(self, chunk: str) -> str:
+        """Recibe un delta del LLM y devuelve el texto a emitir (puede ser vacío)."""
+        if self._head is None:
+            self.text += chunk
+            return chunk
+        self._head += chunk
+        probe = self._head.lstrip()
+        if len(probe) < len(_HEAD) and _HEAD.startswith(probe):
+            return ""
+        return self._release()
+
+    def _release(self) -> str:
+        out, self._head = self._head or "", None
+        if out.strip() and not out.lstrip().startswith(_HEAD):
+            out = f"{_HEAD}\n" + out.lstrip()
+            self.patched.append(_HEAD)
+        self.text += out
+        return out
+
+    def finish(self, sources: List[dict]) -> str:
+        """Cierra el stream y devuelve las secciones faltantes que se pueden completar localmente."""
+        tail = self._release() if self._head is not None else ""
+        if not self.enabled or not self.text.strip():
+            return tail
+        extra = []
+        if "## Siguientes pasos" not in self.text:
+            extra.append(f"## Siguientes pasos\n1) {DEFAULT_NEXT_STEP}")
+            self.patched.append("## Siguientes pasos")
+        if "## Fuentes consultadas" not in self.text and sources:
+            extra.append("## Fuentes consultadas\n" + "\n".join(source_lines(sources)))
+            self.patched.append("## Fuentes consultadas")
+        if extra:
+            add = "\n\n" + "\n\n".join(extra)
+            self.text += add
+            tail += add
+        return tail
+
+    @property
+    def missing(self) -> List[str]:
+        if not self.enabled:
+            return []
+        return [h for h in _FIX_HEADERS if h not in self.text]
+
+def _stale_answer(key: Optional[str], exc: BaseException) -> Optional[Dict[str, Any]]:
+    """Última respuesta buena para `key` si el fallo fue del upstream (stale-if-error)."""
+    if answer_cache is None or key is None or not is_upstream_error(exc):
+        return None
+    stale = answer_cache.get_stale(key)
+    if stale is not None:
+        stale_totals["answer"] += 1
+    return stale
+
+# ── Plazo del stream
+# `within` no sirve para un stream: la generación entrega tokens mientras corre. Cada
+# espera (abrir el stream, cada delta, el mensaje final) se acota con lo que le queda al
+# plazo, así que quedan cortados tanto el tiempo al primer token como el stream completo.
+async def _until_deadline(aw: Awaitable[T], budget: Optional[Deadline]) -> T:
+    if budget is None or budget.expires is None:
+        return await aw
+    timeout = budget.remaining()
+    if timeout <= 0:
+        if asyncio.iscoroutine(aw):
+            aw.close()
+        raise DeadlineExceeded("generation")
+    try:
+        return await asyncio.wait_for(aw, timeout)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded("generation") from None
+
+@asynccontextmanager
+async def _open_stream(manager: Any, budget: Optional[Deadline]) -> AsyncIterator[Any]:
+    stream = await _until_deadline(manager.__aenter__(), budget)
+    try:
+        yield stream
+    except BaseException as e:
+        await manager.__aexit__(type(e), e, e.__traceback__)
+        raise
+    await manager.__aexit__(None, None, None)
+
+async def _deltas(stream: Any, budget: Optional[Deadline]) -> AsyncIterator[str]:
+    it = stream.text_stream.__aiter__()
+    while True:
+        try:
+            yield await _until_deadline(it.__anext__(), budget)
+        except StopAsyncIteration:
+            return
+
+def _usage_dict(usage: Any) -> Dict[str, int]:
+    return {
+        kind: getattr(usage, kind, 0) or 0
+        for kind in ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens")
+    }
+
+# ── Pipeline en streaming: sources → token* → done
+async def ask_agent_stream(
+    question: str,
+    *,
+    size: int = 30,
+    max_chunks: int = 20,
+    use_semantic: bool = True,
+    min_score: float = 0.0,
+    deadline: Optional[float] = None,
+    session_id: Optional[str] = None,
+) -> AsyncIterator[Event]:
+    t0 = time.perf_counter()
+    budget = start_deadline(deadline)
+
+    def elapsed() -> float:
+        return round((time.perf_counter() - t0) * 1000, 1)
+
+    # Respuestas sin RAG: un solo bloque de texto
+    canned, routed = None, None
+    if not question or not question.strip():
+        canned = _EMPTY_REPLY
+    else:
+        routed = route_intent(question)
+        if routed.intent == "greeting":
+            canned = smalltalk_reply()
+        elif routed.intent == "offtopic" and OFFTOPIC_ROUTING:
+            canned = offtopic_reply()
+    if canned is not None:
+        yield "sources", {"sources": []}
+        yield "token", {"text": canned}
+        yield "done", {"usage": _usage_dict(None), "timing": {"total_ms": elapsed()}}
+        return
+
+    faq = faq_lookup(question)
+    if faq is not None:
+        yield "sources", {"sources": faq.sources}
+        yield "token", {"text": faq.answer}
+        yield "done", {"usage": _usage_dict(None), "timing": {"total_ms": elapsed()}, "faq": faq_meta(faq)}
+        return
+
+    # Los seguimientos de una sesión dependen del historial: sin caché de respuestas
+    session = load_session(session_id)
+    key = answer_key(question, size=size, max_chunks=max_chunks, use_semantic=use_semantic, min_score=min_score)
+    if session is not None and session.turns:
+        key = None
+    cached = answer_cache.get(key) if answer_cache is not None and key is not None else None
+    if cached is not None:
+        yield "sources", {"sources": cached.get("sources", [])}
+        yield "token", {"text": cached.get("answer", "")}
+        done = {"usage": _usage_dict(None), "timing": {"total_ms": elapsed()}, "cached": True}
+        if session is not None:
+            followup = plan_followup(session, question)
+            save_turn(session, question, cached.get("answer", ""), followup,
+                      search=cached.get("search_results") or {}, max_chunks=max_chunks)
+            done["session"] = _session_meta(session, followup, 0, 0)
+        yield "done", done
+        return
+    followup = plan_followup(session, question) if session is not None else None
+
+    # Solo este camino llega a Claude: pide cupo de generación (o se rechaza con 503)
+    async with admission():
+        try:
+            r = await _retrieve(
+                question,
+                size=size,
+                max_chunks=max_chunks,
+                use_semantic=use_semantic,
+                min_score=min_score,
+                followup=followup,
+            )
+        except DeadlineExceeded:
+            r = None
+        except Exception as e:
+            stale = _stale_answer(key, e)
+            if stale is None:
+                raise
+            yield "sources", {"sources": stale.get("sources", [])}
+            yield "token", {"text": stale.get("answer", "")}
+            yield "done", {"usage": _usage_dict(None), "timing": {"total_ms": elapsed()}, "cached": True,
+                           "stale": {"reason": type(e).__name__}}
+            return
+        guard = StructureGuard(_wants_structure(question))
+        suffix = _SCHEMA_HINT if guard.enabled else ""
+        history, history_tokens = history_messages(session)
+        tokens: Dict[str, Any] = {}
+        if r is not None:
+            r, tokens = govern_prompt(r, question, history_tokens, suffix)
+        sources = extract_sources_info(r.selected, max_chunks=r.max_chunks, score_threshold=min_score) if r else []
+        timing: Dict[str, float] = {"retrieval_ms": elapsed()}
+        yield "sources", {"sources": sources}
+
+        # Plazo o cuota agotados antes de generar: solo las fuentes con una respuesta breve
+        in_time = r is not None and (budget is None or budget.allows("generation"))
+        if not in_time or not allow("generation"):
+            done = {"usage": _usage_dict(None), "timing": timing, "retrieval": r.info if r else {}}
+            if in_time:
+                tokens["quota"] = "exceeded"
+                done["tokens"] = tokens
+            else:
+                budget.degrade("fallback_answer")
+            if budget is not None:
+                done["deadline"] = budget.as_dict()
+            yield "token", {"text": _fallback_answer(sources)}
+            timing["total_ms"] = elapsed()
+            yield "done", done
+            return
+
+        content = _user_content(question, r.context, r.no_context, suffix)
+        choice = choose_tier(question, routed.intent, _context_paragraphs(r), guard.enabled)
+
+        # El stream no se reintenta (ya pudo emitir tokens), pero sí pasa por el breaker;
+        # un overloaded antes del primer token cambia de tier
+        final, truncated, t_gen = None, False, time.monotonic()
+        try:
+            async with gate("llm"):
+                with span("generation", upstream="anthropic"):
+                    while True:
+                        tier, t_call = choice.tier, time.perf_counter()
+                        try:
+                            async with guarded("anthropic"), _open_stream(get_async_llm().messages.stream(
+                                model=tier.model,
+                                max_tokens=output_cap(tier.max_tokens),
+                                temperature=TEMPERATURE,
+                                system=system_prompt(INSTRUCTIONS, tier.model),
+                                messages=history + [{"role": "user", "content": content}],
+                            ), budget) as stream:
+                                async for delta in _deltas(stream, budget):
+                                    if "ttft_ms" not in timing:
+                                        timing["ttft_ms"] = elapsed()
+                                    out = guard.feed(delta)
+                                    if out:
+                                        yield "token", {"text": out}
+                                final = await _until_deadline(stream.get_final_message(), budget)
+                        except DeadlineExceeded:
+                            raise
+                        except Exception as e:
+                            model_totals[(tier.name, "overloaded" if is_overloaded(e) else "error")] += 1
+                            if "ttft_ms" not in timing and choice.fallback(e):
+                                continue
+                            raise
+                        observe_call(tier, time.perf_counter() - t_call, "ok", getattr(final, "usage", None))
+                        break
+            if budget is not None:
+                observe("generation", time.monotonic() - t_gen)
+        except DeadlineExceeded:
+            # Cortada antes de terminar: su duración real fue al menos la estimada
+            observe("generation", max(time.monotonic() - t_gen, estimate("generation")))
+            if guard.text:
+                # Ya hay tokens en el cliente: se cierra lo emitido y se avisa en `done`
+                truncated = True
+            else:
+                # Nada emitido todavía: la misma salida que /ask (vencida o solo las fuentes)
+                stale = answer_cache.get_stale(key) if answer_cache is not None and key is not None else None
+                if stale is not None:
+                    stale_totals["answer"] += 1
+                else:
+                    budget.degrade("fallback_answer")
+                yield "token", {"text": stale.get("answer", "") if stale is not None else _fallback_answer(sources)}
+                timing["total_ms"] = elapsed()
+                done = {"usage": _usage_dict(None), "timing": timing, "retrieval": r.info,
+                        "deadline": budget.as_dict()}
+                if stale is not None:
+                    done.update(cached=True, stale={"reason": "DeadlineExceeded"})
+                yield "done", done
+                return
+        except Exception as e:
+            # Sin tokens emitidos todavía: se puede responder con la última respuesta buena
+            stale = _stale_answer(key, e) if not guard.text else None
+            if stale is None:
+                raise
+            yield "token", {"text": stale.get("answer", "")}
+            timing["total_ms"] = elapsed()
+            yield "done", {"usage": _usage_dict(None), "timing": timing, "cached": True,
+                           "stale": {"reason": type(e).__name__}}
+            return
+        tail = guard.finish(sources)
+        if tail:
+            yield "token", {"text": tail}
+
+        # Sin contexto y respuesta pobre: agrega la guía UVG
+        if r.no_context and len(guard.text.strip()) < 20:
+            yield "token", {"text": ("\n\n" if guard.text.strip() else "") + _NO_CONTEXT_REPLY}
+        elif answer_cache is not None and key is not None and not r.no_context and not truncated \
+                and not (budget and budget.applied) and not degraded_search(r.info):
+            answer_cache.set(key, {
+                "answer": guard.text.strip(),
+                "sources": sources,
+                "search_results": r.search,
+                "meta": {"retrieval": r.info},
+            })
+
+        timing["total_ms"] = elapsed()
+        tokens["prompt"] = attribute(tokens["estimated"], getattr(final, "usage", None))
+        done = {
+            "usage": _usage_dict(getattr(final, "usage", None)),
+            "timing": timing,
+            "structure": {"patched": guard.patched, "missing": guard.missing},
+            "retrieval": r.info,
+            "model": choice.as_dict(),
+            "tokens": tokens,
+        }
+        if truncated:
+            done["truncated"] = "deadline"
+        if budget is not None:
+            done["deadline"] = budget.as_dict()
+        if session is not None:
+            done["session"] = _session_meta(session, followup, len(history) // 2, history_tokens)
+            save_turn(session, question, guard.text, followup, search=r.selected,
+                      query=r.info.get("query", ""), max_chunks=r.max_chunks)
+        yield "done", done
@@ -0,0 +1,34 @@
+# app/text.py
+import re
+import unicodedata
+
+# ── Normalización de texto (claves de caché, comparaciones locales)
+_PUNCT_RE = re.compile(r"[^\w\s]", re.UNICODE)
+_SPACES_RE = re.compile(r"\s+")
+
+def fold_accents(text: str) -> str:
+    """'Inscripción' -> 'Inscripcion' (conserva la ñ)."""
+    text = text or ""
+    if text.isascii():  # el caso común en la tokenización: nada que plegar
+        return text
+    out = []
+    for ch in unicodedata.normalize("NFD", text):
+        if unicodedata.category(ch) == "Mn":
+            # La tilde de la ñ sí distingue palabras (año/ano)
+            if ch == "\u0303" and out and out[-1] in "nN":
+                out[-1] = "ñ" if out[-1] == "n" else "Ñ"
+            continue
+        out.append(ch)
+    return unicodedata.normalize("NFC", "".join(out))
+
+def normalize_question(text: str) -> str:
+    """Minúsculas, sin acentos, sin puntuación (¿?¡! incluidos) y espacios colapsados."""
+    q = fold_accents((text or "").lower())
+    q = _PUNCT_RE.sub(" ", q).replace("_", " ")
+    return _SPACES_RE.sub(" ", q).strip()
+
+def estimate_tokens(text: str) -> int:
+    """Estimación local de tokens (~3.5 caracteres por token en español)."""
+    if not text:
+        return 0
+    return max(1, round(len(text) / 3.5))
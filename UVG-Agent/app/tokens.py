@@ -0,0 +1,209 @@
+# app/tokens.py
+from __future__ import annotations
+import contextvars
+import datetime as dt
+import json
+import logging
+from collections import Counter, OrderedDict
+from typing import Any, Dict, Optional
+
+from .text import estimate_tokens
+from .config import (
+    PROMPT_TOKEN_BUDGET,
+    OUTPUT_TOKEN_BUDGET,
+    DAILY_TOKEN_QUOTA,
+    DAILY_TOKEN_RESERVE,
+    CLIENT_DAILY_TOKENS,
+)
+
+# ── Contabilidad y gobierno de tokens
+# Las tres llamadas a Claude (rewrite, generation, reformat) reportan su `usage` por
+# etapa (meta.usage, uvg_llm_tokens_total) y además:
+#   - El prompt de la generación se estima localmente antes de enviarlo, por partes
+#     (system / history / context / question). Si pasa PROMPT_TOKEN_BUDGET se recorta el
+#     contexto empezando por los párrafos de menor prioridad. Con el usage real, el
+#     reparto se escala al input facturado (meta.tokens, uvg_prompt_tokens_total{part}).
+#   - OUTPUT_TOKEN_BUDGET acota el max_tokens de cada llamada.
+#   - Cuotas diarias (todos los tipos de token; se reinician a medianoche local):
+#       DAILY_TOKEN_QUOTA    total del proceso. Pasado (1 - DAILY_TOKEN_RESERVE) de la cuota
+#                            ya no se reescribe ni se reformatea con Claude; agotada, se
+#                            responde solo con las fuentes.
+#       CLIENT_DAILY_TOKENS  por cliente (IP o CLIENT_ID_HEADER): 429 hasta el día siguiente.
+# Cada violación (prompt que no cabe, cuota agotada) cuenta en governor_totals y queda en
+# el log: la primera de cada tipo en el día como warning, las siguientes en debug.
+
+log = logging.getLogger("uvg.tokens")
+
+PROMPT_PARTS = ("system", "history", "context", "question")
+VIOLATIONS = (
+    "prompt_over_budget",   # system + historial + pregunta ya no caben: se envía sin contexto
+    "input_over_budget",    # el input real pasó el presupuesto (la estimación se quedó corta)
+    "quota_rewrite",
+    "quota_generation",
+    "quota_reformat",
+    "client_quota",
+)
+_INPUT_KINDS = ("input_tokens", "cache_creation_input_tokens", "cache_read_input_tokens")
+
+governor_totals: Counter = Counter()   # trimmed, trimmed_tokens y las VIOLATIONS
+prompt_totals: Counter = Counter()     # parte del prompt -> tokens de input atribuidos
+
+# ── Estimación
+def count_tokens(value: Any) -> int:
+    """Tokens estimados de un system, un contenido o una lista de mensajes (texto o bloques)."""
+    if not value:
+        return 0
+    if isinstance(value, str):
+        return estimate_tokens(value)
+    if isinstance(value, dict):  # bloque {"text"} o mensaje {"content"}
+        return count_tokens(value.get("text")) + count_tokens(value.get("content"))
+    if isinstance(value, (list, tuple)):
+        return sum(count_tokens(v) for v in value)
+    return 0
+
+def input_tokens(usage: Any) -> int:
+    """Input facturado de una llamada, incluida la escritura/lectura de la caché de prompts."""
+    return sum(getattr(usage, kind, 0) or 0 for kind in _INPUT_KINDS) if usage is not None else 0
+
+def output_cap(max_tokens: int) -> int:
+    return min(max_tokens, OUTPUT_TOKEN_BUDGET) if OUTPUT_TOKEN_BUDGET > 0 else max_tokens
+
+def attribute(parts: Dict[str, int], usage: Any) -> Dict[str, int]:
+    """Reparte el input real de la generación entre las partes, en proporción a lo estimado."""
+    estimated, actual = sum(parts.values()), input_tokens(usage)
+    if not estimated or not actual:
+        return {}
+    out = {part: round(n * actual / estimated) for part, n in parts.items()}
+    prompt_totals.update(out)
+    if 0 < PROMPT_TOKEN_BUDGET < actual:
+        violation("input_over_budget", estimated=estimated, actual=actual, budget=PROMPT_TOKEN_BUDGET)
+    return out
+
+# ── Violaciones
+_warned: Dict[str, dt.date] = {}
+
+def violation(kind: str, **fields: Any) -> None:
+    governor_totals[kind] += 1
+    today = dt.date.today()
+    first = _warned.get(kind) != today
+    _warned[kind] = today
+    log.log(logging.WARNING if first else logging.DEBUG,
+            json.dumps({"event": "token_violation", "kind": kind, **fields}, ensure_ascii=False))
+
+# ── Cuotas diarias
+def _seconds_to_midnight() -> float:
+    now = dt.datetime.now()
+    tomorrow = dt.datetime.combine(now.date() + dt.timedelta(days=1), dt.time())
+    return (tomorrow - now).total_seconds()
+
+class DailyQuota:
+    """Tokens consumidos hoy por etapa, contra `limit` (0 = sin cuota)."""
+
+    def __init__(self, limit: int, reserve: float = 0.0):
+        self.limit = limit
+        self.reserve = min(max(reserve, 0.0), 1.0)
+        self.day = dt.date.today()
+        self.used: Counter = Counter()
+
+    def _roll(self) -> None:
+        today = dt.date.today()
+        if today != self.day:
+            self.day, self.used = today, Counter()
+
+    def charge(self, stage: str, n: int) -> None:
+        self._roll()
+        self.used[stage] += n
+
+    def total(self) -> int:
+        self._roll()
+        return sum(self.used.values())
+
+    def allows(self, stage: str) -> bool:
+        """La generación puede usar toda la cuota; rewrite y reformat dejan libre la reserva."""
+        if self.limit <= 0:
+            return True
+        cap = self.limit if stage == "generation" else self.limit * (1 - self.reserve)
+        return self.total() < cap
+
+    def as_dict(self) -> Dict[str, Any]:
+        total = self.total()
+        return {
+            "limit": self.limit,
+            "reserve": self.reserve,
+            "day": self.day.isoformat(),
+            "used": total,
+            "by_stage": dict(self.used),
+            "remaining": max(0, self.limit - total) if self.limit > 0 else None,
+        }
+
+class ClientQuotas:
+    """Tokens del día por cliente; los clientes más viejos se olvidan pasado `max_clients`."""
+
+    def __init__(self, limit: int, max_clients: int = 10000):
+        self.limit = limit
+        self.max_clients = max_clients
+        self.day = dt.date.today()
+        self._used: "OrderedDict[str, int]" = OrderedDict()
+
+    def _roll(self) -> None:
+        today = dt.date.today()
+        if today != self.day:
+            self.day = today
+            self._used.clear()
+
+    def charge(self, client: str, n: int) -> None:
+        self._roll()
+        self._used[client] = self._used.get(client, 0) + n
+        self._used.move_to_end(client)
+        if len(self._used) > self.max_clients:
+            self._used.popitem(last=False)
+
+    def wait(self, client: str) -> float:
+        """0 si el cliente tiene cuota; si no, segundos hasta que se reinicie."""
+        self._roll()
+        if self._used.get(client, 0) < self.limit:
+            return 0.0
+        violation("client_quota", client=client, used=self._used[client], limit=self.limit)
+        return _seconds_to_midnight()
+
+    def as_dict(self) -> Dict[str, Any]:
+        self._roll()
+        return {"limit": self.limit, "clients": len(self._used), "exhausted": sum(
+            1 for n in self._used.values() if n >= self.limit
+        )}
+
+quota = DailyQuota(DAILY_TOKEN_QUOTA, DAILY_TOKEN_RESERVE)
+client_quotas: Optional[ClientQuotas] = ClientQuotas(CLIENT_DAILY_TOKENS) if CLIENT_DAILY_TOKENS > 0 else None
+
+# Cliente del request actual (lo fija main al admitirlo; las tareas de un lote lo heredan)
+_client: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("uvg_token_client", default=None)
+
+def use_client(client: str) -> None:
+    _client.set(client)
+
+def charge(stage: str, n: int) -> None:
+    """Suma `n` tokens de una llamada a Claude a la cuota del día (y a la del cliente)."""
+    quota.charge(stage, n)
+    client = _client.get()
+    if client_quotas is not None and client is not None:
+        client_quotas.charge(client, n)
+
+def allow(stage: str) -> bool:
+    """¿Queda cuota para esta llamada? Si no, la registra como violación."""
+    if quota.allows(stage):
+        return True
+    violation(f"quota_{stage}", used=quota.total(), limit=quota.limit)
+    return False
+
+def client_wait(client: str) -> float:
+    return client_quotas.wait(client) if client_quotas is not None else 0.0
+
+def token_stats() -> Dict[str, Any]:
+    return {
+        "prompt_budget": PROMPT_TOKEN_BUDGET,
+        "output_budget": OUTPUT_TOKEN_BUDGET,
+        "quota": quota.as_dict(),
+        "clients": client_quotas.as_dict() if client_quotas is not None else {"enabled": False},
+        "prompt": {part: prompt_totals[part] for part in PROMPT_PARTS},
+        "governor": dict(governor_totals),
+    }
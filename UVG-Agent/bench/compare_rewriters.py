@@ -0,0 +1,104 @@
+"""
+Comparación offline de los motores de reescritura de consultas.
+
+Para cada pregunta se reescribe con el motor local y con Claude, se busca en Nuclia
+con ambas consultas y se reporta cuánto se solapan los párrafos recuperados.
+
+    python -m bench.compare_rewriters                      # preguntas de ejemplo
+    python -m bench.compare_rewriters -f preguntas.txt -k 10 --json reporte.json
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import List
+
+from app.clients import close_clients
+from app.llm import llm_rewrite_async
+from app.nuclia import nuclia_search_async, paragraph_key
+from app.rewriter import local_rewrite
+
+SAMPLE_QUESTIONS = [
+    "¿Cuáles son los requisitos de admisión?",
+    "¿Cuánto cuesta el arancel de Ingeniería en Computación?",
+    "¿Qué becas ofrece la UVG?",
+    "¿Dónde puedo ver el pensum de Biotecnología?",
+    "¿Cuándo empieza el primer ciclo académico?",
+    "¿Qué carreras hay en el Campus Altiplano?",
+    "¿Cómo me inscribo a un curso en el Campus Sur?",
+    "¿Qué horario tiene la biblioteca?",
+    "¿Qué es el MakerSpace y cómo lo uso?",
+    "¿Hay financiamiento para maestrías?",
+]
+
+def _top_keys(search: dict, k: int) -> List[tuple]:
+    hits = (search.get("paragraphs") or {}).get("results", [])[:k]
+    return [paragraph_key(h) for h in hits]
+
+async def compare(questions: List[str], k: int, size: int) -> dict:
+    rows = []
+    try:
+        for q in questions:
+            local = local_rewrite(q)
+            t0 = time.perf_counter()
+            llm_query = await llm_rewrite_async(q)
+            llm_ms = (time.perf_counter() - t0) * 1000
+
+            local_search, llm_search = await asyncio.gather(
+                nuclia_search_async(local.query, size=size),
+                nuclia_search_async(llm_query, size=size),
+            )
+            a, b = set(_top_keys(local_search, k)), set(_top_keys(llm_search, k))
+            union = a | b
+            rows.append({
+                "question": q,
+                "local_query": local.query,
+                "local_confidence": local.confidence,
+                "llm_query": llm_query,
+                "llm_ms": round(llm_ms, 1),
+                "overlap_at_k": round(len(a & b) / k, 3),
+                "jaccard": round(len(a & b) / len(union), 3) if union else 1.0,
+                "local_hits": len(a),
+                "llm_hits": len(b),
+            })
+    finally:
+        await close_clients()
+
+    n = len(rows) or 1
+    return {
+        "k": k,
+        "questions": len(rows),
+        "mean_overlap_at_k": round(sum(r["overlap_at_k"] for r in rows) / n, 3),
+        "mean_jaccard": round(sum(r["jaccard"] for r in rows) / n, 3),
+        "mean_llm_ms": round(sum(r["llm_ms"] for r in rows) / n, 1),
+        "rows": rows,
+    }
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Compara la reescritura local vs Claude por solapamiento de resultados.")
+    ap.add_argument("-f", "--file", help="archivo con una pregunta por línea")
+    ap.add_argument("-k", type=int, default=10, help="párrafos a comparar (top-k)")
+    ap.add_argument("--size", type=int, default=30, help="resultados pedidos a Nuclia")
+    ap.add_argument("--json", help="guarda el reporte completo en este archivo")
+    args = ap.parse_args()
+
+    questions = SAMPLE_QUESTIONS
+    if args.file:
+        with open(args.file, encoding="utf-8") as fh:
+            questions = [line.strip() for line in fh if line.strip()]
+
+    report = asyncio.run(compare(questions, args.k, args.size))
+    for r in report["rows"]:
+        print(f"{r['overlap_at_k']:>5.2f}  conf={r['local_confidence']:.2f}  {r['question']}")
+        print(f"       local: {r['local_query']}")
+        print(f"       llm:   {r['llm_query']}  ({r['llm_ms']} ms)")
+    print(
+        f"\noverlap@{report['k']} promedio: {report['mean_overlap_at_k']}  "
+        f"jaccard: {report['mean_jaccard']}  latencia LLM media: {report['mean_llm_ms']} ms"
+    )
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Micro-benchmark del router de intenciones contra el `classify_intent` original.
+
+Mide µs por llamada sobre un set de preguntas y muestra en cuáles difieren las
+intenciones (el router nuevo distingue offtopic y no toma "hola, ¿qué becas hay?"
+como saludo).
+
+    python -m bench.intent_router
+    python -m bench.intent_router -f preguntas.txt -n 20000
+"""
+import argparse
+import re
+import timeit
+from typing import List
+
+from app.intents import route_intent
+
+from bench.compare_rewriters import SAMPLE_QUESTIONS
+
+EXTRA_QUESTIONS = [
+    "hola",
+    "Buenas tardes, ¿qué tal?",
+    "Hola, ¿qué becas hay en el Campus Sur?",
+    "¿Cuánto cuesta la mensualidad de Ingeniería?",
+    "¿Cuándo empiezan las clases del segundo ciclo?",
+    "¿Me das una receta de pepián?",
+    "¿Quién ganó el partido de fútbol ayer?",
+    "¿Cómo creo una cuenta en el portal?",
+    "¿Qué necesito para inscribirme?",
+    "Quiero información sobre el Altiplano",
+]
+
+# ── Implementación original (copiada tal cual para comparar)
+_GREET_RE = re.compile(r"\b(hola|buen[oa]s|qué tal|como estas|¿cómo estás|hi|hello)\b", re.I)
+
+def legacy_classify_intent(question: str) -> str:
+    q = (question or "").strip().lower()
+    if not q:
+        return "unknown"
+    if _GREET_RE.search(q) and len(q.split()) <= 8:
+        return "greeting"
+    uvgtokens = [
+        "uvg", "altiplano", "campus sur", "campus central", "admisiones",
+        "carrera", "inscripción", "beca", "arancel", "pensum", "malla",
+        "calendario", "facultad", "laboratorio", "crea", "makerspace"
+    ]
+    if any(t in q for t in uvgtokens):
+        return "uvg"
+    return "unknown"
+
+def _per_call_us(fn, questions: List[str], number: int) -> float:
+    def run():
+        for q in questions:
+            fn(q)
+    return timeit.timeit(run, number=number) / (number * len(questions)) * 1e6
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Compara el router de intenciones con classify_intent original.")
+    ap.add_argument("-f", "--file", help="archivo con una pregunta por línea")
+    ap.add_argument("-n", "--number", type=int, default=5000, help="repeticiones del set completo")
+    args = ap.parse_args()
+
+    questions = SAMPLE_QUESTIONS + EXTRA_QUESTIONS
+    if args.file:
+        with open(args.file, encoding="utf-8") as fh:
+            questions = [line.strip() for line in fh if line.strip()]
+
+    legacy_us = _per_call_us(legacy_classify_intent, questions, args.number)
+    router_us = _per_call_us(lambda q: route_intent(q).intent, questions, args.number)
+    print(f"classify_intent original: {legacy_us:6.2f} µs/llamada")
+    print(f"router de intenciones:    {router_us:6.2f} µs/llamada  ({legacy_us / router_us:.2f}x)")
+
+    print("\nDiferencias:")
+    for q in questions:
+        old, new = legacy_classify_intent(q), route_intent(q)
+        if old != new.intent:
+            print(f"  {old:>9} -> {new.intent:<9} {q}  {new.features}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Prueba de carga offline del backend contra los stand-ins de ``bench.standins``.
+
+Levanta los stand-ins de Nuclia y Anthropic, arranca la app con uvicorn apuntando
+``NUCLIA_API_BASE`` y ``ANTHROPIC_BASE_URL`` a ellos y, para cada nivel de
+concurrencia, reporta p50/p95/p99, requests por segundo y llamadas upstream.
+
+    python -m bench.load                                   # /ask a 1, 4, 16 y 32
+    python -m bench.load -e search -e file -c 1,8,32 -n 200
+    python -m bench.load --set CONTEXT_PACKING=true --set QUERY_REWRITER=local --json reporte.json
+    python -m bench.load --target http://127.0.0.1:8000    # app ya levantada (con los stand-ins)
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+from bench.compare_rewriters import SAMPLE_QUESTIONS
+from bench.standins import CORPUS, add_config_args, config_from_args, start_standins
+
+ROOT = Path(__file__).resolve().parent.parent
+ENDPOINTS = ("ask", "stream", "search", "file")
+
+# Por defecto se miden los caminos completos: sin caché de respuestas ni de búsquedas.
+# Todo el tráfico sale de una sola IP: sin tope por cliente aunque el entorno lo active
+BENCH_ENV = {
+    "KB": "bench-kb",
+    "NUCLIA_TOKEN": "bench",
+    "ANTHROPIC_KEY": "bench",
+    "ANSWER_CACHE_BACKEND": "off",
+    "SEARCH_CACHE_TTL": "0",
+    "REQUEST_LOG": "false",
+    "CLIENT_RATE_PER_MIN": "0",
+    "CLIENT_DAILY_TOKENS": "0",
+}
+
+def admission_env(max_concurrency: int) -> Dict[str, str]:
+    """Cupos y cola de admisión que admiten el nivel más alto sin rechazar (503)."""
+    n = max(1, max_concurrency)
+    return {"ADMISSION_MAX_ACTIVE": str(n), "ADMISSION_QUEUE_SIZE": str(n)}
+
+def percentile(values: List[float], p: float) -> float:
+    """Percentil por rango más cercano (values ya ordenados)."""
+    if not values:
+        return 0.0
+    k = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[k]
+
+def _request_args(endpoint: str, i: int) -> Dict:
+    question = SAMPLE_QUESTIONS[i % len(SAMPLE_QUESTIONS)]
+    if endpoint == "ask":
+        return {"method": "POST", "url": "/ask", "json": {"query": question}}
+    if endpoint == "stream":
+        return {"method": "POST", "url": "/ask/stream", "json": {"query": question}}
+    if endpoint == "search":
+        return {"method": "GET", "url": "/search", "params": {"query": question}}
+    rid = CORPUS[i % len(CORPUS)][0]
+    return {"method": "GET", "url": f"/resources/{rid}/file"}
+
+async def run_level(target: str, endpoint: str, concurrency: int, total: int, timeout: float) -> dict:
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    counter = iter(range(total))
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=target, timeout=timeout, limits=limits) as http:
+        async def worker():
+            for i in counter:
+                t0 = time.perf_counter()
+                try:
+                    async with http.stream(**_request_args(endpoint, i)) as r:
+                        async for _ in r.aiter_raw():
+                            pass
+                    key = str(r.status_code)
+                except httpx.HTTPError as e:
+                    key = type(e).__name__
+                latencies.append(time.perf_counter() - t0)
+                statuses[key] = statuses.get(key, 0) + 1
+
+        t_start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall = time.perf_counter() - t_start
+
+    latencies.sort()
+    return {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": total,
+        "rps": round(total / wall, 2) if wall else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "max_ms": round(latencies[-1] * 1000, 1) if latencies else 0.0,
+        "status": statuses,
+    }
+
+def _upstream_stats(urls: List[str], reset: bool = False) -> Dict[str, int]:
+    out: Dict[str, int] = {}
+    for url in urls:
+        try:
+            if reset:
+                httpx.post(f"{url}/_bench/reset", timeout=5)
+            else:
+                out.update(httpx.get(f"{url}/_bench/stats", timeout=5).json())
+        except httpx.HTTPError:
+            pass
+    return out
+
+def _start_app(port: int, env: Dict[str, str], workers: int) -> subprocess.Popen:
+    cmd = [
+        sys.executable, "-m", "uvicorn", "app.main:app",
+        "--host", "127.0.0.1", "--port", str(port),
+        "--workers", str(workers), "--log-level", "warning",
+    ]
+    return subprocess.Popen(cmd, cwd=ROOT, env=env)
+
+def _wait_healthy(target: str, proc: Optional[subprocess.Popen], timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f"La app terminó al arrancar (código {proc.returncode})")
+        try:
+            if httpx.get(f"{target}/health", timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"La app no respondió /health en {timeout:.0f}s")
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Prueba de carga de /ask, /search y /resources contra stand-ins locales.")
+    ap.add_argument("-e", "--endpoint", action="append", choices=ENDPOINTS, help="endpoint a medir (repetible; default: ask)")
+    ap.add_argument("-c", "--concurrency", default="1,4,16,32", help="niveles de concurrencia separados por coma")
+    ap.add_argument("-n", "--requests", type=int, default=100, help="requests por nivel")
+    ap.add_argument("--timeout", type=float, default=60.0, help="timeout (s) por request")
+    ap.add_argument("--port", type=int, default=8100, help="puerto de la app")
+    ap.add_argument("--workers", type=int, default=1, help="workers de uvicorn")
+    ap.add_argument("--nuclia-port", type=int, default=8101)
+    ap.add_argument("--anthropic-port", type=int, default=8102)
+    ap.add_argument("--set", action="append", default=[], metavar="VAR=VALOR", help="variable de entorno extra para la app")
+    ap.add_argument("--target", help="URL de una app ya levantada (no arranca app ni stand-ins)")
+    ap.add_argument("--json", help="guarda el reporte completo en este archivo")
+    add_config_args(ap)
+    args = ap.parse_args()
+
+    endpoints = args.endpoint or ["ask"]
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    servers, proc = [], None
+    target = args.target
+
+    if target:
+        upstream_urls = [f"http://127.0.0.1:{args.nuclia_port}", f"http://127.0.0.1:{args.anthropic_port}"]
+    else:
+        servers = start_standins(config_from_args(args), nuclia_port=args.nuclia_port, anthropic_port=args.anthropic_port)
+        upstream_urls = [s.url for s in servers]
+        env = {**os.environ, **BENCH_ENV, **admission_env(max(levels, default=1))}
+        env["NUCLIA_API_BASE"] = f"{servers[0].url}/api/v1"
+        env["ANTHROPIC_BASE_URL"] = servers[1].url
+        for item in args.set:
+            name, _, value = item.partition("=")
+            env[name.strip()] = value
+        target = f"http://127.0.0.1:{args.port}"
+        proc = _start_app(args.port, env, args.workers)
+
+    rows = []
+    try:
+        _wait_healthy(target, proc)
+        for endpoint in endpoints:
+            for concurrency in levels:
+                _upstream_stats(upstream_urls, reset=True)
+                row = asyncio.run(run_level(target, endpoint, concurrency, args.requests, args.timeout))
+                row["upstream"] = _upstream_stats(upstream_urls)
+                rows.append(row)
+                print(
+                    f"{endpoint:<7} c={concurrency:<4} {row['rps']:>8.1f} rps  "
+                    f"p50={row['p50_ms']:>8.1f}  p95={row['p95_ms']:>8.1f}  p99={row['p99_ms']:>8.1f} ms  "
+                    f"status={row['status']}  upstream={row['upstream']}",
+                    flush=True,
+                )
+    finally:
+        if proc is not None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        for s in servers:
+            s.stop()
+
+    if args.json:
+        report = {"endpoints": endpoints, "levels": levels, "requests_per_level": args.requests,
+                  "settings": args.set, "rows": rows}
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Tamaño y tiempo de serialización de la respuesta de /ask, antes y después del recorte.
+
+Arma un resultado con la forma real de `ask_agent_async` (respuesta en Markdown,
+fuentes de `extract_sources_info` y la respuesta cruda de Nuclia con metadatos de
+recursos) y compara:
+
+  - antes:  dict completo por `jsonable_encoder` + `JSONResponse` (camino por defecto de FastAPI)
+  - después: `shape_answer` por cada `verbosity` + orjson, y gzip/brotli del modo debug
+
+    python -m bench.payload
+    python -m bench.payload -p 50 -c 1200 -n 500
+"""
+import argparse
+import gzip
+import json
+import random
+import timeit
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from app.agent import extract_sources_info
+from app.responses import brotli, dumps, orjson, shape_answer
+
+from bench.standins import CORPUS
+
+def synthetic_search(paragraphs: int, chars: int, seed: int = 7) -> dict:
+    """Respuesta con la forma de /find de Nuclia: párrafos largos + recursos con metadatos."""
+    rnd = random.Random(seed)
+    words = " ".join(text for *_rest, text in CORPUS).split()
+    results, resources = [], {}
+    for i in range(paragraphs):
+        rid, title, url, _text = CORPUS[i % len(CORPUS)]
+        rid = f"{rid}-{i // len(CORPUS)}"
+        text = ""
+        while len(text) < chars:
+            text += rnd.choice(words) + " "
+        results.append({
+            "rid": rid,
+            "field": "/f/file",
+            "field_type": "file",
+            "text": text.strip(),
+            "score": round(1.0 - i / (paragraphs * 1.5), 3),
+            "score_type": "BOTH",
+            "order": i,
+            "labels": ["/l/tipo/documento", "/l/sede/central"],
+            "position": {"page_number": 1 + i % 9, "index": i, "start": i * chars, "end": (i + 1) * chars},
+            "fuzzy_result": False,
+            "page_with_visual": False,
+            "is_a_table": False,
+        })
+        resources.setdefault(rid, {
+            "id": rid,
+            "slug": rid,
+            "title": title,
+            "summary": " ".join(rnd.choice(words) for _ in range(60)),
+            "icon": "application/pdf",
+            "created": "2025-01-10T15:00:00Z",
+            "modified": "2025-03-02T09:30:00Z",
+            "origin": {"url": url, "filename": f"{rid}.pdf", "tags": ["uvg", "oficial"]},
+            "metadata": {"language": "es", "languages": ["es"], "status": "PROCESSED"},
+            "usermetadata": {"classifications": [{"labelset": "tipo", "label": "documento"}]},
+            "fieldmetadata": [],
+            "computedmetadata": {"field_classifications": []},
+        })
+    return {
+        "paragraphs": {"results": results, "total": paragraphs, "page_number": 0, "page_size": paragraphs},
+        "resources": resources,
+        "fulltext": {"results": [], "total": 0},
+        "sentences": {"results": [], "total": 0},
+        "relations": {"entities": {}},
+        "shards": ["shard-1", "shard-2"],
+        "autofilters": [],
+    }
+
+def sample_result(paragraphs: int, chars: int) -> dict:
+    search = synthetic_search(paragraphs, chars)
+    sources = extract_sources_info(search, max_chunks=20)
+    answer = (
+        "# Respuesta\nLas becas cubren hasta el 50% del arancel.\n\n## Detalles\n"
+        + "\n".join(f"- punto {i}: {s['text'][:120]}" for i, s in enumerate(sources[:6]))
+        + "\n\n## Siguientes pasos\n1) Escribe a Ayuda Financiera.\n\n## Fuentes consultadas\n"
+        + "\n".join(f"- {s['title']} ({s['url']})" for s in sources[:6])
+    )
+    meta = {
+        "intent": {"name": "uvg", "features": {"uvg": ["beca"]}},
+        "retrieval": {"mode": "sequential", "path": "rewrite", "query": "beca arancel"},
+        "format": "ok",
+        "model": {"tier": "full", "model": "claude-3-5-sonnet-latest", "reasons": ["structured"]},
+        "deadline": {"budget_ms": 25000.0, "remaining_ms": 18000.0, "degraded": []},
+        "timing": {"total_ms": 4200.0, "stages": {"search": 800.0, "generation": 3200.0}},
+        "usage": {"generation": {"input_tokens": 3100, "output_tokens": 420}},
+    }
+    return {"answer": answer, "sources": sources, "search_results": search, "meta": meta}
+
+def _per_call_us(fn, number: int) -> float:
+    return timeit.timeit(fn, number=number) / number * 1e6
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Tamaño y serialización de /ask antes y después del recorte.")
+    ap.add_argument("-p", "--paragraphs", type=int, default=30, help="párrafos en la respuesta de Nuclia")
+    ap.add_argument("-c", "--chars", type=int, default=700, help="caracteres por párrafo")
+    ap.add_argument("-n", "--number", type=int, default=300, help="repeticiones por medición")
+    args = ap.parse_args()
+
+    result = sample_result(args.paragraphs, args.chars)
+    before = JSONResponse(jsonable_encoder(result)).body
+    before_us = _per_call_us(lambda: JSONResponse(jsonable_encoder(result)), args.number)
+    print(f"orjson: {'sí' if orjson else 'no'} · brotli: {'sí' if brotli else 'no'}\n")
+    print(f"{'forma':<34}{'bytes':>10}{'µs/resp':>10}")
+    print(f"{'antes (completo, jsonable_encoder)':<34}{len(before):>10}{before_us:>10.0f}")
+    for verbosity in ("debug", "answer+sources", "answer"):
+        body = dumps(shape_answer(result, verbosity))
+        us = _per_call_us(lambda: dumps(shape_answer(result, verbosity)), args.number)
+        print(f"{'después ' + verbosity:<34}{len(body):>10}{us:>10.0f}")
+
+    debug = dumps(shape_answer(result, "debug"))
+    print(f"\ndebug gzip (nivel 5): {len(gzip.compress(debug, compresslevel=5))} bytes")
+    if brotli is not None:
+        print(f"debug brotli (q4):    {len(brotli.compress(debug, quality=4))} bytes")
+    full = json.dumps(result, ensure_ascii=False).encode()
+    print(f"search_results = {len(dumps(result['search_results'])) / len(full):.0%} del JSON completo")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+"""
+Servidores sustitutos (stand-ins) de Nuclia y Anthropic para medir el backend sin red.
+
+- Nuclia: ``/api/v1/kb/{kb}/search`` con párrafos y recursos enlatados,
+  ``/api/v1/kb/{kb}/resources`` y ``/api/v1/kb/{kb}/resource/{rid}`` (lo que baja
+  ``python -m app.local_index sync``) y ``/api/v1/kb/{kb}/resource/{rid}/file/original``
+  con un PDF sintético.
+- Anthropic: ``/v1/messages`` (normal y ``stream``) con latencia hasta el primer
+  token y velocidad de tokens configurables.
+
+Cada stand-in cuenta sus llamadas en ``GET /_bench/stats`` (``POST /_bench/reset`` las
+reinicia), que es lo que usa ``bench.load`` para reportar llamadas upstream.
+
+    python -m bench.standins --nuclia-port 8101 --anthropic-port 8102 --llm-ttft 0.4 --token-rate 80
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+@dataclass
+class StandinConfig:
+    search_latency: float = 0.15   # s por búsqueda Nuclia
+    file_latency: float = 0.05     # s hasta el primer byte del archivo
+    file_size: int = 512 * 1024    # bytes del PDF sintético
+    llm_ttft: float = 0.4          # s hasta el primer token de Claude
+    token_rate: float = 80.0       # tokens/s generados (0 = instantáneo)
+    rewrite_latency: float = 0.3   # s de la llamada corta de reescritura
+
+# ── Corpus enlatado: (rid, título, url, texto)
+CORPUS = [
+    ("r-admision", "Guía de Admisiones", "https://www.uvg.edu.gt/admisiones/",
+     "Los requisitos de admisión incluyen título de diversificado, certificado de notas y la prueba de aptitud académica."),
+    ("r-admision", "Guía de Admisiones", "https://www.uvg.edu.gt/admisiones/",
+     "La inscripción se realiza en línea; después de pagar la cuota de admisión se agenda la prueba en el campus elegido."),
+    ("r-becas", "Becas y Ayuda Financiera", "https://www.uvg.edu.gt/becas/",
+     "Las becas cubren hasta el 50% del arancel y se renuevan cada ciclo si el estudiante mantiene el promedio requerido."),
+    ("r-becas", "Becas y Ayuda Financiera", "https://www.uvg.edu.gt/becas/",
+     "El financiamiento educativo permite diferir parte de la colegiatura; se solicita en la oficina de Ayuda Financiera."),
+    ("r-costos", "Aranceles 2025", "https://www.uvg.edu.gt/aranceles/",
+     "El arancel de Ingeniería en Ciencias de la Computación se paga en cuotas mensuales durante cada semestre."),
+    ("r-costos", "Aranceles 2025", "https://www.uvg.edu.gt/aranceles/",
+     "Las formas de pago incluyen tarjeta, transferencia bancaria y pago en agencias autorizadas."),
+    ("r-pensum", "Pensum Biotecnología Industrial", "https://www.uvg.edu.gt/pensum/biotecnologia/",
+     "El plan de estudios de Biotecnología Industrial tiene diez semestres con laboratorios desde el primer año."),
+    ("r-calendario", "Calendario Académico", "https://www.uvg.edu.gt/calendario/",
+     "El primer ciclo académico inicia en enero y el segundo ciclo en julio; las fechas de exámenes se publican al inicio de cada ciclo."),
+    ("r-sedes", "Sedes UVG", "https://www.uvg.edu.gt/sedes/",
+     "La UVG tiene sedes en Campus Central, Campus Altiplano en Sololá y Campus Sur en Escuintla."),
+    ("r-sedes", "Sedes UVG", "https://www.uvg.edu.gt/sedes/",
+     "El Campus Altiplano ofrece carreras de educación, ingeniería y ciencias sociales con horarios para estudiantes que trabajan."),
+    ("r-crea", "CREA y MakerSpace", "https://www.uvg.edu.gt/crea/",
+     "El MakerSpace del CREA presta impresoras 3D y cortadoras láser a estudiantes que completan la inducción."),
+    ("r-biblioteca", "Biblioteca", "https://www.uvg.edu.gt/biblioteca/",
+     "La biblioteca abre de lunes a sábado y ofrece acceso remoto a bases de datos para estudiantes y docentes."),
+]
+
+_WORD_RE = re.compile(r"\w+")
+
+def _terms(text: str) -> set:
+    return {w for w in _WORD_RE.findall(text.lower()) if len(w) > 3}
+
+def canned_search(query: str, top_k: int) -> dict:
+    """Respuesta con la forma de /search de Nuclia; el score depende del solapamiento de términos."""
+    q = _terms(query)
+    scored = []
+    for i, (rid, title, url, text) in enumerate(CORPUS):
+        overlap = len(q & _terms(text + " " + title))
+        scored.append((0.3 + 0.7 * overlap / (len(q) or 1), i))
+    scored.sort(reverse=True)
+    results, resources = [], {}
+    for score, i in scored[:top_k]:
+        rid, title, url, text = CORPUS[i]
+        results.append({
+            "rid": rid,
+            "field": "/f/file",
+            "field_type": "file",
+            "text": text,
+            "score": round(min(score, 1.0), 3),
+            "position": {"page_number": 1 + i % 3, "start": 0, "end": len(text)},
+        })
+        resources[rid] = {"id": rid, "title": title, "origin": {"url": url}}
+    return {"paragraphs": {"results": results, "total": len(results)}, "resources": resources}
+
+def canned_resource(rid: str) -> Optional[dict]:
+    """Recurso con la forma de /resource/{rid}?show=extracted: texto del archivo y sus párrafos."""
+    parts = [(title, url, text) for r, title, url, text in CORPUS if r == rid]
+    if not parts:
+        return None
+    text, paragraphs = "", []
+    for i, (_title, _url, chunk) in enumerate(parts):
+        start = len(text)
+        text += chunk + "\n"
+        paragraphs.append({"start": start, "end": start + len(chunk), "kind": "TEXT", "page": {"page": 1 + i}})
+    title, url, _text = parts[0]
+    return {
+        "id": rid,
+        "title": title,
+        "origin": {"url": url},
+        "usermetadata": {"classifications": [{"labelset": "tipo", "label": "documento"}]},
+        "data": {"files": {"file": {"extracted": {
+            "text": {"text": text},
+            "metadata": {"metadata": {"paragraphs": paragraphs}},
+        }}}},
+    }
+
+def synthetic_pdf(rid: str, size: int) -> bytes:
+    head = f"%PDF-1.4\n% stand-in {rid}\n".encode()
+    seed = hashlib.sha1(rid.encode()).digest()
+    body = (seed * (size // len(seed) + 1))[: max(0, size - len(head) - 6)]
+    return head + body + b"\n%%EOF"
+
+# ── Nuclia
+def nuclia_app(cfg: StandinConfig) -> FastAPI:
+    app = FastAPI(title="Nuclia stand-in")
+    calls: Counter = Counter()
+    files: Dict[str, bytes] = {}
+
+    @app.api_route("/api/v1/kb/{kb}/search", methods=["GET", "POST"])
+    async def search(kb: str, request: Request):
+        calls["search"] += 1
+        params = dict(request.query_params)
+        if request.method == "POST":
+            params.update(await request.json())
+        await asyncio.sleep(cfg.search_latency)
+        return canned_search(str(params.get("query", "")), int(params.get("size") or params.get("top_k") or 20))
+
+    @app.get("/api/v1/kb/{kb}/resources")
+    async def resources(kb: str, page: int = 0, size: int = 20):
+        calls["resources"] += 1
+        rids = list(dict.fromkeys(rid for rid, *_rest in CORPUS))
+        chunk = rids[page * size:(page + 1) * size]
+        return {
+            "resources": [{"id": rid} for rid in chunk],
+            "pagination": {"page": page, "size": size, "last": (page + 1) * size >= len(rids)},
+        }
+
+    @app.get("/api/v1/kb/{kb}/resource/{rid}")
+    async def resource(kb: str, rid: str):
+        calls["resource"] += 1
+        data = canned_resource(rid)
+        if data is None:
+            return JSONResponse({"detail": "Resource does not exist"}, status_code=404)
+        await asyncio.sleep(cfg.search_latency / 3)
+        return data
+
+    @app.get("/api/v1/kb/{kb}/resource/{rid}/file/original")
+    async def file_original(kb: str, rid: str, request: Request):
+        calls["file"] += 1
+        data = files.get(rid)
+        if data is None:
+            data = files[rid] = synthetic_pdf(rid, cfg.file_size)
+        etag = '"' + hashlib.sha1(data).hexdigest()[:16] + '"'
+        headers = {
+            "ETag": etag,
+            "Accept-Ranges": "bytes",
+            "Content-Disposition": f'inline; filename="{rid}.pdf"',
+        }
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        await asyncio.sleep(cfg.file_latency)
+
+        start, end, status = 0, len(data) - 1, 200
+        m = re.match(r"bytes=(\d*)-(\d*)$", request.headers.get("range", ""))
+        if m and (m.group(1) or m.group(2)):
+            if m.group(1):
+                start = int(m.group(1))
+                end = min(int(m.group(2)), end) if m.group(2) else end
+            else:
+                start = max(0, len(data) - int(m.group(2)))
+            if start > end:
+                return Response(status_code=416, headers={"Content-Range": f"bytes */{len(data)}"})
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+        headers["Content-Length"] = str(end - start + 1)
+
+        async def chunks():
+            for pos in range(start, end + 1, 64 * 1024):
+                yield data[pos:min(pos + 64 * 1024, end + 1)]
+
+        return StreamingResponse(chunks(), status_code=status, media_type="application/pdf", headers=headers)
+
+    _add_stats_routes(app, calls)
+    return app
+
+# ── Anthropic
+_GENERATED_ANSWER = """# Respuesta
+La UVG publica los requisitos, costos y becas en sus guías oficiales; aquí tienes lo principal.
+
+## Detalles
+- Los requisitos de admisión incluyen título de diversificado y la prueba de aptitud académica.
+- Las becas cubren hasta el 50% del arancel y se renuevan cada ciclo.
+- El arancel se paga en cuotas mensuales durante el semestre.
+
+## Siguientes pasos
+1) Revisa la guía de admisiones de tu sede.
+2) Confirma fechas y montos con Admisiones o Finanzas.
+
+## Fuentes consultadas
+- Guía de Admisiones (https://www.uvg.edu.gt/admisiones/)"""
+
+def _split_tokens(text: str) -> List[str]:
+    # ~1 token por palabra (con su espacio): suficiente para simular la velocidad de salida
+    return re.findall(r"\S+\s*|\s+", text)
+
+def _tokens_of(obj) -> int:
+    return max(0, int(len(json.dumps(obj, ensure_ascii=False)) / 3.5))
+
+def _prompt_blocks(body: dict) -> list:
+    """system + mensajes aplanados en bloques, en el orden en que Anthropic arma el prefijo."""
+    system = body.get("system") or []
+    blocks = [{"type": "text", "text": system}] if isinstance(system, str) else list(system)
+    for m in body.get("messages", []):
+        content = m.get("content")
+        blocks += [{"type": "text", "text": content}] if isinstance(content, str) else list(content or [])
+    return blocks
+
+def _usage(body: dict, seen_prefixes: set) -> dict:
+    """Simula la caché de prompts: el prefijo hasta el último cache_control se escribe o se lee."""
+    blocks = _prompt_blocks(body)
+    cut = max((i + 1 for i, b in enumerate(blocks) if isinstance(b, dict) and b.get("cache_control")), default=0)
+    total = max(1, _tokens_of(blocks))
+    usage = {"input_tokens": total, "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}
+    if cut:
+        prefix = blocks[:cut]
+        cached = _tokens_of(prefix)
+        key = hashlib.sha1(json.dumps([body.get("model"), prefix], sort_keys=True).encode()).hexdigest()
+        usage["input_tokens"] = max(1, total - cached)
+        if key in seen_prefixes:
+            usage["cache_read_input_tokens"] = cached
+        else:
+            seen_prefixes.add(key)
+            usage["cache_creation_input_tokens"] = cached
+    return usage
+
+def anthropic_app(cfg: StandinConfig) -> FastAPI:
+    app = FastAPI(title="Anthropic stand-in")
+    calls: Counter = Counter()
+    seen_prefixes: set = set()
+
+    @app.post("/v1/messages")
+    async def messages(request: Request):
+        body = await request.json()
+        model = body.get("model", "stand-in")
+        max_tokens = int(body.get("max_tokens") or 1024)
+        # Las llamadas cortas (reescritura de consulta) devuelven palabras clave
+        short = max_tokens <= 100
+        if short:
+            user = " ".join(
+                m.get("content", "") if isinstance(m.get("content"), str) else ""
+                for m in body.get("messages", [])
+            )
+            text = " ".join(sorted(_terms(user.split(":", 1)[-1])))[:120] or "consulta uvg"
+        else:
+            text = _GENERATED_ANSWER
+        tokens = _split_tokens(text)[:max_tokens]
+        usage = {**_usage(body, seen_prefixes), "output_tokens": len(tokens)}
+        msg_id = f"msg_{uuid.uuid4().hex[:24]}"
+        calls["messages_short" if short else "messages"] += 1
+        calls["cache_read_input_tokens"] += usage["cache_read_input_tokens"]
+        calls["cache_creation_input_tokens"] += usage["cache_creation_input_tokens"]
+
+        if not body.get("stream"):
+            await asyncio.sleep(cfg.rewrite_latency if short else cfg.llm_ttft)
+            if cfg.token_rate > 0 and not short:
+                await asyncio.sleep(len(tokens) / cfg.token_rate)
+            return JSONResponse({
+                "id": msg_id, "type": "message", "role": "assistant", "model": model,
+                "content": [{"type": "text", "text": "".join(tokens)}],
+                "stop_reason": "end_turn", "stop_sequence": None, "usage": usage,
+            })
+
+        calls["streams"] += 1
+
+        def event(name: str, data: dict) -> str:
+            return f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+        async def stream():
+            await asyncio.sleep(cfg.llm_ttft)
+            yield event("message_start", {"type": "message_start", "message": {
+                "id": msg_id, "type": "message", "role": "assistant", "model": model, "content": [],
+                "stop_reason": None, "stop_sequence": None,
+                "usage": {**usage, "output_tokens": 1},
+            }})
+            yield event("content_block_start", {"type": "content_block_start", "index": 0,
+                                                 "content_block": {"type": "text", "text": ""}})
+            for tok in tokens:
+                yield event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                                    "delta": {"type": "text_delta", "text": tok}})
+                if cfg.token_rate > 0:
+                    await asyncio.sleep(1 / cfg.token_rate)
+            yield event("content_block_stop", {"type": "content_block_stop", "index": 0})
+            yield event("message_delta", {"type": "message_delta",
+                                          "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                          "usage": {"output_tokens": len(tokens)}})
+            yield event("message_stop", {"type": "message_stop"})
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    _add_stats_routes(app, calls)
+    return app
+
+def _add_stats_routes(app: FastAPI, calls: Counter) -> None:
+    @app.get("/_bench/stats")
+    def stats():
+        return dict(calls)
+
+    @app.post("/_bench/reset")
+    def reset():
+        calls.clear()
+        return {"ok": True}
+
+# ── Arranque con uvicorn (en hilos, para usarlos desde bench.load)
+class StandinServer:
+    def __init__(self, app: FastAPI, host: str, port: int):
+        import uvicorn
+
+        self.url = f"http://{host}:{port}"
+        self.server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, name=f"standin-{port}", daemon=True)
+
+    def start(self, timeout: float = 10.0) -> "StandinServer":
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if time.monotonic() > deadline or not self.thread.is_alive():
+                raise RuntimeError(f"El stand-in en {self.url} no arrancó")
+            time.sleep(0.05)
+        return self
+
+    def stop(self) -> None:
+        self.server.should_exit = True
+        self.thread.join(timeout=5)
+
+def start_standins(cfg: StandinConfig, host: str = "127.0.0.1",
+                   nuclia_port: int = 8101, anthropic_port: int = 8102) -> List[StandinServer]:
+    return [
+        StandinServer(nuclia_app(cfg), host, nuclia_port).start(),
+        StandinServer(anthropic_app(cfg), host, anthropic_port).start(),
+    ]
+
+def add_config_args(ap: argparse.ArgumentParser) -> None:
+    defaults = StandinConfig()
+    ap.add_argument("--search-latency", type=float, default=defaults.search_latency, help="s por búsqueda Nuclia")
+    ap.add_argument("--file-latency", type=float, default=defaults.file_latency, help="s hasta el primer byte del archivo")
+    ap.add_argument("--file-size", type=int, default=defaults.file_size, help="bytes del PDF sintético")
+    ap.add_argument("--llm-ttft", type=float, default=defaults.llm_ttft, help="s hasta el primer token de Claude")
+    ap.add_argument("--token-rate", type=float, default=defaults.token_rate, help="tokens/s generados (0 = instantáneo)")
+    ap.add_argument("--rewrite-latency", type=float, default=defaults.rewrite_latency, help="s de la llamada de reescritura")
+
+def config_from_args(args: argparse.Namespace) -> StandinConfig:
+    return StandinConfig(
+        search_latency=args.search_latency,
+        file_latency=args.file_latency,
+        file_size=args.file_size,
+        llm_ttft=args.llm_ttft,
+        token_rate=args.token_rate,
+        rewrite_latency=args.rewrite_latency,
+    )
+
+def main(argv: Optional[List[str]] = None) -> None:
+    ap = argparse.ArgumentParser(description="Levanta los stand-ins de Nuclia y Anthropic.")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--nuclia-port", type=int, default=8101)
+    ap.add_argument("--anthropic-port", type=int, default=8102)
+    add_config_args(ap)
+    args = ap.parse_args(argv)
+
+    servers = start_standins(config_from_args(args), args.host, args.nuclia_port, args.anthropic_port)
+    print(f"NUCLIA_API_BASE={servers[0].url}/api/v1")
+    print(f"ANTHROPIC_BASE_URL={servers[1].url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for s in servers:
+            s.stop()
+
+if __name__ == "__main__":
+    main()
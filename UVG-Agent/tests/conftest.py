@@ -0,0 +1,24 @@
+# tests/conftest.py
+import os
+
+# La configuración se lee al importar app.config: valores fijos para que un .env local
+# no cambie los resultados, y sin tocar disco ni servicios externos.
+os.environ.update(
+    NUCLIA_API_BASE="http://nuclia.test/api/v1",
+    KB="kb-test",
+    NUCLIA_TOKEN="test",
+    ANTHROPIC_KEY="test",
+    KBS_PATH="",
+    KB_ROUTING="true",
+    LOCAL_INDEX_PATH="",
+    RESOURCE_CACHE_MAX_MB="0",
+    ANSWER_CACHE_BACKEND="off",
+    DAILY_TOKEN_QUOTA="0",
+    CLIENT_DAILY_TOKENS="0",
+    PROMPT_TOKEN_BUDGET="6000",
+    CONTEXT_PACKING="false",
+    RERANK_TOP_K="8",
+    RERANK_CUTOFF="0.35",
+    RERANK_MIN_KEEP="3",
+    REQUEST_LOG="false",
+)
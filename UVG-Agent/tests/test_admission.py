@@ -0,0 +1,166 @@
+# tests/test_admission.py
+import asyncio
+
+import pytest
+
+from app import admission
+from app.admission import AdmissionController, Overloaded, TokenBucket, patient_slot
+from app.deadline import current_deadline, start_deadline
+from app.limits import Limits, gate, reset_limits, use_limits
+
+async def _settle() -> None:
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+async def _cancel(tasks) -> None:
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+def test_admits_up_to_max_active_then_queues():
+    async def main():
+        ctl = AdmissionController(max_active=2, queue_size=4, queue_timeout=5)
+        await ctl.acquire()
+        await ctl.acquire()
+        waiter = asyncio.create_task(ctl.acquire())
+        await _settle()
+        assert ctl.active == 2 and ctl.queued == 1 and not waiter.done()
+        ctl.release()
+        await _settle()
+        assert waiter.done() and ctl.active == 2 and ctl.queued == 0
+        ctl.release()
+        ctl.release()
+        assert ctl.active == 0
+
+    asyncio.run(main())
+
+def test_sheds_when_interactive_queue_is_full():
+    async def main():
+        ctl = AdmissionController(max_active=1, queue_size=1, queue_timeout=5)
+        await ctl.acquire()
+        waiter = asyncio.create_task(ctl.acquire())
+        await _settle()
+        with pytest.raises(Overloaded) as exc:
+            await ctl.acquire()
+        assert exc.value.status == 503 and exc.value.retry_after > 0
+        await _cancel([waiter])
+
+    asyncio.run(main())
+
+def test_queue_timeout_sheds_and_leaves_the_queue():
+    async def main():
+        ctl = AdmissionController(max_active=1, queue_size=4, queue_timeout=0.01)
+        await ctl.acquire()
+        with pytest.raises(Overloaded) as exc:
+            await ctl.acquire()
+        assert exc.value.status == 503
+        assert ctl.queued == 0
+        ctl.release()
+        assert ctl.active == 0
+
+    asyncio.run(main())
+
+def test_patient_waiters_do_not_count_against_queue_size():
+    # Un lote grande esperando no puede dejar sin lugar a una pregunta interactiva
+    async def main():
+        ctl = AdmissionController(max_active=1, queue_size=1, queue_timeout=5)
+        await ctl.acquire()
+        patients = [asyncio.create_task(ctl.acquire(patient=True)) for _ in range(20)]
+        await _settle()
+        interactive = asyncio.create_task(ctl.acquire())
+        await _settle()
+        assert ctl.queued == 1 and ctl.queued_patient == 20
+        assert not interactive.done()  # en cola, no rechazada
+        await _cancel(patients + [interactive])
+
+    asyncio.run(main())
+
+def test_release_serves_interactive_waiters_before_patient_ones():
+    async def main():
+        ctl = AdmissionController(max_active=1, queue_size=4, queue_timeout=5)
+        await ctl.acquire()
+        order = []
+
+        async def take(name, patient):
+            await ctl.acquire(patient=patient)
+            order.append(name)
+
+        tasks = [asyncio.create_task(take(f"p{i}", True)) for i in range(2)]
+        await _settle()
+        tasks.append(asyncio.create_task(take("i0", False)))
+        await _settle()
+        for _ in range(3):
+            ctl.release()
+            await _settle()
+        assert order == ["i0", "p0", "p1"]
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+
+def test_cancelled_waiter_does_not_consume_a_slot():
+    async def main():
+        ctl = AdmissionController(max_active=1, queue_size=4, queue_timeout=5)
+        await ctl.acquire()
+        gone = asyncio.create_task(ctl.acquire(patient=True))
+        await _settle()
+        await _cancel([gone])
+        assert ctl.queued_patient == 0
+        ctl.release()
+        assert ctl.active == 0
+
+    asyncio.run(main())
+
+def test_batch_llm_gate_holds_the_slot_only_during_the_call(monkeypatch):
+    async def main():
+        ctl = AdmissionController(max_active=2, queue_size=4, queue_timeout=5)
+        monkeypatch.setattr(admission, "ADMISSION_MAX_ACTIVE", 2)
+        monkeypatch.setattr(admission, "get_controller", lambda: ctl)
+        token = use_limits(Limits({"llm": 1}, hold={"llm": patient_slot}))
+        try:
+            deadline = start_deadline(30, paused=True)
+            async with gate("search"):
+                assert ctl.active == 0
+            assert deadline.expires is None
+            async with gate("llm"):
+                assert ctl.active == 1
+                assert current_deadline().expires is not None  # el plazo corre desde el cupo
+            assert ctl.active == 0
+        finally:
+            reset_limits(token)
+
+    asyncio.run(main())
+
+def test_token_bucket_allows_burst_then_asks_to_wait(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission.time, "monotonic", lambda: now[0])
+    bucket = TokenBucket(per_minute=60, burst=2)
+    assert bucket.take() == 0.0
+    assert bucket.take() == 0.0
+    assert bucket.take() == pytest.approx(1.0)
+    now[0] += 0.5
+    assert bucket.take() == pytest.approx(0.5)
+    now[0] += 0.5
+    assert bucket.take() == 0.0
+
+def test_token_bucket_refill_is_capped_at_burst(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission.time, "monotonic", lambda: now[0])
+    bucket = TokenBucket(per_minute=60, burst=3)
+    for _ in range(3):
+        bucket.take()
+    now[0] += 3600
+    assert [bucket.take() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take() > 0
+
+@pytest.mark.parametrize("header, value, hops, expected", [
+    ("", "9.9.9.9", 1, "10.0.0.1"),                                       # sin header: la conexión
+    ("X-Forwarded-For", "6.6.6.6, 203.0.113.7", 1, "203.0.113.7"),         # el salto del proxy, no el primero
+    ("X-Forwarded-For", "6.6.6.6, 203.0.113.7, 10.0.0.9", 2, "203.0.113.7"),
+    ("X-Forwarded-For", "203.0.113.7", 2, "10.0.0.1"),                    # faltan saltos: la conexión
+    ("X-Client-Id", " app-42 ", 1, "app-42"),
+])
+def test_client_key_trusts_only_the_proxy_hop(monkeypatch, header, value, hops, expected):
+    monkeypatch.setattr(admission, "CLIENT_ID_HEADER", header)
+    monkeypatch.setattr(admission, "TRUSTED_PROXY_HOPS", hops)
+    headers = {header: value} if header else {"X-Forwarded-For": value}
+    assert admission.client_key(headers, "10.0.0.1") == expected
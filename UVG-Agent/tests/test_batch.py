@@ -0,0 +1,79 @@
+# tests/test_batch.py
+import asyncio
+import json
+
+import pytest
+
+from app import batch
+from app.admission import is_patient
+from app import limits
+
+def _item(question, deadline=None):
+    return dict(question=question, size=30, max_chunks=20, use_semantic=True, min_score=0.0, deadline=deadline)
+
+@pytest.fixture
+def agent(monkeypatch):
+    """ask_agent_async simulado: anota cada pregunta y responde tras `delay[pregunta]`."""
+    calls, delay, tasks = [], {}, []
+
+    async def ask(question, **kwargs):
+        calls.append((question, is_patient(), limits._current.get() is not None))
+        tasks.append(asyncio.current_task())
+        await asyncio.sleep(delay.get(question, 0.0))
+        if question.startswith("falla"):
+            raise RuntimeError("nuclia")
+        return {"answer": f"R: {question}", "sources": [], "meta": {}}
+    monkeypatch.setattr(batch, "ask_agent_async", ask)
+    agent = type("Agent", (), {"calls": calls, "delay": delay, "tasks": tasks})
+    return agent
+
+def _collect(items):
+    async def main():
+        return [out async for out in batch.ask_batch(items)]
+    return asyncio.run(main())
+
+def test_identical_questions_are_answered_once(agent):
+    items = [_item("¿Cuánto cuesta la inscripción?"), _item("otra pregunta"),
+             _item("cuanto cuesta la INSCRIPCION", deadline=5)]  # el plazo no cambia la clave
+    out = _collect(items)
+    assert sorted(indices for indices, _ in out) == [[0, 2], [1]]
+    assert len(agent.calls) == 2
+    # Cada ítem corre con los límites del lote y como trabajo de baja prioridad
+    assert all(patient and limited for _, patient, limited in agent.calls)
+
+def test_results_arrive_as_they_finish_and_errors_are_yielded(agent):
+    agent.delay.update({"lenta": 0.05})
+    out = _collect([_item("lenta"), _item("falla pronto"), _item("rápida")])
+    assert out[-1][0] == [0]
+    failed = [result for indices, result in out if indices == [1]][0]
+    assert isinstance(failed, RuntimeError)
+
+def test_closing_the_stream_cancels_pending_items(agent):
+    agent.delay.update({"lenta 1": 5, "lenta 2": 5})
+
+    async def main():
+        stream = batch.ask_batch([_item("rápida"), _item("lenta 1"), _item("lenta 2")])
+        first = await stream.__anext__()
+        await stream.aclose()  # el cliente se desconectó
+        await asyncio.sleep(0)
+        return first
+    first = asyncio.run(asyncio.wait_for(main(), 2))
+    assert first[0] == [0]
+    assert len(agent.tasks) == 3
+    assert [t.cancelled() for t in agent.tasks] == [False, True, True]
+
+def test_endpoint_writes_one_ndjson_line_per_item_and_a_summary(agent):
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    body = {"items": [{"query": "becas"}, {"query": "falla"}, {"query": "Becas"}]}
+    with TestClient(app) as client:
+        resp = client.post("/ask/batch", json=body)
+    assert resp.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in resp.text.splitlines()]
+    by_index = {line["index"]: line for line in lines[:-1]}
+    assert sorted(by_index) == [0, 1, 2]
+    assert by_index[0]["ok"] and by_index[2]["result"] == by_index[0]["result"]
+    assert not by_index[1]["ok"] and "error" in by_index[1]
+    assert lines[-1]["summary"]["items"] == 3 and lines[-1]["summary"]["unique"] == 2
+    assert lines[-1]["summary"]["errors"] == 1
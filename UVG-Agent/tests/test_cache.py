@@ -0,0 +1,113 @@
+# tests/test_cache.py
+import asyncio
+
+import pytest
+
+from app import cache
+from app.cache import MemoryCache, SingleFlight, SQLiteCache, answer_key, make_cache
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(cache.time, "time", c)
+    return c
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path, clock):
+    if request.param == "memory":
+        return MemoryCache(max_entries=2, ttl=60, grace=300)
+    return SQLiteCache(str(tmp_path / "answers.sqlite"), max_entries=2, ttl=60, grace=300)
+
+def test_get_returns_what_was_set_until_the_ttl(store, clock):
+    store.set("a", {"answer": "sí"})
+    clock.now += 59
+    assert store.get("a") == {"answer": "sí"}
+    clock.now += 2
+    assert store.get("a") is None
+    assert store.stats.hits == 1 and store.stats.misses == 1
+
+def test_evicts_the_least_recently_used(store, clock):
+    store.set("a", 1)
+    clock.now += 1
+    store.set("b", 2)
+    clock.now += 1
+    assert store.get("a") == 1  # ahora "b" es la menos usada
+    clock.now += 1
+    store.set("c", 3)
+    assert store.get("b") is None
+    assert store.get("a") == 1 and store.get("c") == 3
+    assert len(store) == 2 and store.stats.evictions == 1
+
+def test_expired_entry_is_kept_for_get_stale_within_grace(store, clock):
+    store.set("a", "vieja")
+    clock.now += 120
+    assert store.get("a") is None
+    assert store.get_stale("a") == "vieja"
+    clock.now += 300
+    assert store.get_stale("a") is None
+
+def test_clear_and_delete(store):
+    store.set("a", 1)
+    store.set("b", 2)
+    store.delete("a")
+    assert store.get("a") is None
+    assert store.clear() == 1 and len(store) == 0
+
+def test_make_cache_backends(tmp_path):
+    assert make_cache("off", path="", max_entries=1, ttl=1) is None
+    assert make_cache("memory", path="", max_entries=1, ttl=1).backend == "memory"
+    assert make_cache("sqlite", path=str(tmp_path / "c.sqlite"), max_entries=1, ttl=1).backend == "sqlite"
+
+PARAMS = dict(size=30, max_chunks=20, use_semantic=True, min_score=0.0)
+
+def test_answer_key_ignores_case_accents_punctuation_and_spaces():
+    base = answer_key("¿Cuánto cuesta la inscripción?", **PARAMS)
+    assert answer_key("cuanto  cuesta la INSCRIPCION", **PARAMS) == base
+    assert answer_key("¡Cuánto cuesta la inscripción!!", **PARAMS) == base
+
+def test_answer_key_keeps_the_enie_and_the_search_parameters():
+    base = answer_key("becas por año", **PARAMS)
+    assert answer_key("becas por ano", **PARAMS) != base
+    assert answer_key("becas por año", **{**PARAMS, "size": 10}) != base
+    assert answer_key("becas por año", **{**PARAMS, "use_semantic": False}) != base
+    assert answer_key("becas por año", **{**PARAMS, "min_score": None}) == base
+
+# ── Single-flight
+def test_single_flight_coalesces_concurrent_calls():
+    flight, calls = SingleFlight(), []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "resultado"
+
+    async def main():
+        return await asyncio.gather(*(flight.do("k", fetch) for _ in range(5)))
+    assert asyncio.run(main()) == ["resultado"] * 5
+    assert len(calls) == 1
+    assert flight.as_dict() == {"leaders": 1, "coalesced": 4, "inflight": 0}
+
+def test_single_flight_survives_a_cancelled_leader_and_shares_errors():
+    flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise ValueError("nuclia")
+
+    async def main():
+        leader = asyncio.ensure_future(flight.do("k", fetch))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do("k", fetch))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(ValueError):
+            await follower
+        return flight.inflight("k")
+    assert asyncio.run(main()) is False
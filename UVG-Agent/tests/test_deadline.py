@@ -0,0 +1,90 @@
+# tests/test_deadline.py
+import asyncio
+
+import pytest
+
+from app import deadline as dl
+from app.deadline import DEGRADATIONS, Deadline, DeadlineExceeded
+
+ESTIMATES = {"rewrite": 1.0, "search": 2.0, "generation": 8.0, "reformat": 4.0}
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(dl.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(dl, "_estimates", dict(ESTIMATES))
+    return now
+
+def _degradations(d: Deadline) -> list:
+    # Las mismas preguntas que hace el pipeline antes de cada etapa (agent._retrieve / _rag_answer)
+    if not d.allows("rewrite", "search", "generation"):
+        d.degrade("skip_rewrite")
+    if not d.allows("search", "generation"):
+        d.degrade("shrink_search")
+    if not d.allows("reformat"):
+        d.degrade("skip_reformat")
+    if not d.allows("generation"):
+        d.degrade("fallback_answer")
+    return d.as_dict()["degraded"]
+
+def test_degradations_accumulate_in_order_as_time_runs_out(clock):
+    # generation cuenta la mitad de su estimado: 4 s; + search 6 s; + rewrite 7 s
+    seen = []
+    for remaining in (20, 6.5, 5, 3.5, 1):
+        seen.append(_degradations(Deadline(remaining)))
+    assert seen == [
+        [],
+        ["skip_rewrite"],
+        ["skip_rewrite", "shrink_search"],
+        ["skip_rewrite", "shrink_search", "skip_reformat", "fallback_answer"],
+        ["skip_rewrite", "shrink_search", "skip_reformat", "fallback_answer"],
+    ]
+    for degraded in seen:
+        assert degraded == sorted(degraded, key=DEGRADATIONS.index)
+
+def test_as_dict_reports_degradations_in_canonical_order(clock):
+    d = Deadline(10)
+    d.degrade("fallback_answer")
+    d.degrade("skip_rewrite")
+    d.degrade("skip_rewrite")
+    assert d.as_dict()["degraded"] == ["skip_rewrite", "fallback_answer"]
+
+def test_remaining_counts_down(clock):
+    d = Deadline(10)
+    clock[0] += 4
+    assert d.remaining() == pytest.approx(6)
+    assert d.allows("search") and not d.allows("generation", "reformat")
+
+def test_paused_deadline_starts_on_begin(clock):
+    d = Deadline(10, paused=True)
+    clock[0] += 60
+    assert d.remaining() == 10 and d.allows("search", "generation")
+    d.begin()
+    clock[0] += 3
+    d.begin()  # solo la primera vez cuenta
+    assert d.remaining() == pytest.approx(7)
+
+def test_run_raises_when_no_time_is_left_for_the_reserve(clock):
+    d = Deadline(5)
+
+    async def stage():
+        return "ok"
+
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(d.run("search", stage(), reserve=("generation", "reformat")))
+    assert asyncio.run(d.run("search", stage())) == "ok"
+
+def test_run_cuts_a_slow_stage_at_the_deadline(monkeypatch):
+    monkeypatch.setattr(dl, "_estimates", dict(ESTIMATES))  # run() ajusta el estimado de la etapa
+    d = Deadline(0.05)
+
+    async def slow():
+        await asyncio.sleep(1)
+
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(d.run("rewrite", slow()))
+    assert dl.estimate("rewrite") == pytest.approx(ESTIMATES["rewrite"])  # cortada: al menos lo estimado
+
+def test_start_deadline_without_budget_disables_it():
+    assert dl.start_deadline(0) is None
+    assert dl.current_deadline() is None
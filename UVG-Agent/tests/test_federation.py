@@ -0,0 +1,95 @@
+# tests/test_federation.py
+import json
+
+import pytest
+
+from app import federation
+from app.federation import KbTarget, load_targets, route_kbs, rrf_merge, select_targets
+
+CENTRAL = KbTarget(name="central", kb="kb-central", sede="central")
+ALTIPLANO = KbTarget(name="altiplano", kb="kb-alt", sede="altiplano")
+ADMISIONES = KbTarget(name="admisiones", kb="kb-adm", weight=0.5)
+
+def _search(*hits, resources=None):
+    results = [{"rid": rid, "text": text, "score": score} for rid, text, score in hits]
+    return {"paragraphs": {"results": results}, "resources": resources or {rid: {"title": rid} for rid, _t, _s in hits}}
+
+def test_rrf_merge_fuses_ranks_and_tags_each_hit_with_its_kb():
+    merged = rrf_merge([
+        (CENTRAL, _search(("c1", "Becas del campus central", 20.0), ("c2", "Inscripción en línea", 10.0))),
+        (ALTIPLANO, _search(("a1", "Becas en Altiplano", 0.9), ("a2", "Inscripción en línea", 0.8))),
+    ], size=10)
+    hits = merged["paragraphs"]["results"]
+    # "Inscripción en línea" aparece en las dos KB: suma ambos aportes y queda primero
+    assert hits[0]["text"] == "Inscripción en línea"
+    assert len(hits) == 3 and merged["paragraphs"]["total"] == 3
+    assert {h["kb"] for h in hits} <= {"kb-central", "kb-alt"}
+    assert all(r["kb"] in ("kb-central", "kb-alt") for r in merged["resources"].values())
+    assert set(merged["resources"]) == {h["rid"] for h in hits}
+
+def test_rrf_merge_scores_are_normalized_and_never_increase():
+    merged = rrf_merge([
+        (CENTRAL, _search(("c1", "uno", 40.0), ("c2", "dos", 30.0), ("c3", "tres", 5.0))),
+        (ADMISIONES, _search(("d1", "cuatro", 0.2), ("d2", "tres", 0.9))),
+    ], size=10)
+    scores = [h["score"] for h in merged["paragraphs"]["results"]]
+    assert all(0.0 <= s <= 1.0 for s in scores)
+    assert scores == sorted(scores, reverse=True)
+
+def test_rrf_merge_weight_and_size():
+    merged = rrf_merge([
+        (ADMISIONES, _search(("d1", "admisiones primero", 0.9))),
+        (CENTRAL, _search(("c1", "central primero", 0.9))),
+    ], size=1)
+    hits = merged["paragraphs"]["results"]
+    assert [h["text"] for h in hits] == ["central primero"]  # mismo rango, más peso
+    assert list(merged["resources"]) == ["c1"]
+
+def test_rrf_merge_skips_empty_texts():
+    merged = rrf_merge([(CENTRAL, _search(("c1", "  ", 1.0), ("c2", "texto", 0.5)))], size=10)
+    assert [h["rid"] for h in merged["paragraphs"]["results"]] == ["c2"]
+
+@pytest.fixture
+def kbs(monkeypatch):
+    monkeypatch.setattr(federation, "targets", [CENTRAL, ALTIPLANO, ADMISIONES])
+    monkeypatch.setattr(federation, "KB_ROUTING", True)
+
+def test_route_kbs_picks_the_named_sede_and_general_kbs(kbs):
+    assert route_kbs("¿Qué becas hay en el campus altiplano?") == ["altiplano", "admisiones"]
+    assert route_kbs("horario del campus central") == ["central", "admisiones"]
+
+def test_route_kbs_without_sede_or_routing_queries_all(kbs, monkeypatch):
+    assert route_kbs("¿Qué becas hay?") is None
+    assert route_kbs("becas en campus sur") == ["admisiones"]  # sede sin KB propia: las generales
+    monkeypatch.setattr(federation, "targets", [CENTRAL, ALTIPLANO])
+    assert route_kbs("becas en campus sur") is None  # ni propia ni generales: todas
+    monkeypatch.setattr(federation, "KB_ROUTING", False)
+    assert route_kbs("becas en el campus altiplano") is None
+
+def test_route_kbs_without_federation():
+    assert route_kbs("becas en el campus altiplano") is None
+
+def test_select_targets_falls_back_to_all(kbs):
+    assert select_targets(["altiplano"]) == [ALTIPLANO]
+    assert select_targets(None) == [CENTRAL, ALTIPLANO, ADMISIONES]
+    assert select_targets(["otra"]) == [CENTRAL, ALTIPLANO, ADMISIONES]
+
+def test_load_targets_reads_tokens_and_rejects_bad_files(tmp_path, monkeypatch):
+    monkeypatch.setenv("TOK_ALT", "secreto")
+    good = tmp_path / "kbs.json"
+    good.write_text(json.dumps([
+        {"name": "altiplano", "kb": "kb-alt", "sede": "Sede Altiplano", "token_env": "TOK_ALT", "timeout": 3},
+        {"kb": "kb-adm", "weight": 0.8},
+    ]), encoding="utf-8")
+    alt, adm = load_targets(str(good))
+    assert (alt.sede, alt.timeout) == ("altiplano", 3.0)
+    assert "secreto" in " ".join(alt.headers.values())
+    assert (adm.name, adm.weight) == ("kb-adm", 0.8)
+
+    repeated = tmp_path / "rep.json"
+    repeated.write_text(json.dumps([{"name": "x", "kb": "a"}, {"name": "x", "kb": "b"}]), encoding="utf-8")
+    missing_kb = tmp_path / "bad.json"
+    missing_kb.write_text(json.dumps([{"name": "x"}]), encoding="utf-8")
+    assert load_targets(str(repeated)) == []
+    assert load_targets(str(missing_kb)) == []
+    assert load_targets(str(tmp_path / "no-existe.json")) == []
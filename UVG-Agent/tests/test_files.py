@@ -0,0 +1,122 @@
+# tests/test_files.py
+import asyncio
+
+import httpx
+import pytest
+
+from app import files
+from app.files import CachedFile, ResourceCache, cache_key, etag_matches
+
+PDF = b"%PDF-1.4 " + b"x" * 1000
+ETAG = '"v1"'
+
+def test_etag_matches_weak_lists_and_star():
+    assert etag_matches('"v1"', ETAG)
+    assert etag_matches('W/"v1"', ETAG)
+    assert etag_matches('"v0", "v1"', 'W/"v1"')
+    assert etag_matches("*", ETAG)
+    assert not etag_matches('"v2"', ETAG)
+    assert not etag_matches(None, ETAG) and not etag_matches('"v1"', None)
+
+def _store(cache: ResourceCache, rid: str, size: int) -> None:
+    async def write():
+        writer = cache.writer("kb-test", rid)
+        await writer.write(b"x" * size)
+        await writer.commit(None, "application/pdf", "inline", size)
+    asyncio.run(write())
+
+def test_disk_cache_evicts_least_recently_used_by_bytes(tmp_path):
+    cache = ResourceCache(str(tmp_path / "rc"), max_bytes=250, max_file_bytes=200, ttl=60)
+    _store(cache, "a", 100)
+    _store(cache, "b", 100)
+    assert cache.get(cache_key("kb-test", "a")) is not None  # "b" queda como la menos usada
+    _store(cache, "c", 100)
+    assert cache.get(cache_key("kb-test", "b")) is None
+    stats = cache.as_dict()
+    assert stats["entries"] == 2 and stats["bytes"] == 200 and stats["evictions"] == 1
+
+def test_disk_cache_skips_files_over_the_limit_and_reloads_from_disk(tmp_path):
+    cache = ResourceCache(str(tmp_path / "rc"), max_bytes=10_000, max_file_bytes=200, ttl=60)
+    _store(cache, "grande", 300)
+    _store(cache, "chico", 50)
+    assert cache.get(cache_key("kb-test", "grande")) is None
+    assert [p.suffix for p in (tmp_path / "rc").iterdir() if p.suffix == ".part"] == []
+    reloaded = ResourceCache(str(tmp_path / "rc"), max_bytes=10_000, max_file_bytes=200, ttl=60)
+    entry, stat = reloaded.get(cache_key("kb-test", "chico"))
+    assert entry.size == stat.st_size == 50 and entry.etag.startswith('"')
+
+# ── serve_resource contra un Nuclia simulado
+@pytest.fixture
+def nuclia(monkeypatch, tmp_path):
+    seen = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        seen.append({k: request.headers.get(k) for k in ("range", "if-none-match")})
+        headers = {"content-type": "application/pdf", "etag": ETAG, "accept-ranges": "bytes"}
+        if request.headers.get("if-none-match") == ETAG:
+            return httpx.Response(304, headers={"etag": ETAG})
+        if request.headers.get("range") == "bytes=0-9":
+            return httpx.Response(206, content=PDF[:10],
+                                  headers={**headers, "content-range": f"bytes 0-9/{len(PDF)}"})
+        return httpx.Response(200, content=PDF, headers=headers)
+
+    cache = ResourceCache(str(tmp_path / "rc"), max_bytes=1 << 20, max_file_bytes=1 << 20, ttl=60)
+    monkeypatch.setattr(files, "resource_cache", cache)
+    monkeypatch.setattr(files, "get_http_client",
+                        lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return seen
+
+async def _body(resp) -> bytes:
+    if hasattr(resp, "body_iterator"):
+        return b"".join([chunk async for chunk in resp.body_iterator])
+    if hasattr(resp, "path"):
+        with open(resp.path, "rb") as fh:
+            return fh.read()
+    return resp.body
+
+def test_miss_streams_and_fills_the_cache_then_serves_from_disk(nuclia):
+    async def main():
+        first = await files.serve_resource("r1")
+        body1 = await _body(first)
+        second = await files.serve_resource("r1")
+        return first, body1, second, await _body(second)
+    first, body1, second, body2 = asyncio.run(main())
+    assert first.headers["x-cache"] == "MISS" and body1 == PDF
+    assert second.headers["x-cache"] == "HIT" and body2 == PDF
+    assert second.headers["etag"] == ETAG
+    assert len(nuclia) == 1
+
+def test_range_is_forwarded_and_answered_with_206(nuclia):
+    async def main():
+        resp = await files.serve_resource("r1", range_header="bytes=0-9")
+        body = await _body(resp)
+        await asyncio.gather(*files._background)  # el archivo completo se baja aparte
+        return resp, body
+    resp, body = asyncio.run(main())
+    assert resp.status_code == 206 and body == PDF[:10]
+    assert resp.headers["content-range"] == f"bytes 0-9/{len(PDF)}"
+    assert nuclia[0]["range"] == "bytes=0-9" and nuclia[1]["range"] is None
+    assert files.resource_cache.get(cache_key("kb-test", "r1")) is not None
+
+def test_if_none_match_gets_304_from_cache_and_upstream(nuclia):
+    async def main():
+        upstream = await files.serve_resource("r1", if_none_match=ETAG)  # sin caché: Nuclia responde
+        await _body(await files.serve_resource("r1"))
+        cached = await files.serve_resource("r1", if_none_match=f"W/{ETAG}")
+        return upstream, cached
+    upstream, cached = asyncio.run(main())
+    assert upstream.status_code == 304 and upstream.headers["etag"] == ETAG
+    assert cached.status_code == 304 and cached.headers["x-cache"] == "HIT"
+    assert len(nuclia) == 2
+
+def test_expired_entry_is_revalidated_with_its_etag(nuclia, monkeypatch):
+    async def main():
+        await _body(await files.serve_resource("r1"))
+        entry, _ = files.resource_cache.get(cache_key("kb-test", "r1"))
+        entry.at -= 120  # fuera del TTL
+        return await files.serve_resource("r1")
+    resp = asyncio.run(main())
+    assert resp.headers["x-cache"] == "HIT"
+    assert nuclia[-1]["if-none-match"] == ETAG
+    entry, _ = files.resource_cache.get(cache_key("kb-test", "r1"))
+    assert entry.at > files.time.time() - 5  # touch() la marcó como validada
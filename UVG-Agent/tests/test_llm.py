@@ -0,0 +1,27 @@
+# tests/test_llm.py
+from app import llm
+from app.llm import cache_min_tokens, system_prompt, text_block
+
+LONG = "Reglamento académico de la UVG. " * 200  # ~1700 tokens estimados
+
+def test_cache_minimum_depends_on_the_model():
+    assert cache_min_tokens("claude-3-5-sonnet-latest") == 1024
+    assert cache_min_tokens("claude-3-5-haiku-latest") == 2048
+
+def test_short_system_prompt_goes_without_breakpoint(monkeypatch):
+    monkeypatch.setattr(llm, "PROMPT_CACHE", True)
+    assert system_prompt("Eres un asistente de la UVG.") == "Eres un asistente de la UVG."
+
+def test_long_system_prompt_is_marked_only_above_the_model_minimum(monkeypatch):
+    monkeypatch.setattr(llm, "PROMPT_CACHE", True)
+    blocks = system_prompt(LONG, "claude-3-5-sonnet-latest")
+    assert blocks == [{"type": "text", "text": LONG, "cache_control": {"type": "ephemeral"}}]
+    assert system_prompt(LONG, "claude-3-5-haiku-latest") == LONG
+    monkeypatch.setattr(llm, "PROMPT_CACHE", False)
+    assert system_prompt(LONG, "claude-3-5-sonnet-latest") == LONG
+
+def test_text_block_counts_the_prefix_before_the_breakpoint():
+    short = "Contexto breve."
+    assert "cache_control" not in text_block(short, cache=True)
+    assert "cache_control" in text_block(short, cache=True, prefix=1024)
+    assert "cache_control" not in text_block(LONG)
@@ -0,0 +1,97 @@
+# tests/test_local_index.py
+import pytest
+
+from app.local_index import LocalIndex, build_index, terms, write_index
+
+PARAGRAPHS = [
+    {"rid": "r1", "field": "/f/file", "text": "Requisitos de admisión: prueba de aptitud académica y entrevista.",
+     "page": 1, "start": 0, "end": 64, "index": 0},
+    {"rid": "r1", "field": "/f/file", "text": "Las becas cubren hasta el 50% del arancel.",
+     "page": 2, "start": 64, "end": 106, "index": 1},
+    {"rid": "r2", "field": "/a/title", "text": "Calendario académico del campus Altiplano: inicio de clases en enero.",
+     "page": None, "start": None, "end": None, "index": None},
+    {"rid": "r3", "field": "/t/text", "text": "de la y el"},  # solo stop words: no se indexa
+]
+RESOURCES = {
+    "r1": {"title": "Guía de admisión", "url": "https://uvg.edu.gt/admision", "labels": ["/l/tipo/guia"]},
+    "r2": {"title": "Calendario", "url": "", "labels": []},
+}
+
+@pytest.fixture
+def index(tmp_path):
+    path = str(tmp_path / "local.idx")
+    write_index(path, build_index(PARAGRAPHS, RESOURCES))
+    idx = LocalIndex(path)
+    yield idx
+    idx.close()
+
+def test_round_trip_keeps_paragraphs_and_resources(index):
+    assert index.n_docs == 3
+    assert index.rids == ["r1", "r2"]
+    assert index.text(1) == PARAGRAPHS[1]["text"]
+    assert index.as_dict()["paragraphs"] == 3
+
+def test_search_ranks_matching_paragraph_first_with_nuclia_shape(index):
+    res = index.search("¿Qué becas hay?")
+    hits = res["paragraphs"]["results"]
+    assert hits[0]["rid"] == "r1" and hits[0]["text"].startswith("Las becas")
+    assert hits[0]["position"] == {"page_number": 2, "start": 64, "end": 106, "index": 1}
+    assert 0 < hits[0]["score"] < 1 and hits[0]["score_type"] == "BM25"
+    assert res["resources"]["r1"]["title"] == "Guía de admisión"
+    assert res["resources"]["r1"]["origin"]["url"] == "https://uvg.edu.gt/admision"
+
+def test_search_matches_accents_and_plurals(index):
+    hits = index.search("admision requisito")["paragraphs"]["results"]
+    assert hits and hits[0]["text"].startswith("Requisitos de admisión")
+    assert "position" in hits[0] and "index" in hits[0]["position"]
+
+def test_search_applies_label_filters_and_size(index):
+    query = "calendario y prueba académica"
+    assert {h["rid"] for h in index.search(query)["paragraphs"]["results"]} == {"r1", "r2"}
+    filtered = index.search(query, filters=["/l/tipo/guia"])["paragraphs"]["results"]
+    assert [h["rid"] for h in filtered] == ["r1"]
+    assert len(index.search(query, size=1)["paragraphs"]["results"]) == 1
+
+def test_search_without_known_terms_is_empty(index):
+    res = index.search("zzz qqq")
+    assert res["paragraphs"]["results"] == [] and res["resources"] == {}
+
+def test_terms_drop_stop_words_and_fold_accents():
+    assert "de" not in terms("Requisitos de admisión")
+    assert terms("ADMISIÓN") == terms("admision")
+
+def test_rejects_files_that_are_not_an_index(tmp_path):
+    path = tmp_path / "otro.bin"
+    path.write_bytes(b"no es un indice" * 4)
+    with pytest.raises(ValueError):
+        LocalIndex(str(path))
+
+def _hits(*pairs):
+    return {"paragraphs": {"results": [{"rid": rid, "text": text, "score": score} for rid, text, score in pairs]},
+            "resources": {}}
+
+def test_parallel_mode_sends_nuclia_first_and_merges_on_one_scale(monkeypatch):
+    import asyncio
+    from app import nuclia
+
+    calls = []
+
+    async def remote_search(key, url, params, *args):
+        calls.append("nuclia")
+        await asyncio.sleep(0.01)
+        return _hits(("n1", "Becas de excelencia", 12.0), ("n2", "Horario de biblioteca", 6.0))
+
+    def local(query, **kwargs):
+        calls.append("local")
+        found = _hits(("l1", "Requisitos de admisión", 0.9))
+        return {**found, "local": {"use": kwargs.get("use")}}
+
+    monkeypatch.setattr(nuclia, "LOCAL_SEARCH_MODE", "parallel")
+    monkeypatch.setattr(nuclia, "local_index", lambda: object())
+    monkeypatch.setattr(nuclia, "local_search", local)
+    monkeypatch.setattr(nuclia, "_remote_search", remote_search)
+    res = asyncio.run(nuclia.nuclia_search_async("becas", size=3))
+    assert calls == ["nuclia", "local"]  # la petición a Nuclia ya salió
+    hits = res["paragraphs"]["results"]
+    assert [h["rid"] for h in hits] == ["n1", "l1", "n2"]
+    assert [h["score"] for h in hits] == [1.0, 0.9, 0.5]
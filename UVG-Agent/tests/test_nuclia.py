@@ -0,0 +1,69 @@
+# tests/test_nuclia.py
+import asyncio
+
+import httpx
+import pytest
+
+from app import nuclia
+from app.cache import MemoryCache, SingleFlight
+
+URL, PARAMS = "http://nuclia.test/api/v1/kb/kb-test/search", {"query": "becas"}
+
+@pytest.fixture
+def search_env(monkeypatch):
+    """Caché de búsquedas propia, reloj fijo y un Nuclia que cuenta llamadas."""
+    env = type("Env", (), {})()
+    env.now, env.calls, env.fail = 1000.0, [], None
+    env.cache = MemoryCache(max_entries=10, ttl=60 + 30, grace=600)
+    monkeypatch.setattr(nuclia.time, "time", lambda: env.now)
+    monkeypatch.setattr(nuclia, "search_cache", env.cache)
+    monkeypatch.setattr(nuclia, "search_flight", SingleFlight())
+    monkeypatch.setattr(nuclia, "SEARCH_CACHE_TTL", 60)
+
+    async def fetch(key, url, params, upstream="nuclia", headers=None):
+        env.calls.append(key)
+        await asyncio.sleep(0.01)
+        if env.fail is not None:
+            raise env.fail
+        data = {"n": len(env.calls)}
+        env.cache.set(key, {"at": env.now, "data": data})
+        return data
+    monkeypatch.setattr(nuclia, "_fetch_search", fetch)
+    return env
+
+def _search(key="k"):
+    return nuclia._remote_search(key, URL, PARAMS)
+
+def test_fresh_entry_is_served_without_calling_nuclia(search_env):
+    search_env.cache.set("k", {"at": search_env.now, "data": {"n": 0}})
+    assert asyncio.run(_search()) == {"n": 0}
+    assert search_env.calls == []
+
+def test_concurrent_misses_reach_nuclia_once(search_env):
+    async def main():
+        return await asyncio.gather(*(_search() for _ in range(4)))
+    assert asyncio.run(main()) == [{"n": 1}] * 4
+    assert search_env.calls == ["k"]
+
+def test_stale_entry_is_served_and_refreshed_in_background(search_env):
+    search_env.cache.set("k", {"at": search_env.now - 70, "data": {"n": 0}})
+
+    async def main():
+        first = await _search()
+        await asyncio.sleep(0.05)  # deja terminar la revalidación
+        return first, await _search()
+    assert asyncio.run(main()) == ({"n": 0}, {"n": 1})
+    assert search_env.calls == ["k"]
+    assert search_env.cache.stats.stale == 1
+
+def test_upstream_error_serves_the_expired_entry(search_env):
+    search_env.cache.set("k", {"at": search_env.now - 120, "data": {"n": 0}})
+    search_env.now += 100  # fuera de TTL + ventana stale, dentro de STALE_IF_ERROR
+    search_env.fail = httpx.ConnectError("caído")
+    res = asyncio.run(_search())
+    assert res["n"] == 0 and res["stale"]["reason"] == "ConnectError"
+
+def test_upstream_error_without_cached_entry_is_raised(search_env):
+    search_env.fail = httpx.ConnectError("caído")
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(_search())
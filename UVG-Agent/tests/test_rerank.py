@@ -0,0 +1,63 @@
+# tests/test_rerank.py
+from app import rerank as rr
+from app.rerank import rerank, score_candidates
+
+QUESTION = "¿Qué becas hay para ingeniería en el campus altiplano?"
+
+def _search(*hits):
+    return {
+        "paragraphs": {"results": [dict(h) for h in hits], "total": len(hits)},
+        "resources": {"r-becas": {"title": "Becas y ayuda financiera"}, "r-otro": {"title": "Parqueos"}},
+    }
+
+RELEVANT = {"rid": "r-becas", "text": "Las becas para ingeniería en el campus Altiplano cubren hasta el 50%.", "score": 0.4}
+OTHER_SEDE = {"rid": "r-becas", "text": "Las becas para ingeniería en el campus sur cubren el 30%.", "score": 0.4}
+NOISE = [
+    {"rid": "r-otro", "text": f"Horario de parqueo número {i} para visitantes del edificio {i}.", "score": 0.9}
+    for i in range(6)
+]
+
+def test_relevant_paragraph_beats_a_higher_nuclia_score():
+    ranked, stats = rerank(_search(*NOISE, RELEVANT), QUESTION, max_chunks=20)
+    hits = ranked["paragraphs"]["results"]
+    assert hits[0]["text"] == RELEVANT["text"]
+    assert all("rerank" in h for h in hits)
+    assert [h["rerank"] for h in hits] == sorted((h["rerank"] for h in hits), reverse=True)
+    assert stats["candidates"] == 7 and stats["kept"] == len(hits)
+    assert stats["removed_chunks"] == 7 - len(hits) and stats["removed_tokens"] >= 0
+
+def test_sede_named_in_the_question_wins():
+    ranked, _ = rerank(_search(OTHER_SEDE, RELEVANT), QUESTION)
+    assert ranked["paragraphs"]["results"][0]["text"] == RELEVANT["text"]
+
+def test_cutoff_drops_weak_candidates_but_keeps_the_minimum(monkeypatch):
+    monkeypatch.setattr(rr, "RERANK_CUTOFF", 0.99)
+    monkeypatch.setattr(rr, "RERANK_MIN_KEEP", 2)
+    ranked, stats = rerank(_search(*NOISE, RELEVANT), QUESTION)
+    assert stats["kept"] == 2
+    assert ranked["paragraphs"]["results"][0]["text"] == RELEVANT["text"]
+
+def test_keeps_at_most_top_k_and_max_chunks(monkeypatch):
+    monkeypatch.setattr(rr, "RERANK_CUTOFF", 0.0)
+    assert rerank(_search(*NOISE, RELEVANT), QUESTION, top_k=3)[1]["kept"] == 3
+    assert rerank(_search(*NOISE, RELEVANT), QUESTION, top_k=8, max_chunks=2)[1]["kept"] == 2
+
+def test_min_score_and_empty_texts_are_filtered_first():
+    empty = {"rid": "r-otro", "text": "   ", "score": 1.0}
+    low = {**RELEVANT, "score": 0.05}
+    ranked, stats = rerank(_search(empty, low, OTHER_SEDE), QUESTION, min_score=0.1)
+    assert stats["candidates"] == 1
+    assert [h["text"] for h in ranked["paragraphs"]["results"]] == [OTHER_SEDE["text"]]
+
+def test_empty_search():
+    ranked, stats = rerank({"paragraphs": {"results": []}}, QUESTION)
+    assert ranked["paragraphs"]["results"] == [] and stats["kept"] == 0
+
+def test_rewritten_query_terms_count_less_than_the_question():
+    hits = [
+        {"rid": "r-becas", "text": "Becas para ingeniería.", "score": 0.5},
+        {"rid": "r-becas", "text": "Financiamiento estudiantil disponible.", "score": 0.5},
+    ]
+    scores = score_candidates(hits, {}, "becas ingeniería", "financiamiento estudiantil")
+    assert scores[0][0] > scores[1][0] > 0
+    assert set(scores[0][1]) == {"bm25", "phrase", "sede", "title", "prior"}
@@ -0,0 +1,128 @@
+# tests/test_resilience.py
+import asyncio
+
+import httpx
+import pytest
+
+from app import resilience
+from app.deadline import start_deadline
+from app.resilience import CircuitBreaker, CircuitOpen, is_transient, resilient
+
+def _status_error(status: int, **headers) -> httpx.HTTPStatusError:
+    request = httpx.Request("GET", "http://nuclia.test/search")
+    response = httpx.Response(status, headers=headers, request=request)
+    return httpx.HTTPStatusError(f"{status}", request=request, response=response)
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def env(monkeypatch):
+    """Breaker nuevo para "nuclia", sin jitter (siempre el tope) y esperas anotadas, no reales."""
+    clock, sleeps = Clock(), []
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+    monkeypatch.setattr(resilience.time, "monotonic", clock)
+    monkeypatch.setattr(resilience.asyncio, "sleep", sleep)
+    monkeypatch.setattr(resilience.random, "uniform", lambda low, high: high)
+    breaker = CircuitBreaker("nuclia", failures=3, reset=30)
+    monkeypatch.setitem(resilience.breakers, "nuclia", breaker)
+    start_deadline(0)  # sin plazo salvo que el test lo fije
+    return type("Env", (), {"clock": clock, "sleeps": sleeps, "breaker": breaker})
+
+def _flaky(*outcomes):
+    """fn para resilient: cada llamada consume un resultado (excepción o valor)."""
+    calls = []
+
+    async def fn():
+        outcome = outcomes[len(calls)]
+        calls.append(outcome)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+    return fn, calls
+
+def test_transient_errors_classification():
+    assert is_transient(httpx.ConnectError("caído"))
+    assert is_transient(_status_error(503)) and is_transient(_status_error(529))
+    assert not is_transient(_status_error(400)) and not is_transient(ValueError())
+
+def test_retries_transient_errors_with_exponential_backoff(env):
+    fn, calls = _flaky(httpx.ConnectError("a"), _status_error(502), "ok")
+    assert asyncio.run(resilient("nuclia", fn, attempts=3)) == "ok"
+    assert len(calls) == 3
+    assert env.sleeps == [resilience.RETRY_BASE_DELAY, resilience.RETRY_BASE_DELAY * 2]
+    assert env.breaker.state == "closed" and env.breaker.failures == 0
+
+def test_non_transient_error_is_not_retried(env):
+    fn, calls = _flaky(_status_error(400), "ok")
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(resilient("nuclia", fn, attempts=3))
+    assert len(calls) == 1 and env.sleeps == []
+
+def test_gives_up_after_the_last_attempt(env):
+    fn, calls = _flaky(*[httpx.ConnectError("a")] * 3)
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(resilient("nuclia", fn, attempts=2))
+    assert len(calls) == 2
+
+def test_retry_after_wins_when_longer_than_the_backoff(env):
+    fn, _ = _flaky(_status_error(429, **{"retry-after": "1.5"}), "ok")
+    assert asyncio.run(resilient("nuclia", fn, attempts=2)) == "ok"
+    assert env.sleeps == [1.5]
+
+def test_does_not_wait_past_a_long_retry_after_or_the_deadline(env):
+    fn, calls = _flaky(_status_error(503, **{"retry-after": "120"}), "ok")
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(resilient("nuclia", fn, attempts=3))
+    assert len(calls) == 1 and env.sleeps == []
+
+    async def within_budget():
+        start_deadline(0.1)  # menos que el primer backoff
+        fn, _ = _flaky(httpx.ConnectError("a"), "ok")
+        return await resilient("nuclia", fn, attempts=3)
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(within_budget())
+    assert env.sleeps == []
+
+def test_breaker_opens_after_consecutive_failures(env):
+    fn, calls = _flaky(*[httpx.ConnectError("a")] * 3)
+    for _ in range(3):
+        with pytest.raises(httpx.ConnectError):
+            asyncio.run(resilient("nuclia", fn, attempts=1))
+    assert env.breaker.state == "open" and env.breaker.opens == 1
+    with pytest.raises(CircuitOpen) as err:
+        asyncio.run(resilient("nuclia", fn, attempts=1))
+    assert len(calls) == 3  # ya no se llamó al upstream
+    assert err.value.headers == {"Retry-After": "30"}
+
+def test_half_open_lets_one_probe_and_closes_on_success(env):
+    breaker = env.breaker
+    for _ in range(3):
+        breaker.failure()
+    env.clock.now += 31
+    breaker.check()  # la prueba
+    assert breaker.state == "half_open"
+    with pytest.raises(CircuitOpen):
+        breaker.check()  # una sola a la vez
+    breaker.success()
+    assert breaker.state == "closed"
+    breaker.check()
+
+def test_failed_or_abandoned_probe(env):
+    breaker = env.breaker
+    for _ in range(3):
+        breaker.failure()
+    env.clock.now += 31
+    breaker.check()
+    breaker.abandon()  # cancelada sin veredicto: otra prueba puede pasar
+    breaker.check()
+    breaker.failure()
+    assert breaker.state == "open" and breaker.opens == 2
+    with pytest.raises(CircuitOpen):
+        breaker.check()
@@ -0,0 +1,63 @@
+# tests/test_sessions.py
+import pytest
+
+from app import sessions
+from app.cache import MemoryCache
+from app.sessions import Session, history_messages, keywords, load_session, plan_followup, save_turn
+
+FIRST = "¿Qué becas ofrece la UVG para Ingeniería en Campus Central?"
+SEARCH = {
+    "paragraphs": {"results": [
+        {"rid": "r1", "text": "Becas de excelencia para Ingeniería.", "score": 0.8},
+        {"rid": "r2", "text": "Campus Central: horarios de atención.", "score": 0.5},
+    ]},
+    "resources": {"r1": {"title": "Becas"}, "r2": {"title": "Campus"}, "r3": {"title": "Otro"}},
+}
+
+@pytest.fixture
+def session():
+    return Session("s1", turns=[{"q": FIRST, "a": "# Respuesta\nSí."}], search=SEARCH, keywords=keywords(FIRST))
+
+def test_first_question_is_new_and_without_paragraphs_a_new_topic():
+    assert plan_followup(Session("s1"), FIRST).mode == "new"
+    assert plan_followup(Session("s1", turns=[{"q": "hola", "a": "hola"}]), FIRST).mode == "new_topic"
+
+def test_no_new_terms_reuses_the_stored_paragraphs(session):
+    plan = plan_followup(session, "¿Y para ingeniería?")
+    assert plan.mode == "reuse" and plan.new_terms == []
+    assert plan.prior is SEARCH and plan.keywords == session.keywords
+
+def test_new_entity_searches_incrementally_with_decayed_prior(session):
+    plan = plan_followup(session, "¿Y también aplica en la sede Altiplano?")
+    assert plan.mode == "incremental" and plan.new_terms == ["altiplano"]
+    # La sede nueva reemplaza a la anterior en el tema y en la consulta
+    assert "central" not in plan.keywords and plan.keywords[-1] == "altiplano"
+    assert plan.query.endswith("altiplano") and "central" not in plan.query
+    scores = [h["score"] for h in plan.prior["paragraphs"]["results"]]
+    assert scores == pytest.approx([0.8 * sessions.SESSION_REUSE_DECAY, 0.5 * sessions.SESSION_REUSE_DECAY])
+    assert SEARCH["paragraphs"]["results"][0]["score"] == 0.8  # lo guardado no se modifica
+
+def test_mostly_new_terms_start_a_new_topic(session):
+    plan = plan_followup(session, "¿Cuánto cuesta el parqueo del estadio deportivo?")
+    assert plan.mode == "new_topic" and plan.prior == {}
+    assert plan.keywords == ["cuesta", "parqueo", "estadio", "deportivo"]
+
+def test_save_turn_round_trip_prunes_paragraphs_and_sources(monkeypatch, session):
+    monkeypatch.setattr(sessions, "session_store", MemoryCache(max_entries=10, ttl=60))
+    plan = plan_followup(session, "¿Y para ingeniería?")
+    answer = "# Respuesta\nLas becas cubren el 50%.\n\n## Fuentes consultadas\n- Becas"
+    save_turn(session, "¿Y para ingeniería?", answer, plan, search=SEARCH, max_chunks=1)
+    loaded = load_session("s1")
+    assert [t["q"] for t in loaded.turns] == [FIRST, "¿Y para ingeniería?"]
+    assert loaded.turns[-1]["a"] == "# Respuesta\nLas becas cubren el 50%."
+    assert [h["rid"] for h in loaded.paragraphs] == ["r1"]
+    assert set(loaded.search["resources"]) == {"r1"}
+
+def test_history_keeps_the_latest_turn_even_when_truncated():
+    long_answer = "Detalle de becas. " * 200
+    session = Session("s1", turns=[{"q": "uno", "a": "primera"}, {"q": "dos", "a": long_answer}])
+    messages, used = history_messages(session, budget=100)
+    assert [m["content"] for m in messages if m["role"] == "user"] == ["dos"]
+    assert messages[-1]["content"].endswith("…") and 0 < used <= 100
+    messages, _ = history_messages(session, budget=10_000)
+    assert [m["role"] for m in messages] == ["user", "assistant", "user", "assistant"]
@@ -0,0 +1,117 @@
+# tests/test_streaming.py
+import asyncio
+from types import SimpleNamespace as NS
+
+from app import deadline as dl
+from app import streaming
+from app.agent import Retrieval
+from app.formatter import DEFAULT_NEXT_STEP
+from app.streaming import StructureGuard
+
+SOURCES = [{"title": "Reglamento de becas", "url": "https://uvg.edu.gt/becas"}]
+
+def _stream(guard: StructureGuard, chunks) -> str:
+    return "".join(guard.feed(c) for c in chunks)
+
+def test_disabled_guard_passes_text_through():
+    guard = StructureGuard(False)
+    out = _stream(guard, ["Hola", ", ", "mundo"]) + guard.finish(SOURCES)
+    assert out == "Hola, mundo"
+    assert guard.patched == [] and guard.missing == []
+
+def test_holds_back_a_split_heading_and_keeps_it_intact():
+    guard = StructureGuard(True)
+    assert guard.feed("# Res") == ""  # todavía puede ser el encabezado
+    out = guard.feed("puesta\nTexto") + guard.feed(" final")
+    assert out == "# Respuesta\nTexto final"
+    assert "# Respuesta" not in guard.patched
+
+def test_prepends_the_heading_when_the_answer_starts_without_it():
+    guard = StructureGuard(True)
+    out = _stream(guard, ["La beca ", "cubre el 50%."])
+    assert out.startswith("# Respuesta\nLa beca ")
+    assert guard.patched == ["# Respuesta"]
+
+def test_finish_adds_missing_sections_once():
+    guard = StructureGuard(True)
+    body = _stream(guard, ["# Respuesta\nTexto.\n\n## Detalles\n- a"])
+    tail = guard.finish(SOURCES)
+    full = body + tail
+    assert full.count("## Siguientes pasos") == 1 and DEFAULT_NEXT_STEP in full
+    assert full.count("## Fuentes consultadas") == 1 and "Reglamento de becas" in full
+    assert guard.text == full
+    assert guard.missing == []
+
+def test_finish_without_sources_skips_the_sources_section():
+    guard = StructureGuard(True)
+    _stream(guard, ["# Respuesta\nTexto.\n\n## Siguientes pasos\n1) b"])
+    assert guard.finish([]) == ""
+    assert "## Fuentes consultadas" not in guard.text
+    assert guard.missing == ["## Detalles"]  # lo que no se completa localmente
+
+def test_finish_flushes_a_short_buffered_answer():
+    guard = StructureGuard(True)
+    assert guard.feed("# R") == ""
+    tail = guard.finish([])
+    assert tail.startswith("# R")
+    assert guard.text.startswith("# R")
+
+def test_empty_answer_gets_no_sections():
+    guard = StructureGuard(True)
+    assert guard.finish(SOURCES) == ""
+
+
+# ── Plazo de la generación en streaming
+QUESTION = "¿Cuándo cierra la inscripción del ciclo de verano?"
+
+class _SlowStream:
+    """Stream de Claude que entrega `chunks` y luego se cuelga."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    @property
+    def text_stream(self):
+        async def gen():
+            for chunk in self.chunks:
+                yield chunk
+            await asyncio.sleep(30)
+        return gen()
+
+    async def get_final_message(self):
+        return NS(usage=None)
+
+def _run_stream(monkeypatch, chunks, budget=0.3):
+    monkeypatch.setattr(dl, "_estimates", {"generation": 0.1})
+    retrieval = Retrieval(search={}, selected={}, context="Contexto.", no_context=False)
+
+    async def retrieve(*args, **kwargs):
+        return retrieval
+    monkeypatch.setattr(streaming, "_retrieve", retrieve)
+    monkeypatch.setattr(streaming, "govern_prompt", lambda r, *a: (r, {"estimated": {}}))
+    llm = NS(messages=NS(stream=lambda **kw: _SlowStream(chunks)))
+    monkeypatch.setattr(streaming, "get_async_llm", lambda: llm)
+
+    async def collect():
+        return [e async for e in streaming.ask_agent_stream(QUESTION, deadline=budget)]
+    return asyncio.run(asyncio.wait_for(collect(), 5))
+
+def test_stream_without_first_token_falls_back_at_the_deadline(monkeypatch):
+    events = _run_stream(monkeypatch, [])
+    assert [name for name, _ in events] == ["sources", "token", "done"]
+    assert "No alcancé" in events[1][1]["text"]
+    assert events[-1][1]["deadline"]["degraded"] == ["fallback_answer"]
+
+def test_stream_cut_after_tokens_closes_cleanly(monkeypatch):
+    events = _run_stream(monkeypatch, ["# Respuesta\n", "La inscripción "])
+    text = "".join(data["text"] for name, data in events if name == "token")
+    assert text.startswith("# Respuesta\nLa inscripción")
+    done = events[-1][1]
+    assert events[-1][0] == "done" and done["truncated"] == "deadline"
+    assert done["deadline"]["degraded"] == []
@@ -0,0 +1,116 @@
+# tests/test_tokens.py
+import contextvars
+import datetime as dt
+
+import pytest
+
+from app import agent, nuclia, tokens
+from app.agent import Retrieval, _fit_context, govern_prompt
+from app.nuclia import build_context
+from app.tokens import ClientQuotas, DailyQuota, count_tokens
+
+def _retrieval(n: int = 6) -> Retrieval:
+    hits = [{"rid": f"r{i}", "field": "/f/file", "score": 1.0 - i / 10,
+             "text": f"Párrafo {i}: " + "requisitos de admisión y becas " * 8} for i in range(n)]
+    search = {"paragraphs": {"results": hits}, "resources": {f"r{i}": {"title": f"Doc {i}"} for i in range(n)}}
+    context = build_context(search, max_chunks=n, include_metadata=True)
+    return Retrieval(search=search, selected=search, context=context, no_context=False, max_chunks=n)
+
+def _kept(r: Retrieval) -> list:
+    return [h["rid"] for h in r.selected["paragraphs"]["results"]]
+
+# ── Gobierno del prompt
+def test_fit_context_keeps_priority_prefix_within_allowance():
+    r = _retrieval()
+    full = count_tokens(r.context)
+    fitted = _fit_context(r, full // 2)
+    assert 0 < len(_kept(fitted)) < 6
+    assert _kept(fitted) == [f"r{i}" for i in range(len(_kept(fitted)))]
+    assert count_tokens(fitted.context) <= full // 2
+    assert not fitted.no_context
+
+def test_fit_context_with_room_keeps_everything_and_with_none_drops_context():
+    r = _retrieval()
+    assert _kept(_fit_context(r, 10 ** 6)) == _kept(r)
+    empty = _fit_context(r, 5)
+    assert _kept(empty) == [] and empty.context == "" and empty.no_context
+
+def test_govern_prompt_trims_only_over_budget(monkeypatch):
+    r = _retrieval()
+    monkeypatch.setattr(agent, "PROMPT_TOKEN_BUDGET", 10 ** 6)
+    same, info = govern_prompt(r, "¿Qué becas hay?", history_tokens=0)
+    assert same.context == r.context and "trimmed" not in info
+
+    monkeypatch.setattr(agent, "PROMPT_TOKEN_BUDGET", info["estimated"]["system"] + 300)
+    trimmed, info = govern_prompt(r, "¿Qué becas hay?", history_tokens=0)
+    assert info["trimmed"]["chunks"] > 0 and info["trimmed"]["tokens"] > 0
+    assert sum(info["estimated"].values()) <= agent.PROMPT_TOKEN_BUDGET
+
+def test_trimming_records_packing_stats_once(monkeypatch):
+    monkeypatch.setattr(agent, "CONTEXT_PACKING", True)
+    monkeypatch.setattr(nuclia, "packing_totals", type(nuclia.packing_totals)())
+    r = _retrieval()
+    context, used, stats = nuclia.pack_context(r.search, token_budget=10 ** 4, max_chunks=6, record=False)
+    r = Retrieval(search=r.search, selected=r.search, context=context, no_context=False,
+                  info={"packing": stats}, max_chunks=6)
+    monkeypatch.setattr(agent, "PROMPT_TOKEN_BUDGET", count_tokens(agent.INSTRUCTIONS) + 250)
+    governed, _info = govern_prompt(r, "¿Qué becas hay?", history_tokens=0)
+    assert nuclia.packing_totals["requests"] == 1
+    assert nuclia.packing_totals["tokens"] == governed.info["packing"]["tokens"] < stats["tokens"]
+
+# ── Cuotas diarias
+def test_daily_quota_reserve_blocks_rewrite_before_generation(monkeypatch):
+    monkeypatch.setattr(tokens, "quota", DailyQuota(1000, reserve=0.2))
+    before = tokens.governor_totals["quota_rewrite"]
+    tokens.charge("generation", 700)
+    assert tokens.allow("rewrite") and tokens.allow("generation")
+    tokens.charge("generation", 150)
+    assert not tokens.allow("rewrite") and not tokens.allow("reformat")
+    assert tokens.allow("generation")
+    assert tokens.governor_totals["quota_rewrite"] == before + 1
+    tokens.charge("generation", 150)
+    assert not tokens.allow("generation")
+    assert tokens.quota.as_dict()["remaining"] == 0
+
+def test_daily_quota_without_limit_always_allows(monkeypatch):
+    monkeypatch.setattr(tokens, "quota", DailyQuota(0))
+    tokens.charge("generation", 10 ** 9)
+    assert tokens.allow("generation") and tokens.allow("rewrite")
+    assert tokens.quota.as_dict()["remaining"] is None
+
+def test_daily_quota_resets_on_a_new_day():
+    q = DailyQuota(100)
+    q.charge("generation", 100)
+    assert not q.allows("generation")
+    q.day -= dt.timedelta(days=1)
+    assert q.allows("generation") and q.total() == 0
+
+def test_client_quota_is_charged_through_the_request_client(monkeypatch):
+    monkeypatch.setattr(tokens, "quota", DailyQuota(0))
+    monkeypatch.setattr(tokens, "client_quotas", ClientQuotas(100))
+
+    def request(client: str, n: int) -> None:
+        tokens.use_client(client)
+        tokens.charge("generation", n)
+
+    contextvars.copy_context().run(request, "1.2.3.4", 120)
+    contextvars.copy_context().run(request, "5.6.7.8", 10)
+    assert tokens.client_wait("1.2.3.4") > 0
+    assert tokens.client_wait("5.6.7.8") == 0.0
+
+def test_output_cap_and_attribution(monkeypatch):
+    monkeypatch.setattr(tokens, "OUTPUT_TOKEN_BUDGET", 300)
+    assert tokens.output_cap(1000) == 300 and tokens.output_cap(60) == 60
+    usage = type("Usage", (), {"input_tokens": 150, "cache_read_input_tokens": 50})()
+    parts = tokens.attribute({"system": 100, "context": 100}, usage)
+    assert parts == {"system": 100, "context": 100}
+    assert tokens.attribute({"system": 0}, usage) == {}
+    assert tokens.attribute({"system": 10}, None) == {}
+
+@pytest.mark.parametrize("value, expected", [
+    ("", 0), (None, 0), ([], 0),
+    ([{"role": "user", "content": "hola"}], count_tokens("hola")),
+    ([{"type": "text", "text": "uno"}, "dos"], count_tokens("uno") + count_tokens("dos")),
+])
+def test_count_tokens_handles_blocks_and_messages(value, expected):
+    assert count_tokens(value) == expected
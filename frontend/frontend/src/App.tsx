@@ -76,7 +76,8 @@ export default function App() {
         role: "assistant",
         text: res?.answer ?? res?.reply ?? res?.content ?? "",
         sources: (res?.sources ?? []).map((s: any, i: number) => ({
-          id: String(s.id ?? i),
+          id: String(s.resource_id ?? s.id ?? i),
+          kb: s.kb ?? undefined,
           title: String(s.title ?? "Fuente"),
           url: s.url ?? undefined,
           type: String(s.url || "").toLowerCase().endsWith(".pdf")
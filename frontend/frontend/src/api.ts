@@ -31,7 +31,8 @@ export async function health(): Promise<boolean> {
   }
 }
 
-/** URL del archivo original proxyeado por el backend (PDF u otros) */
-export function resourceFileUrl(resourceId: string) {
-  return `${API_BASE}/resources/${resourceId}/file`;
+/** URL del archivo original proxyeado por el backend (PDF u otros); `kb` = KB federada del recurso */
+export function resourceFileUrl(resourceId: string, kb?: string) {
+  const query = kb ? `?kb=${encodeURIComponent(kb)}` : "";
+  return `${API_BASE}/resources/${resourceId}/file${query}`;
 }
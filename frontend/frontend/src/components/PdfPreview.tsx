@@ -6,7 +6,7 @@ import { resourceFileUrl } from "../api";
  * Renderiza un PDF embebido usando Blob URL.
  * Evita convertir el binario a texto (adiós "�����").
  */
-export default function PdfPreview({ resourceId, height = "70vh" }: { resourceId: string; height?: string }) {
+export default function PdfPreview({ resourceId, kb, height = "70vh" }: { resourceId: string; kb?: string; height?: string }) {
   const [url, setUrl] = useState<string | null>(null);
   const [error, setError] = useState<string | null>(null);
 
@@ -15,7 +15,7 @@ export default function PdfPreview({ resourceId, height = "70vh" }: { resourceId
 
     (async () => {
       try {
-        const res = await fetch(resourceFileUrl(resourceId));
+        const res = await fetch(resourceFileUrl(resourceId, kb));
         if (!res.ok) throw new Error(`No se pudo descargar el PDF (${res.status})`);
         const buf = await res.arrayBuffer();
         const blob = new Blob([buf], { type: "application/pdf" });
@@ -29,7 +29,7 @@ export default function PdfPreview({ resourceId, height = "70vh" }: { resourceId
     return () => {
       if (objectUrl) URL.revokeObjectURL(objectUrl);
     };
-  }, [resourceId]);
+  }, [resourceId, kb]);
 
   if (error) {
     return <div className="rounded-lg border border-red-500/40 bg-red-900/20 p-3 text-sm text-red-200">⚠️ {error}</div>;
@@ -7,6 +7,8 @@ import { resourceFileUrl } from "../api";
 export type SourceDoc = {
   /** Usa aquí el ID de recurso de tu RAG/Nuclia para PDFs */
   id: string;
+  /** KB de Nuclia del recurso (búsqueda federada); vacío = la KB por defecto */
+  kb?: string;
   title: string;
   url?: string;
   /** "pdf" para activar la vista embebida */
@@ -16,7 +18,7 @@ export type SourceDoc = {
 
 export default function SourceCard({ s }: { s: SourceDoc }) {
   const isPdf = s.type === "pdf";
-  const pdfUrl = isPdf ? resourceFileUrl(s.id) : undefined;
+  const pdfUrl = isPdf ? resourceFileUrl(s.id, s.kb) : undefined;
 
   const Icon = (
     <svg className="h-5 w-5 text-emerald-400" viewBox="0 0 24 24" fill="none" aria-hidden>
@@ -45,7 +47,7 @@ export default function SourceCard({ s }: { s: SourceDoc }) {
           </div>
         </div>
 
-        <PdfPreview resourceId={s.id} />
+        <PdfPreview resourceId={s.id} kb={s.kb} />
 
         <div className="mt-3 flex items-center gap-3 text-sm">
           <a